@@ -0,0 +1,175 @@
+import asyncio
+import json
+import random
+import time
+from collections import deque
+import httpx
+from postgrest.exceptions import APIError
+from .supabase import supabase
+from .deadline import run_with_deadline
+
+# 每个请求最多的行数
+MAX_ROWS = 500
+# 每个请求最多的字节数（按json估算），避免超过PostgREST的请求大小限制
+MAX_BYTES = 1024 * 1024
+# 被限流后最少缩小到多少行
+MIN_ROWS = 20
+# 同时进行的请求数量
+MAX_IN_FLIGHT = 4
+# 每个分块最多重试的次数
+MAX_RETRIES = 4
+# 重试的等待时间：BACKOFF_BASE * 2^n秒，最多BACKOFF_MAX秒
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# 可以重试的http状态码。postgrest-py只在错误内容不是PostgREST的json时把状态码放在code里
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# PostgREST的json错误中的code是PGRST或者SQLSTATE错误码，不包含http状态码，按错误码判断:
+# PGRST000-003: 连接不上数据库、schema缓存没有加载、等待连接池超时（503/504）
+# 57014: statement timeout, 57P01/57P03: 数据库正在重启, 40001/40P01: 序列化失败、死锁
+RETRY_CODES = {"PGRST000", "PGRST001", "PGRST002", "PGRST003", "57014", "57P01", "57P03", "40001", "40P01"}
+# SQLSTATE的类别：08连接异常，53资源不足（例如too many connections）
+RETRY_SQLSTATE_CLASSES = {"08", "53"}
+# 说明请求太大或者太慢，需要缩小分块：限流、请求过大、statement timeout
+SHRINK_CODES = {"429", "413", "57014"}
+
+def error_code(e):
+    if isinstance(e, APIError):
+        return str(e.code or "")
+    return ""
+
+def is_retryable(e):
+    if isinstance(e, httpx.TransportError):
+        return True
+    code = error_code(e)
+    if code.isdigit() and len(code) == 3:
+        return int(code) in RETRY_STATUS
+    if code in RETRY_CODES:
+        return True
+    return len(code) == 5 and code[:2] in RETRY_SQLSTATE_CLASSES
+
+def should_shrink(e):
+    if isinstance(e, httpx.TimeoutException):
+        return True
+    return error_code(e) in SHRINK_CODES
+
+def row_size(row):
+    return len(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8"))
+
+class BulkWriter:
+    """
+    把大量的行分块upsert到supabase:
+    - 每块不超过batch_rows行、max_bytes字节
+    - 最多parallel个分块同时写入
+    - 5xx和429按指数退避重试，被限流或者超时时缩小分块，成功后逐渐恢复
+    - 某一块失败不影响其他块，结果中按块记录
+    """
+    def __init__(self, table_name, on_conflict=None, max_rows=MAX_ROWS, max_bytes=MAX_BYTES, parallel=MAX_IN_FLIGHT, retries=MAX_RETRIES):
+        self.table_name = table_name
+        self.on_conflict = on_conflict
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.parallel = parallel
+        self.retries = retries
+        self.batch_rows = max_rows
+
+    def _send(self, rows):
+        query = supabase.table(self.table_name)
+        if self.on_conflict:
+            return query.upsert(rows, on_conflict=self.on_conflict).execute()
+        return query.upsert(rows).execute()
+
+    def _take(self, pending, sizes):
+        """
+        从pending中取出下一个分块，超过当前的行数或者字节数限制时把剩下的部分放回去
+        """
+        rows, attempts = pending.popleft()
+        count = 0
+        total = 0
+        for row in rows:
+            size = sizes[id(row)]
+            if count > 0 and (count >= self.batch_rows or total + size > self.max_bytes):
+                break
+            count += 1
+            total += size
+        if count < len(rows):
+            pending.appendleft((rows[count:], attempts))
+        return rows[:count], attempts, total
+
+    def _shrink(self):
+        old = self.batch_rows
+        self.batch_rows = max(MIN_ROWS, self.batch_rows // 2)
+        if old != self.batch_rows:
+            print(f"[BulkWriter]: throttled, table = {self.table_name}, batch_rows {old} -> {self.batch_rows}")
+
+    def _grow(self):
+        if self.batch_rows < self.max_rows:
+            self.batch_rows = min(self.max_rows, self.batch_rows + max(MIN_ROWS, self.batch_rows // 4))
+
+    async def write(self, rows):
+        """
+        写入rows，返回每个分块的结果:
+        {"table_name", "rows", "written", "failed", "batch_rows", "chunks": [{"index", "rows", "bytes", "attempts", "status", "error", "elapsed"}]}
+        失败的分块带有retryable：最后一次的错误是否可以重试
+        """
+        sizes = {id(row): row_size(row) for row in rows}
+        pending = deque()
+        if len(rows) > 0:
+            pending.append((list(rows), 0))
+        chunks = []
+        in_flight = [0]
+        # 分块完成（成功、失败或者放回pending）时通知等待的worker
+        changed = asyncio.Condition()
+
+        async def worker():
+            while True:
+                async with changed:
+                    # 正在写入的分块失败时会把行放回来，缩小后可以并行重试；没有进行中的分块时结束
+                    await changed.wait_for(lambda: len(pending) > 0 or in_flight[0] == 0)
+                    if len(pending) == 0:
+                        return
+                    chunk, attempts, size = self._take(pending, sizes)
+                    in_flight[0] += 1
+                index = len(chunks)
+                record = {"index": index, "rows": len(chunk), "bytes": size, "attempts": attempts + 1, "status": "ok", "error": None, "elapsed": 0.0}
+                chunks.append(record)
+                start = time.monotonic()
+                try:
+                    await run_with_deadline(self._send, chunk)
+                    self._grow()
+                except Exception as e:
+                    retryable = is_retryable(e)
+                    if not retryable or attempts >= self.retries:
+                        record["status"] = "failed"
+                        record["error"] = str(e)
+                        record["retryable"] = retryable
+                        print(f"[BulkWriter]: chunk failed, table = {self.table_name}, rows = {len(chunk)}, error = {e}")
+                    else:
+                        record["status"] = "retry"
+                        record["error"] = str(e)
+                        if should_shrink(e):
+                            self._shrink()
+                        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempts)) * (0.5 + random.random())
+                        await asyncio.sleep(delay)
+                        # 放回队列，按新的分块大小重新切分
+                        pending.appendleft((chunk, attempts + 1))
+                finally:
+                    async with changed:
+                        in_flight[0] -= 1
+                        changed.notify_all()
+                record["elapsed"] = round(time.monotonic() - start, 3)
+
+        await asyncio.gather(*[worker() for _ in range(max(1, self.parallel))])
+        written = sum(c["rows"] for c in chunks if c["status"] == "ok")
+        failed = sum(c["rows"] for c in chunks if c["status"] == "failed")
+        return {
+            "table_name": self.table_name,
+            "rows": len(rows),
+            "written": written,
+            "failed": failed,
+            "batch_rows": self.batch_rows,
+            "chunks": chunks,
+        }
+
+async def bulk_upsert(table_name, rows, on_conflict=None, **kwargs):
+    return await BulkWriter(table_name, on_conflict, **kwargs).write(rows)
@@ -1,9 +1,12 @@
 from celery.app import Celery
 from celery.schedules import crontab
-import uuid
-from .task import TaskRequest, run_single_task
+from celery.signals import worker_process_init, worker_process_shutdown
+from .task import perform_tasks, task_runner
+from .task_queue import task_queue
+from .fleet_sync import SYNC_TABLES, run_fleet_sync
+from .fleet_users import FLEET_USER_INTERVAL, run_fleet_user_sync
+from .worker_loop import worker_loop
 import json
-import asyncio
 # user="gateway"
 # password='Tplink753'
 # host="rmq.bingbing.tv"
@@ -16,6 +19,29 @@ broker_url = f"{protocol}://{host}:{port}/{vhost}"
 backend_url = broker_url
 celery = Celery(__name__, broker=broker_url, backend=backend_url)
 
+# 一条消息中的任务数量，以及worker同时执行的任务数量
+TASK_BATCH = 50
+BATCH_CONCURRENCY = 16
+# 每个worker进程预取的消息数量，事件循环在执行当前消息时下一批已经在本地
+celery.conf.worker_prefetch_multiplier = 4
+
+# 定时同步：每张表一个周期，由celery beat触发；过期的任务不再执行，避免积压
+celery.conf.beat_schedule = {
+    f"fleet-sync-{table_name}": {
+        "task": "fleet_sync_table",
+        "schedule": cfg["interval"],
+        "args": (table_name,),
+        "options": {"expires": cfg["interval"]},
+    }
+    for table_name, cfg in SYNC_TABLES.items()
+}
+# 全舰队的账号、组、带宽策略和虚拟组成员同步
+celery.conf.beat_schedule["fleet-sync-users"] = {
+    "task": "fleet_sync_users",
+    "schedule": FLEET_USER_INTERVAL,
+    "options": {"expires": FLEET_USER_INTERVAL},
+}
+
 
 @celery.task
 def add(obj):
@@ -24,17 +50,63 @@ def add(obj):
     y = obj.get("y")
     return x + y
 
+@worker_process_init.connect
+def start_worker_loop(**kwargs):
+    # 每个worker进程启动时创建自己的事件循环，并定期把本地任务队列的状态写回supabase
+    worker_loop.start()
+    worker_loop.spawn(task_runner.flush_loop())
+
+@worker_process_shutdown.connect
+def stop_worker_loop(**kwargs):
+    try:
+        worker_loop.run(task_queue.flush())
+    except Exception as e:
+        print(f"[WorkerLoop]: final flush failed, error = {e}")
+    worker_loop.stop()
+
 @celery.task
 def perform_task_celery(task_str:str):
-    asyncio.run(do_perform_task_celery(task_str))
+    worker_loop.run(do_perform_task_celery(task_str))
 
 async def do_perform_task_celery(task_str:str):
     print("perform_task_celery: {}".format(task_str))
     task = json.loads(task_str)
-    task_id = str(uuid.uuid4())
-    command = task.get("cmd")
-    data = task.get("data")
-    print(f"task_id: {task_id}, command: {command}, data: {data}")
-    tr = TaskRequest(id=task_id, command=command, data=data)
-    res = await run_single_task(tr)
-    return res
\ No newline at end of file
+    # 状态记录在本地任务队列中，没有task_id的任务生成新的id
+    results = await perform_tasks([task])
+    if len(results) == 0:
+        return {"data": [], "result": "status不是todo,跳过"}
+    return results[0][2]
+
+@celery.task(name="perform_tasks_celery")
+def perform_tasks_celery(task_strs:list):
+    """
+    一条消息携带多个任务，在worker的事件循环中并发执行
+    """
+    return worker_loop.run(do_perform_tasks_celery(task_strs))
+
+async def do_perform_tasks_celery(task_strs, concurrency=BATCH_CONCURRENCY):
+    tasks = [json.loads(task_str) for task_str in task_strs]
+    # 一个事务写入并领取整批任务，执行完成后一个事务写入结果
+    results = await perform_tasks(tasks, concurrency)
+    failed = sum(1 for _, ok, _ in results if not ok)
+    return {"tasks": len(tasks), "done": len(results) - failed, "failed": failed, "skipped": len(tasks) - len(results)}
+
+def submit_tasks(task_strs, batch=TASK_BATCH):
+    """
+    按batch个一组发送任务，返回每条消息的celery任务id
+    """
+    return [perform_tasks_celery.delay(task_strs[i:i + batch]).id for i in range(0, len(task_strs), batch)]
+
+@celery.task(name="fleet_sync_table")
+def fleet_sync_table(table_name:str):
+    """
+    同步所有网关的table_name表
+    """
+    return worker_loop.run(run_fleet_sync(table_name))
+
+@celery.task(name="fleet_sync_users")
+def fleet_sync_users(gwids=None):
+    """
+    同步所有在线网关（或者gwids中的网关）的账号、组、带宽策略和虚拟组成员
+    """
+    return worker_loop.run(run_fleet_user_sync(gwids))
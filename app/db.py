@@ -2,23 +2,32 @@ from typing import List, Any
 from fastapi import APIRouter, HTTPException, BackgroundTasks, UploadFile, File
 from pydantic import BaseModel
 from app.utils import get_ratio_by_gwid_in_redis, set_ratio_by_gwid_in_redis, get_gateway_by_id
-from app.sdk import SDK
+from app.gw_session import session_manager
+from app.gw_scheduler import bulk_lane
+from app.gw_breaker import GatewayUnavailable
+from app.deadline import DeadlineExceeded, run_with_deadline
+from app.query_stream import stream_query_response, guess_table_name
+from app.gw_pager import PAGE_SIZE, fetch_page, iter_table_pages
+from app.sync_watermark import sync_watermarks
+from app.row_parser import transform_records
+from app.sync_pipeline import sync_table
 from app.supabase import supabase, get_supabase_table_latest_row, build_sql_for_latest_row, get_db_for_table, meta_for_table_name, formalize_supabase_datetime, build_dict_from_line, to_date
 from .task import post_single_task
-import uuid
 from datetime import datetime, date, timedelta
 import time
 import urllib.parse
 import calendar
-from .celery_app import perform_task_celery, add
-from .tasks.sync_user import UpsertUsersToSupabase, UpsertDeviceToSupabase
+from .celery_app import add, fleet_sync_table, fleet_sync_users, submit_tasks
+from .fleet_users import get_fleet_user_sync_status
+from .fleet_sync import SYNC_TABLES, sync_status
+from .log_ingest import LOG_TABLES, ingest_log_table
+from .sync_queue import sync_queue, JOB_USERS, JOB_DEVICES
+from .bulk_writer import MAX_ROWS
 import urllib.parse
 import random
-from .task import TaskRequest, run_single_task
 import json
 import re
-import luigi
-from .utils import get_device_count, str_strip, get_ratio_by_gwid, is_empty, is_not_empty, get_gw_users_list, get_basic_rpc_result, ping, upsert_user, haskv, getkv, setkv, gw_login, normalize_traffic
+from .utils import get_device_count, str_strip, get_ratio_by_gwid, is_empty, is_not_empty, fetch_gw_users_list, get_basic_rpc_result, ping, upsert_user, haskv, getkv, setkv, async_gw_login, normalize_traffic
 import asyncio 
 
 # class DBParser(abc.ABC):
@@ -53,6 +62,10 @@ class DBQuery(BaseModel):
     gwid: str
     db: str
     sql: str
+    # 流式返回的格式：ndjson或者csv，为空时按原来的方式一次性返回
+    format: str | None = None
+    # 用于解析每一行的表名称，为空时从sql中推断
+    table: str | None = None
 
 
 class TestBuildQuery(BaseModel):
@@ -99,19 +112,19 @@ async def get_gw_table_latest_row(table_name, gwid, column="happendate"):
     sql = build_sql_for_latest_row(table_name, column)
     sql = urllib.parse.quote(sql)
     print(f"[get_gw_table_latest_row] >>> db = f{db}, sql = f{sql}")
-    sdk = SDK()
     try:
-        if sdk.login(address, username, password):
-            result = sdk.query_db(db, sql)
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
+            result = await sdk.query_db(db, sql)
             print(result)
             print(type(result))
             return {"result": result}
         else:
             raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
 
 
 
@@ -134,38 +147,6 @@ def get_rpc_result(data):
     return None
 
 
-class BaseIterable:
-    def __iter__(self):
-        pass
-    def __next__(self):
-        pass
-
-class LineIterable(BaseIterable):
-    def __init__(self, table_name, lines):
-        super().__init__()
-        self.table_name = table_name
-        self.lines = lines
-    def __iter__(self):
-        meta = meta_for_table_name(self.table_name)
-        if meta is None:
-            raise HTTPException(status_code=400, detail="不存在的表名称")
-        self.meta = meta
-        r = get_rpc_result(self.lines)
-        self.query_list = r.splitlines()
-        self.idx = 0
-        return self
-    def __next__(self):
-        if self.idx < len(self.query_list):
-            idx = self.idx
-            self.idx = idx + 1
-            line = self.query_list[idx]
-            if line is None or line == "":
-                return ""
-            else:
-                return build_dict_from_line(self.meta, line)
-        else:
-            raise StopIteration
-
 def build_sync_task(table_name, query_result):
     count = 0
     tasks = []
@@ -191,49 +172,67 @@ class CreateSyncTaskQuery(BaseModel):
     gwid: str
     column: str
     full_sync: bool = False
+    # 每页从网关读取的行数
+    page_size: int = PAGE_SIZE
 
 
-# 创建同步任务
-# column: 同步比较的列名称，默认是happendate
-# gwid: 网关id
-# table_name: 需要同步的表名称，在supabase和gw两边应该相同
-@DB.post("/create_sync_task", tags=["DB"])
-async def create_sync_task(query: CreateSyncTaskQuery):
-    # 1. 获取supabase的表，以及gw的表，对比column所在列的最后一行的值
+async def get_sync_since(query: CreateSyncTaskQuery):
+    """
+    对比supabase和gw两边column所在列的最后一行，返回(should_update, since)
+    since为None时从头读取
+    """
     column = query.column or "happendate"
     gwid = query.gwid
     table_name = query.table_name
-    full_sync = query.full_sync
     supabase_last_row = await get_supabase_table_latest_row(table_name, gwid, column)
     gw_last_row = await get_gw_table_latest_row(table_name, gwid, column)
     print(f"supabase_last_row is {supabase_last_row}, gw_last_row is {gw_last_row}")
     should_update = compare_supabase_and_gw_lastrow(supabase_last_row, str_strip(get_rpc_result(gw_last_row['result'])))
-    # 2. 如果最后一行的值相同则无需创建同步任务
     # 判断是否需要全量更新
     # 如果full_sync为True，则should_update为true, supabase_last_row为None
-    if full_sync is True:
-        should_update = True
-        supabase_last_row = None
-    
+    if query.full_sync is True:
+        return True, None
+    if supabase_last_row is None:
+        return should_update, None
+    return should_update, formalize_supabase_datetime(supabase_last_row)
+
+# 创建同步任务
+# column: 同步比较的列名称，默认是happendate
+# gwid: 网关id
+# table_name: 需要同步的表名称，在supabase和gw两边应该相同
+@DB.post("/create_sync_task", tags=["DB"])
+async def create_sync_task(query: CreateSyncTaskQuery):
+    # 1. 获取supabase的表，以及gw的表，对比column所在列的最后一行的值
+    column = query.column or "happendate"
+    should_update, since = await get_sync_since(query)
+    # 2. 如果最后一行的值相同则无需创建同步任务
     if not should_update:
         return { "tasks": [], "count": 0 }
-    else:
-        # 3. 如果最后一行的值比对不同，则需要创建同步任务
-        # 3.1 同步方向：从gw同步到supabase
-        # 获取sql
-        gw_sql = ""
-        if supabase_last_row is None:
-            # 3.2 同步条数：从gw中选出happendate>supabase.last_happendate的行，或者supabase为空，则gw选出所有行
-            gw_sql = f"SELECT * FROM {query.table_name}"
-        else:
-            gw_sql = f"SELECT * FROM {query.table_name} WHERE {column} > '{formalize_supabase_datetime(supabase_last_row)}'"
-        # 执行sql, 获取内容
-        db_query = DBQuery(gwid=gwid, sql=gw_sql, db=get_db_for_table(query.table_name))
-        query_result = await query_db(db_query)
-        print(query_result)
-        # 3.3 同步任务创建：生成相关task
-        tasks = build_sync_task(query.table_name, query_result["result"])
-        return tasks
+    # 3. 从gw中分页读取column>since的行（since为空时读取所有行），生成相关task
+    tasks = []
+    async for page in iter_table_pages(query.gwid, query.table_name, column, since, page_size=query.page_size):
+        tasks.extend(page)
+    return { "tasks": tasks, "count": len(tasks) }
+
+class GwTablePageQuery(BaseModel):
+    gwid: str
+    table_name: str
+    column: str = "happendate"
+    # column的下限（不包含）
+    since: str | None = None
+    # 上一页返回的next，为空时从第一页开始
+    after: List[str] | None = None
+    page_size: int = PAGE_SIZE
+
+@DB.post("/gw_table_page", tags=["DB"])
+async def gw_table_page(query: GwTablePageQuery):
+    """
+    按排序键分页读取网关上的表，返回一页数据和下一页的游标，next为空时已经读完
+    """
+    if query.page_size <= 0:
+        raise HTTPException(status_code=400, detail="page_size should be positive")
+    rows, after = await fetch_page(query.gwid, query.table_name, query.column or "happendate", query.since, query.after, query.page_size)
+    return { "data": rows, "count": len(rows), "next": after }
 
 
 def build_sync_command(gwid, data, table_name, keys):
@@ -274,6 +273,9 @@ class PostSyncTasks(BaseModel):
     gwid: str
     column: str
     keys: List[str]
+    page_size: int = PAGE_SIZE
+    # 为True时忽略同步水位，从头读取网关上的整张表
+    rebuild: bool = False
 
 def build_individual_task_cmds(gwid, table_name, column, tasks, keys):
     cmds = []
@@ -320,15 +322,8 @@ async def test_update_global_id_for_task(param: TestUpdateGlobalIdForTaskParam):
 
 def build_bulk_task_cmds(gwid, table_name, column, tasks, keys):
     cmds = []
-    for task in tasks:
-        update_task_hour(task)
-        # 构建global_id
-        if len(keys) > 0:
-            update_global_id_for_task(task, keys, gwid)
-    # 聚合task
-    new_task = []
-    for task in tasks:
-        new_task.append(task)
+    # 按列合并hour、构建global_id，不修改传入的tasks
+    new_task = transform_records(tasks, gwid, keys)
     if len(keys) <= 0:
         keys = ["gwid", column]
     d = build_sync_command(gwid, new_task, table_name, keys)
@@ -345,39 +340,99 @@ async def post_sync_tasks(query: PostSyncTasks):
     # target_table_name是supabase上的表名称
     target_table_name = query.target_table_name or query.table_name
     keys = query.keys or []
-    q = CreateSyncTaskQuery(table_name=table_name, gwid=gwid, column=column, full_sync=True)
-    task_ret = await create_sync_task(q)
-    tasks = task_ret.get("tasks")
-    
-    bulk_update = True
-    if bulk_update:
-        cmds = build_bulk_task_cmds(gwid, target_table_name, column, tasks, keys)
-    else:
-        cmds = build_individual_task_cmds(gwid, target_table_name, column, tasks, keys)
-    # cmds = []
-    # for task in tasks: 
-    #     # 生成sync命令
-    #     update_task_hour(task)
-    #     d = build_sync_command(gwid, task, table_name, ["gwid", column])
-    #     # 修复happendate
-    #     # 发送sync命令
-    #     print(f"task  ==== {task}, d === {d}")
-    #     cmds.append(d)
-    # 对于cmds中的命令，开始执行
-    result = []
-    for cmd in cmds:
-        task_id = str(uuid.uuid4())
-        command = cmd.get("cmd")
-        data = cmd.get("data")
-        print(f"task_id: {task_id}, command: {command}, data: {data}")
-        tr = TaskRequest(id=task_id, command=command, data=data)
-        res = await run_single_task(tr)
-        print(f"finish task result =  ", str(res))
-        result.append(res)
-    return result
+    # 从检查点或者同步水位开始读取：只读取新的行，以及最后一天里可能还在变化的行
+    # 读取、解析、转换、写入流水线执行，每页写入后记录检查点；同一个网关和表同时只有一个同步
+    return await sync_table(gwid, table_name, target_table_name, column, keys, query.rebuild, query.page_size)
 
 class SyncTrafficParam(BaseModel):
     gwid: str
+    # 为True时忽略同步水位，全量重新同步
+    rebuild: bool = False
+
+class SyncWatermarkParam(BaseModel):
+    gwid: str | None = None
+    table_name: str | None = None
+
+class IngestLogTableParam(BaseModel):
+    gwid: str
+    table_name: str
+    # 时间范围[since, until]，都为空时从同步水位开始并推进水位
+    since: str | None = None
+    until: str | None = None
+    rebuild: bool = False
+
+@DB.post("/ingest_log_table", tags=["traffic"])
+async def ingest_log_table_api(query: IngestLogTableParam):
+    """
+    按时间窗口并行导入网关上的日志表（websurflog, webpostlog, maillog, ftplog等）
+    """
+    if query.table_name not in LOG_TABLES:
+        raise HTTPException(status_code=400, detail=f"不支持导入的表: {query.table_name}")
+    gw = await get_gateway_by_id(query.gwid)
+    if gw is None or len(gw.data) == 0:
+        raise HTTPException(status_code=400, detail="gateway not found")
+    return await ingest_log_table(query.gwid, query.table_name, query.since, query.until, query.rebuild)
+
+@DB.post("/sync_status", tags=["traffic"])
+async def get_sync_status(query: SyncWatermarkParam):
+    """
+    查询定时同步的状态和最后一次成功的时间，gwid为空时返回所有网关
+    """
+    statuses = await run_with_deadline(sync_status.list, query.gwid)
+    if query.table_name is not None:
+        statuses = [s for s in statuses if s["table_name"] == query.table_name]
+    return { "data": statuses }
+
+@DB.post("/run_fleet_sync", tags=["traffic"])
+async def run_fleet_sync_now(query: SyncWatermarkParam):
+    """
+    立即触发一次全舰队同步（不等待celery beat），table_name为空时同步所有定时同步的表
+    """
+    tables = [query.table_name] if query.table_name else list(SYNC_TABLES.keys())
+    for table_name in tables:
+        if table_name not in SYNC_TABLES:
+            raise HTTPException(status_code=400, detail=f"不支持定时同步的表: {table_name}")
+    task_ids = [fleet_sync_table.delay(table_name).id for table_name in tables]
+    return { "task_ids": task_ids }
+
+class FleetUserSyncParam(BaseModel):
+    # 为空时同步所有在线的网关
+    gwids: List[str] | None = None
+
+@DB.post("/run_fleet_user_sync", tags=["DB"])
+async def run_fleet_user_sync_now(query: FleetUserSyncParam):
+    """
+    立即触发一次全舰队的账号、组、带宽策略和虚拟组成员同步（不等待celery beat）
+    """
+    task = fleet_sync_users.delay(query.gwids)
+    return { "task_id": task.id }
+
+@DB.post("/fleet_user_sync_status", tags=["DB"])
+async def fleet_user_sync_status():
+    """
+    查询最近一次全舰队用户同步的进度：阶段、已读取和失败的网关数量、每个网关的错误和每张表的写入结果
+    """
+    return { "data": await run_with_deadline(get_fleet_user_sync_status) }
+
+@DB.post("/get_sync_watermarks", tags=["traffic"])
+async def get_sync_watermarks(query: SyncWatermarkParam):
+    """
+    查询同步水位，gwid为空时返回所有网关
+    """
+    watermarks = await run_with_deadline(sync_watermarks.list, query.gwid)
+    if query.table_name is not None:
+        watermarks = [w for w in watermarks if w["table_name"] == query.table_name]
+    return { "data": watermarks }
+
+@DB.post("/reset_sync_watermarks", tags=["traffic"])
+async def reset_sync_watermarks(query: SyncWatermarkParam):
+    """
+    清除网关的同步水位，下一次同步从supabase中已有的最后一天开始
+    """
+    if query.gwid is None or query.gwid == "":
+        raise HTTPException(status_code=400, detail="gwid should not be empty")
+    await sync_watermarks.aclear(query.gwid, query.table_name)
+    return { "result": "success" }
 
 @DB.post("/test_sync_acctreport_b", tags=["tests"])
 async def test_sync_acctreport_b(query: SyncTrafficParam):
@@ -388,7 +443,7 @@ async def test_sync_acctreport_b(query: SyncTrafficParam):
     gwid = query.gwid
     target_table_name = "acctreport"
     global_id_keys = ["gwid", "acct", "happendate"]
-    q = PostSyncTasks(table_name="acctreport", target_table_name=target_table_name, gwid=gwid, column="happendate", keys=global_id_keys)
+    q = PostSyncTasks(table_name="acctreport", target_table_name=target_table_name, gwid=gwid, column="happendate", keys=global_id_keys, rebuild=query.rebuild)
     task_ret = await post_sync_tasks(q)
     # 对结果记录日志
     print(f"同步acctreport表: task_ret = {task_ret}")
@@ -404,7 +459,7 @@ async def test_sync_acctreport_b(query: SyncTrafficParam):
     gwid = query.gwid
     target_table_name = "hourreport"
     global_id_keys = ["gwid", "hour", "happendate"]
-    q = PostSyncTasks(table_name="hourreport", target_table_name=target_table_name, gwid=gwid, column="happendate", keys=global_id_keys)
+    q = PostSyncTasks(table_name="hourreport", target_table_name=target_table_name, gwid=gwid, column="happendate", keys=global_id_keys, rebuild=query.rebuild)
     task_ret = await post_sync_tasks(q)
     # 对结果记录日志
     print(f"同步hourreport_b表: task_ret = {task_ret}")
@@ -417,6 +472,7 @@ async def sync_traffics(query: SyncTrafficParam):
     """
     将hourreport, acctreport两张表的内容，从db中同步到supabase的同名表中。
     gwid=网关id，必选
+    rebuild=是否忽略同步水位全量同步，默认只同步新的数据
     """
     # 1. 检查gwid是否为空
     gwid = query.gwid
@@ -427,12 +483,12 @@ async def sync_traffics(query: SyncTrafficParam):
     if gw is None or len(gw.data) == 0:
         raise HTTPException(status_code=400, detail="gateway not found")
     # 3. 调用post_sync_tasks，同步hourreport表
-    q = PostSyncTasks(table_name="hourreport", target_table_name="hourreport", gwid=gwid, column="happendate", keys=["gwid", "hour", "happendate"])
+    q = PostSyncTasks(table_name="hourreport", target_table_name="hourreport", gwid=gwid, column="happendate", keys=["gwid", "hour", "happendate"], rebuild=query.rebuild)
     task_ret = await post_sync_tasks(q)
     # 对结果记录日志
     print(f"同步hourreport表: task_ret = {task_ret}")
     # 4. 调用post_sync_tasks，同步acctreport表
-    q = PostSyncTasks(table_name="acctreport", target_table_name="acctreport", gwid=gwid, column="happendate", keys=["gwid", "acct", "happendate"])
+    q = PostSyncTasks(table_name="acctreport", target_table_name="acctreport", gwid=gwid, column="happendate", keys=["gwid", "acct", "happendate"], rebuild=query.rebuild)
     task_ret = await post_sync_tasks(q)
     # 对结果记录日志
     print(f"同步acctreport表: task_ret = {task_ret}")
@@ -442,8 +498,9 @@ async def sync_traffics(query: SyncTrafficParam):
 @DB.post("/sync_gateway_online_status", tags=["tasks"])
 async def sync_gateway_online_status():
     # 1. get all gateway information from supabase's gateway table
-    response = supabase.table("gateway").select("*").execute()
+    response = await run_with_deadline(supabase.table("gateway").select("*").execute)
     # 2. for each entry in list
+    task_strs = []
     for gw in response.data:
         # 3. get the gateway's online status from gw
         gwid = gw.get("id")
@@ -455,9 +512,10 @@ async def sync_gateway_online_status():
             "result": "",
             "status": "todo"
         }
-        dump_str = json.dumps(cmd)
-        result = perform_task_celery.delay(dump_str)
-        print("任务已提交任务ID:", result.id)
+        task_strs.append(json.dumps(cmd))
+    # 4. 多个网关合并到一条消息中发送
+    for task_id in await run_with_deadline(submit_tasks, task_strs):
+        print("任务已提交任务ID:", task_id)
 
 
 class TestDelayAddQuery(BaseModel):
@@ -506,6 +564,10 @@ async def test_get_gw_ratio(q: TestGetGwRatioQuery):
     ratio = get_ratio_by_gwid_in_redis(gwid)
     return {"ratio": ratio}
 
+# sync_task_celery中每个命令携带的行数，以及每条消息携带的命令数量
+SYNC_COMMAND_ROWS = MAX_ROWS
+SYNC_COMMAND_BATCH = 4
+
 @DB.post("/sync_task_celery", tags=["tasks"])
 async def sync_task_celery(query: PostSyncTasks):
     column = query.column or "happendate"
@@ -514,15 +576,15 @@ async def sync_task_celery(query: PostSyncTasks):
     q = CreateSyncTaskQuery(table_name=table_name, gwid=gwid, column=column)
     task_ret = await create_sync_task(q)
     tasks = task_ret.get("tasks")
-    for task in tasks: 
-        # 生成sync命令
-        d = build_sync_command(gwid, task, table_name, ["gwid", column])
-        # 发送sync命令
-        print(f"task  ==== {task}, d === {d}")
-        dump_str = json.dumps(d)
-        print(f"dump_str === {dump_str}")
-        result = perform_task_celery.delay(dump_str)
-        print("任务已提交任务ID:", result.id)
+    task_strs = []
+    # 每SYNC_COMMAND_ROWS行合并成一个UPSERT_SUPABASE命令，table_data为列表，由bulk_upsert分块写入
+    for i in range(0, len(tasks), SYNC_COMMAND_ROWS):
+        d = build_sync_command(gwid, tasks[i:i + SYNC_COMMAND_ROWS], table_name, ["gwid", column])
+        task_strs.append(json.dumps(d))
+    print(f"[sync_task_celery]: rows = {len(tasks)}, commands = {len(task_strs)}")
+    # 发送sync命令，每条消息携带SYNC_COMMAND_BATCH个命令
+    for task_id in await run_with_deadline(submit_tasks, task_strs, SYNC_COMMAND_BATCH):
+        print("任务已提交任务ID:", task_id)
 
 @DB.post("/query", tags=["DB"])
 async def query_db(query: DBQuery):
@@ -544,17 +606,21 @@ async def query_db(query: DBQuery):
     sql = urllib.parse.quote(query.sql)
 
     # use mysql client to query db
-    sdk = SDK()
     try:
-        if sdk.login(address, username, password):
-            result = sdk.query_db(query.db, sql)
+        sdk = await session_manager.acquire(query.gwid, address, username, password)
+        if sdk is not None:
+            if query.format is not None:
+                # 流式返回，sql编码之后无法推断表名称，先从原始sql中取出
+                table = query.table or guess_table_name(query.sql)
+                return await stream_query_response(sdk, query.db, sql, query.format, table)
+            result = await sdk.query_db(query.db, sql)
             return {"result": result}
         else:
             raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
 
 
 
@@ -601,13 +667,13 @@ async def get_bandwidth(query: GetBandwidthQuery):
     print(f"start_time = {start_time_str}, end_time = {end_time_str}")
     # 2. 查询
     TABLE_NAME = "gateway_view"
-    response = (supabase
+    response = await run_with_deadline(supabase
     .table(TABLE_NAME)
     .select("*")
     .eq("id", gwid)
     # .gte("happendate", start_time_str)
     # .lte("happendate", end_time_str)
-    .execute())
+    .execute)
     # 3. 归集结果
     # 3.1 如果查询结果为0， 则返回空值
     if len(response.data) <= 0:
@@ -683,12 +749,12 @@ async def sync_account_list(query: GetAccountListQuery):
     username = gw.data[0].get('username')
     password = gw.data[0].get('password')
     address = gw.data[0].get('address')
-    sdk = SDK()
     try:
-        if sdk.login(address, username, password):
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
             # top = 1000
             # search = ""
-            result = sdk.list_account(1000, "")
+            result = await sdk.list_account(1000, "")
             r = get_basic_rpc_result(result)
             r = str_strip(r["result"])
             print(r)
@@ -698,10 +764,10 @@ async def sync_account_list(query: GetAccountListQuery):
             return { "total_terminal": f"{total_terminal_count}", "total_connection_count": f"{total_conn_count}"}
         else:
             raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
 
 class ListConfigQuery(BaseModel):
     gwid: str
@@ -709,12 +775,21 @@ class ListConfigQuery(BaseModel):
 @DB.post("/list_config", tags=["DB"])
 async def list_config(query: ListConfigQuery):
     gwid = query.gwid
-    with gw_login(gwid) as sdk_obj:
+    # 导出全部配置走网关的批量通道
+    with bulk_lane():
+        return await list_config_impl(gwid)
+
+async def list_config_impl(gwid: str):
+    async with async_gw_login(gwid) as sdk_obj:
         rval = {}
         config_list = ["network", "firewall", "wfilter-groups", "wfilter-times", "dhcp", "wfilter-appcontrol", "wfilter-webfilter", "wfilter-exception", "wfilter-imfilter", "wfilter-mailfilter", "wfilter-sslinspect", "wfilter-natdetector", "wfilter-webpush", "wfilter-bwcontrol", "wfilter-ipcontrol", "wfilter-mwan", "wfilter-account", "wfilter-adconf", "wfilter-webauth", "wfilter-pppoe", "wfilter-pptpd", "wfilter-ipsec", "openvpn", "wfilter-webvpn", "wfilter-sdwan", "antiddos", "wfilter-snort", "wfilter-aisecurity", "wfilter-isp"]
+        # 所有config的uci get合并为一次批量请求
+        batch = sdk_obj.batch()
         for config_key in config_list:
-            p = sdk_obj.config_load(config_key)
-            p = get_basic_rpc_result(p)
+            batch.config_load(config_key)
+        results = await batch.execute()
+        for config_key, r in zip(config_list, results):
+            p = get_basic_rpc_result(r["result"])
             if p is None:
                 continue
             else:
@@ -722,7 +797,29 @@ async def list_config(query: ListConfigQuery):
                 rval[config_key] = p
         return { "data": rval }
 
-def sync_firewall(sdk, firewall_json):
+async def sync_config_sections(sdk, cfgname, sections, skip_types=(), apply=True):
+    """
+    将sections中的每一个配置项通过config_add写入网关。
+    所有config_add合并为JSON-RPC批量请求发送，不再是每个配置项一次http请求。
+    apply为True时最后执行config_apply，返回每个配置项的结果
+    """
+    batch = sdk.batch()
+    names = []
+    for key, value in sections.items():
+        type = value.get(".type")
+        if type in skip_types:
+            continue
+        batch.config_add(cfgname, type, key, value)
+        names.append(key)
+    results = await batch.execute() if len(batch) > 0 else []
+    for name, r in zip(names, results):
+        if r["error"] is not None:
+            print(f"[sync_config_sections]: config_add failed, cfgname = {cfgname}, name = {name}, error = {r['error']}")
+    if apply:
+        await sdk.config_apply()
+    return results
+
+async def sync_firewall(sdk, firewall_json, apply=True):
     """
     对firewall的json进行同步。下面是可能的配置样式:
     cfg03dc81": {
@@ -745,252 +842,121 @@ def sync_firewall(sdk, firewall_json):
     },
     """
     cfgname = "firewall"
-    # 对于firewall这个json对象中的每一个kv进行遍历
-    for key, value in firewall_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, firewall_json, apply=apply)
     
-def sync_groups(sdk, groups_json):
+async def sync_groups(sdk, groups_json, apply=True):
     cfgname = "wfilter-groups"
-    # 对于firewall这个json对象中的每一个kv进行遍历
-    for key, value in groups_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, groups_json, apply=apply)
 
-def sync_times(sdk, times_json):
+async def sync_times(sdk, times_json, apply=True):
     cfgname = "wfilter-times"
-    # 对于firewall这个json对象中的每一个kv进行遍历
-    for key, value in times_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, times_json, apply=apply)
 
-def sync_app_control(sdk, appcontrol_json):
+async def sync_app_control(sdk, appcontrol_json, apply=True):
     cfgname = "wfilter-appcontrol"
-    # 对于firewall这个json对象中的每一个kv进行遍历
-    for key, value in appcontrol_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, appcontrol_json, apply=apply)
 
-def sync_web_filter(sdk, webfilter_json):
+async def sync_web_filter(sdk, webfilter_json, apply=True):
     cfgname = "wfilter-webfilter"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in webfilter_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, webfilter_json, apply=apply)
 
 # 同步wfilter_exception
-def sync_wfilter_exception(sdk, exception_json):
+async def sync_wfilter_exception(sdk, exception_json, apply=True):
     cfgname = "wfilter-exception"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in exception_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, exception_json, apply=apply)
 
 # 同步wfilter-imfilter
-def sync_wfilter_imfilter(sdk, imfilter_json):
+async def sync_wfilter_imfilter(sdk, imfilter_json, apply=True):
     cfgname = "wfilter-imfilter"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in imfilter_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, imfilter_json, apply=apply)
 
-def sync_mail_filter(sdk, mail_json):
+async def sync_mail_filter(sdk, mail_json, apply=True):
     cfgname = "wfilter-mailfilter"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in mail_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, mail_json, apply=apply)
 
 # 同步sslinspect
-def sync_sslinspect(sdk, sslinspect_json):
+async def sync_sslinspect(sdk, sslinspect_json, apply=True):
     cfgname = "wfilter-sslinspect"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in sslinspect_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, sslinspect_json, apply=apply)
 
 # 同步natdetector
-def sync_natdetector(sdk, natdetector_json):
+async def sync_natdetector(sdk, natdetector_json, apply=True):
     cfgname = "wfilter-natdetector"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in natdetector_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, natdetector_json, apply=apply)
 
 # 同步webpush
-def sync_webpush(sdk, webpush_json):
+async def sync_webpush(sdk, webpush_json, apply=True):
     cfgname = "wfilter-webpush"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in webpush_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, webpush_json, apply=apply)
 # 同步bwcontrol
-def sync_bwcontrol(sdk, bwcontrol_json):
+async def sync_bwcontrol(sdk, bwcontrol_json, apply=True):
     cfgname = "wfilter-bwcontrol"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in bwcontrol_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, bwcontrol_json, apply=apply)
 
 #同步ipcontrol
-def sync_ipcontrol(sdk, ipcontrol_json):
+async def sync_ipcontrol(sdk, ipcontrol_json, apply=True):
     cfgname = "wfilter-ipcontrol"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in ipcontrol_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, ipcontrol_json, apply=apply)
 
 # 同步mwan
-def sync_mwan(sdk, mwan_json):
+async def sync_mwan(sdk, mwan_json, apply=True):
     cfgname = "wfilter-mwan"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in mwan_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        if type == "system":
-            continue
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, mwan_json, skip_types=("system",), apply=apply)
 
 # 同步adconf
-def sync_adconf(sdk, adconf_json):
+async def sync_adconf(sdk, adconf_json, apply=True):
     cfgname = "wfilter-adconf"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in adconf_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, adconf_json, apply=apply)
 
 # 同步webauth
-def sync_webauth(sdk, webauth_json):
+async def sync_webauth(sdk, webauth_json, apply=True):
     cfgname = "wfilter-webauth"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in webauth_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, webauth_json, apply=apply)
 
 # 同步pppoe
-def sync_pppoe(sdk, pppoe_json):
+async def sync_pppoe(sdk, pppoe_json, apply=True):
     cfgname = "wfilter-pppoe"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in pppoe_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, pppoe_json, apply=apply)
 
 # 同步pptpd
-def sync_pptpd(sdk, pptpd_json):
+async def sync_pptpd(sdk, pptpd_json, apply=True):
     cfgname = "wfilter-pptpd"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in pptpd_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, pptpd_json, apply=apply)
 
 # 同步ipsec
-def sync_ipsec(sdk, ipsec_json):
+async def sync_ipsec(sdk, ipsec_json, apply=True):
     cfgname = "wfilter-ipsec"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in ipsec_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, ipsec_json, apply=apply)
 # 同步openvpn
-def sync_openvpn(sdk, openvpn_json):
+async def sync_openvpn(sdk, openvpn_json, apply=True):
     cfgname = "openvpn"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in openvpn_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, openvpn_json, apply=apply)
 
 # 同步webvpn
-def sync_webvpn(sdk, webvpn_json):
+async def sync_webvpn(sdk, webvpn_json, apply=True):
     cfgname = "wfilter-webvpn"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in webvpn_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        if type == "system":
-            continue
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, webvpn_json, skip_types=("system",), apply=apply)
 
 # 同步sdwan
-def sync_sdwan(sdk, sdwan_json):
+async def sync_sdwan(sdk, sdwan_json, apply=True):
     cfgname = "wfilter-sdwan"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in sdwan_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, sdwan_json, apply=apply)
 
 # 同步antiddos
-def sync_antiddos(sdk, antiddos_json):
+async def sync_antiddos(sdk, antiddos_json, apply=True):
     cfgname = "antiddos"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in antiddos_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, antiddos_json, apply=apply)
 
 # 同步snort
-def sync_snort(sdk, snort_json):
+async def sync_snort(sdk, snort_json, apply=True):
     cfgname = "wfilter-snort"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in snort_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, snort_json, apply=apply)
 # 同步aisecurity
-def sync_aisecurity(sdk, aisecurity_json):
+async def sync_aisecurity(sdk, aisecurity_json, apply=True):
     cfgname = "wfilter-aisecurity"
-    # 对于wfilter-webfilter这个json对象中的每一个kv进行遍历
-    for key, value in aisecurity_json.items():
-        type = value.get(".type")
-        # 通过sdk同步config
-        if type == "system":
-            continue
-        sdk.config_add(cfgname, type, key, value)
-    sdk.config_apply()
+    return await sync_config_sections(sdk, cfgname, aisecurity_json, skip_types=("system",), apply=apply)
 
-def sync_users(sdk, users_json):
+async def sync_users(sdk, users_json, apply=True):
     """
     对users的json进行同步。下面是可能的配置样式:
     "wfuser1737514663429": {
@@ -1016,80 +982,84 @@ def sync_users(sdk, users_json):
     }
     """
     cfgname = "wfilter-account"
-    # 对于users_json这个json对象中的每一个kv进行遍历
+    # 只同步类型为wfuser的项，用户名为admin的不同步
+    users = {}
     for k, v in users_json.items():
-        type = v.get(".type")
-        # 只同步类型为wfuser的项:
-        if type != "wfuser":
+        if v.get(".type") != "wfuser":
             continue
-        # 单独处理admin，如果用户名为admin,则不同步
         if v.get("username") == "admin":
-            continue 
-        # 通过sdk同步config
-        sdk.config_add(cfgname, type, k, v)
-    sdk.config_apply()
+            continue
+        users[k] = v
+    return await sync_config_sections(sdk, cfgname, users, apply=apply)
         
 
 @DB.post("/upload_config", tags=["DB"])
 async def upload_config(gwid: str, file: UploadFile = File(...)):
     # 读取上传的文件内容（异步方式）
     content = await file.read()
+    # 上传配置走网关的批量通道
+    with bulk_lane():
+        return await upload_config_impl(gwid, content)
+
+async def upload_config_impl(gwid: str, content):
     # 解析JSON内容  
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         json_data = json.loads(content)
         # 兼容处理data
         if "data" in json_data:
            json_data = json_data["data"]
         # 同步防火墙策略
-        sync_firewall(sdk_obj, firewall_json=json_data["firewall"])
+        await sync_firewall(sdk_obj, firewall_json=json_data["firewall"], apply=False)
         # 同步用户
-        sync_users(sdk_obj, users_json=json_data["wfilter-account"])
+        await sync_users(sdk_obj, users_json=json_data["wfilter-account"], apply=False)
         # 同步组
-        sync_groups(sdk_obj, groups_json=json_data["wfilter-groups"])
+        await sync_groups(sdk_obj, groups_json=json_data["wfilter-groups"], apply=False)
         # 同步时间
-        sync_times(sdk_obj, times_json=json_data["wfilter-times"])
+        await sync_times(sdk_obj, times_json=json_data["wfilter-times"], apply=False)
         # 同步app_control
-        sync_app_control(sdk_obj, appcontrol_json=json_data["wfilter-appcontrol"])
+        await sync_app_control(sdk_obj, appcontrol_json=json_data["wfilter-appcontrol"], apply=False)
         # 同步wfilter_webfilter
-        sync_web_filter(sdk_obj, webfilter_json=json_data["wfilter-webfilter"])
+        await sync_web_filter(sdk_obj, webfilter_json=json_data["wfilter-webfilter"], apply=False)
         # 同步wfilter_exception
-        sync_wfilter_exception(sdk_obj, exception_json=json_data["wfilter-exception"])
+        await sync_wfilter_exception(sdk_obj, exception_json=json_data["wfilter-exception"], apply=False)
         # 同步wfilter-imfilter
-        sync_wfilter_imfilter(sdk_obj, imfilter_json=json_data["wfilter-imfilter"])
+        await sync_wfilter_imfilter(sdk_obj, imfilter_json=json_data["wfilter-imfilter"], apply=False)
         # 同步wfilter-mailfilter
-        sync_mail_filter(sdk_obj, mail_json=json_data["wfilter-mailfilter"])
+        await sync_mail_filter(sdk_obj, mail_json=json_data["wfilter-mailfilter"], apply=False)
         # 同步wfilter-sslinspect
-        sync_sslinspect(sdk_obj, sslinspect_json=json_data["wfilter-sslinspect"])
+        await sync_sslinspect(sdk_obj, sslinspect_json=json_data["wfilter-sslinspect"], apply=False)
         # 同步natdetector
-        sync_natdetector(sdk_obj, natdetector_json=json_data["wfilter-natdetector"])
+        await sync_natdetector(sdk_obj, natdetector_json=json_data["wfilter-natdetector"], apply=False)
         # 同步webpush
-        sync_webpush(sdk_obj, webpush_json=json_data["wfilter-webpush"])
+        await sync_webpush(sdk_obj, webpush_json=json_data["wfilter-webpush"], apply=False)
         # 同步bwcontrol
-        sync_bwcontrol(sdk_obj, bwcontrol_json=json_data["wfilter-bwcontrol"])
+        await sync_bwcontrol(sdk_obj, bwcontrol_json=json_data["wfilter-bwcontrol"], apply=False)
         # 同步ipcontrol
-        sync_ipcontrol(sdk_obj, ipcontrol_json=json_data["wfilter-ipcontrol"])
+        await sync_ipcontrol(sdk_obj, ipcontrol_json=json_data["wfilter-ipcontrol"], apply=False)
         # 同步adconf
-        sync_adconf(sdk_obj, adconf_json=json_data["wfilter-adconf"])
+        await sync_adconf(sdk_obj, adconf_json=json_data["wfilter-adconf"], apply=False)
         # 同步webauth
-        sync_webauth(sdk_obj, webauth_json=json_data["wfilter-webauth"])
+        await sync_webauth(sdk_obj, webauth_json=json_data["wfilter-webauth"], apply=False)
         # 同步pppoe
-        sync_pppoe(sdk_obj, pppoe_json=json_data["wfilter-pppoe"])
+        await sync_pppoe(sdk_obj, pppoe_json=json_data["wfilter-pppoe"], apply=False)
         # 同步pptpd
-        sync_pptpd(sdk_obj, pptpd_json=json_data["wfilter-pptpd"])
+        await sync_pptpd(sdk_obj, pptpd_json=json_data["wfilter-pptpd"], apply=False)
         # 同步ipsec
-        sync_ipsec(sdk_obj, ipsec_json=json_data["wfilter-ipsec"])
+        await sync_ipsec(sdk_obj, ipsec_json=json_data["wfilter-ipsec"], apply=False)
         # 同步openvpn
-        sync_openvpn(sdk_obj, openvpn_json=json_data["openvpn"])
+        await sync_openvpn(sdk_obj, openvpn_json=json_data["openvpn"], apply=False)
         # 同步webvpn
-        sync_webvpn(sdk_obj, webvpn_json=json_data["wfilter-webvpn"])
+        await sync_webvpn(sdk_obj, webvpn_json=json_data["wfilter-webvpn"], apply=False)
         # 同步sdwan
-        sync_sdwan(sdk_obj, sdwan_json=json_data["wfilter-sdwan"])
+        await sync_sdwan(sdk_obj, sdwan_json=json_data["wfilter-sdwan"], apply=False)
         # 同步antiddos
-        sync_antiddos(sdk_obj, antiddos_json=json_data["antiddos"])
+        await sync_antiddos(sdk_obj, antiddos_json=json_data["antiddos"], apply=False)
         # 同步snort
-        sync_snort(sdk_obj, snort_json=json_data["wfilter-snort"])
+        await sync_snort(sdk_obj, snort_json=json_data["wfilter-snort"], apply=False)
         # 同步aisecurity
-        sync_aisecurity(sdk_obj, aisecurity_json=json_data["wfilter-aisecurity"])
+        await sync_aisecurity(sdk_obj, aisecurity_json=json_data["wfilter-aisecurity"], apply=False)
+        # 所有配置写入后只apply一次
+        await sdk_obj.config_apply()
         return { "result": "success" }
 
 class GetUserBandwidthQuery(BaseModel):
@@ -1138,20 +1108,20 @@ async def get_user_bandwidth(query: GetUserBandwidthQuery):
     ratio = get_ratio_by_gwid(gwid)
     unit = "GB"
     if is_empty(gwid):
-        response = (supabase
+        response = await run_with_deadline(supabase
         .table('acctreport')
         .select("*")
         .gte("happendate", start_time_str)
         .lte("happendate", end_time_str)
-        .execute())
+        .execute)
     else:
-        response = (supabase
+        response = await run_with_deadline(supabase
         .table('acctreport')
         .select("*")
         .eq("gwid", gwid)
         .gte("happendate", start_time_str)
         .lte("happendate", end_time_str)
-        .execute())
+        .execute)
     # 4.归集本月结果 
     if len(response.data) <= 0:
         #
@@ -1184,13 +1154,13 @@ async def get_user_bandwidth_detail(query: GetUserBandwidthDetailQuery):
     end_time_str = get_end_of_month(d, True)
     unit = "GB"
     ratio = get_ratio_by_gwid(gwid)
-    response = (supabase
+    response = await run_with_deadline(supabase
         .table('acctreport')
         .select("*")
         .eq("gwid", gwid)
         .gte("happendate", start_time_str)
         .lte("happendate", end_time_str)
-        .execute())
+        .execute)
     # 4. 归集结果
     if len(response.data) <= 0:
         return {"data": []}
@@ -1211,6 +1181,8 @@ async def get_user_bandwidth_detail(query: GetUserBandwidthDetailQuery):
 
 class GetAccountListQuery(BaseModel):
     gwid: str
+    # 为True时直接返回supabase中已有的数据，同时在后台从网关刷新用户列表
+    stale: bool = False
 
 
 def get_gw_online_status_by_id(gwid, id):
@@ -1258,8 +1230,8 @@ async def get_device_list(query: GetAccountListQuery):
     #     device["gwid"] = gwid
     #     lst.append(device)
     list = []
-    with gw_login(gwid) as sdk_obj:
-        r = sdk_obj.list_online_users(1000, "")
+    async with async_gw_login(gwid) as sdk_obj:
+        r = await sdk_obj.list_online_users(1000, "")
         r = get_basic_rpc_result(r)
         r = str_strip(r["result"])
         print(r)
@@ -1278,7 +1250,8 @@ async def get_device_list(query: GetAccountListQuery):
             device["total"] = normalize_traffic(up + down, unit, ratio)
             device["gwid"] = gwid
             list.append(device)
-        luigi.build([UpsertDeviceToSupabase(json.dumps(list))], local_scheduler=True)
+    # 在后台写入device_list表，不阻塞接口返回
+    sync_queue.submit(gwid, JOB_DEVICES, list)
     return { "data": list }
 
 def get_total_traffic(item, unit, ratio):
@@ -1303,21 +1276,28 @@ async def get_account_list(query: GetAccountListQuery):
     """
     POST /get_account_list获取用户列表
     参数1： gwid=当前网关id，非必须。当gwid为空字符串时候，显示所有用户。
+    参数2： stale=是否直接返回已有数据并在后台刷新，非必须，默认为False。
     """
     # 1. 获取gwid
     gwid = query.gwid
+    job = None
     if is_not_empty(gwid):
         print(f"[DEBUG][get_account_list]: gwid = {gwid}")
-        lst = get_gw_users_list(gwid)
-        print("====start build luigi, list = " + json.dumps(lst))
-        luigi.build([UpsertUsersToSupabase(json.dumps(lst))], local_scheduler=True)
+        if query.stale:
+            # 后台从网关读取并写入gw_users，本次返回已有的数据
+            job = sync_queue.submit(gwid, JOB_USERS)
+        else:
+            lst = await fetch_gw_users_list(gwid)
+            job = sync_queue.submit(gwid, JOB_USERS, lst)
+            # 等待写入完成，超时则返回已有的数据，写入继续在后台进行
+            await sync_queue.wait(job)
     # 2. 查user_traffic_view
     r = None
     TABLE_NAME = "user_traffic_monthly_view"
     if is_empty(gwid):
-        r = supabase.table(TABLE_NAME).select("*").order("userid", desc=True).execute()
+        r = await run_with_deadline(supabase.table(TABLE_NAME).select("*").order("userid", desc=True).execute)
     else:
-        r = supabase.table(TABLE_NAME).select("*").eq("gwid", gwid).order("userid", desc=True).execute()
+        r = await run_with_deadline(supabase.table(TABLE_NAME).select("*").eq("gwid", gwid).order("userid", desc=True).execute)
     print(f"[DEBUG][get_account_list]: user_traffic_view = {r}")
     data = []
     for item in r.data:
@@ -1345,29 +1325,47 @@ async def get_account_list(query: GetAccountListQuery):
             "group_alias": item.get("group_alias") #组名称
         })
     # 2.2 将r.data返回
+    if job is not None:
+        return { "data": data, "sync_job": job.to_dict() }
     return { "data": data }
 
+class GetSyncJobsQuery(BaseModel):
+    gwid: str | None = None
+    job_id: str | None = None
+
+@DB.post("/get_sync_jobs", tags=["DB"])
+async def get_sync_jobs(query: GetSyncJobsQuery):
+    """
+    查询后台同步任务（用户列表、设备列表）的状态，job_id为空时按gwid过滤，两者都为空时返回全部
+    """
+    if query.job_id is not None:
+        job = sync_queue.get(query.job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"同步任务不存在: {query.job_id}")
+        return { "data": [job] }
+    return { "data": sync_queue.list(query.gwid) }
+
 @DB.post("/get_stats", tags=["DB"])
 async def get_stats():
     # 1. 查询supabase的gateway_count表，获取count值
-    r = supabase.table("gateway_count").select("count").execute()
+    r = await run_with_deadline(supabase.table("gateway_count").select("count").execute)
     gateway_count = 0
     if len(r.data) > 0:
         #获取count
         gateway_count = r.data[0]["count"]
     # 2. 查询supabase中的client_count，获取客户数量count值
-    r = supabase.table("client_count").select("count").execute()
+    r = await run_with_deadline(supabase.table("client_count").select("count").execute)
     client_count = 0
     for line in r.data:
         client_count += 1
     # 3. 查询supabase中的fleet_count，获取舰船数量count值
-    r = supabase.table("fleet_count").select("count").execute()
+    r = await run_with_deadline(supabase.table("fleet_count").select("count").execute)
     fleet_count = 0
     for line in r.data:
         fleet_count += line.get("count")
     
     # 4. 总流量:查询supabase中的total_traffic，获取up和down字段
-    r = supabase.table("total_traffic").select("up, down").execute()
+    r = await run_with_deadline(supabase.table("total_traffic").select("up, down").execute)
     up = 0
     down = 0
     if len(r.data) > 0:
@@ -1377,7 +1375,7 @@ async def get_stats():
 
     # 5. 总用户数: 查询supabase中的gw_users_count，获取count字段
     users_count = 0
-    r = supabase.table("gw_users_count").select("count").execute()
+    r = await run_with_deadline(supabase.table("gw_users_count").select("count").execute)
     if len(r.data) > 0:
         #获取count
         users_count = r.data[0]["count"]
@@ -1459,11 +1457,11 @@ async def kill_user(param: UserSessionParam):
     # 打印参数
     gwid = param.gwid
     print("kill_user param = {}".format(param))
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         # 根据op决定type
         # 如果op是up，则type为REMOVE；如果op是down，则type为ALL
         type = "REMOVE" if param.op == "up" else "ALL"
-        result = sdk_obj.kill_connection(param.user, 0, type, "", "")
+        result = await sdk_obj.kill_connection(param.user, 0, type, "", "")
         print(result)
         return result
 
@@ -1495,7 +1493,7 @@ async def update_online_status(param: UserSessionParam):
     await kill_user(param)
     # 5. 更新supabase中的user表中的online字段
     online = "true" if op == "up" else "false"
-    response = supabase.table('gw_users').update({"online": online}).eq("gwid", gwid).eq("username", user).execute()
+    response = await run_with_deadline(supabase.table('gw_users').update({"online": online}).eq("gwid", gwid).eq("username", user).execute)
     return response
     
 class TestPingQuery(BaseModel):
@@ -1525,7 +1523,7 @@ async def test_all_gw_device_count():
     """
     kv = {}
     # 1. 从gateways获取所有的gwid，形成一个数组gws
-    response = supabase.table("gateway").select("*").execute()
+    response = await run_with_deadline(supabase.table("gateway").select("*").execute)
     gws = []
     for r in response.data:
         gwid = r.get("id")
@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fastapi import HTTPException
+
+# 请求的默认处理时间（秒）
+DEFAULT_BUDGET = 1000
+# 按路由设置处理时间，没有列出的路由使用DEFAULT_BUDGET
+ROUTE_BUDGETS = {
+    "/upload_config": 100000,
+    "/sync_traffics": 100000,
+    "/ingest_log_table": 100000,
+}
+
+# 不在请求中时（例如celery任务、定时同步），每次阻塞调用最多等待的秒数
+CALL_TIMEOUT = 120
+# 执行阻塞调用的线程数量上限
+CALL_WORKERS = 32
+
+# 当前请求的截止时间（time.monotonic），不在请求中时为None
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+class DeadlineExceeded(HTTPException):
+    """
+    请求的处理时间用完时抛出，返回504
+    """
+    def __init__(self):
+        super().__init__(status_code=504, detail="Request processing time excedeed limit")
+
+def budget_for_path(path):
+    return ROUTE_BUDGETS.get(path, DEFAULT_BUDGET)
+
+@contextmanager
+def request_deadline(seconds):
+    """
+    在这个上下文中设置请求的截止时间，嵌套时取更早的一个
+    """
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+def remaining():
+    """
+    返回当前请求剩余的秒数，不在请求中时返回None
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_deadline():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+def timeout_for(default):
+    """
+    下游调用的超时：default和请求剩余时间中较小的一个；时间已经用完时抛出DeadlineExceeded
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    if default is None:
+        return left
+    return min(default, left)
+
+# run_with_deadline专用的线程池。超时只是不再等待，已经开始的调用无法中断，会继续占用线程直到返回；
+# 线程数量固定，慢调用堆积时新的调用排队（排队的时间也计入超时），超时前还没有开始的调用被取消，不会再执行
+_executor = ThreadPoolExecutor(max_workers=CALL_WORKERS, thread_name_prefix="deadline")
+
+async def run_with_deadline(fn, *args, **kwargs):
+    """
+    在线程中执行同步调用（例如supabase），最多等待请求剩余的时间，不在请求中时最多等待CALL_TIMEOUT秒
+    """
+    timeout = timeout_for(None)
+    if timeout is None:
+        timeout = CALL_TIMEOUT
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(_executor, call), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import time
+import zlib
+from datetime import datetime
+from .supabase import supabase
+from .utils import getkv, setkv
+from .deadline import run_with_deadline
+from .gw_breaker import gateway_breakers
+from .sync_pipeline import sync_table_locked
+from .sync_lease import SyncJobRunning, sync_lease
+
+# 定时同步的表，每张表有自己的周期（秒）
+SYNC_TABLES = {
+    "hourreport": {
+        "target_table_name": "hourreport",
+        "column": "happendate",
+        "keys": ["gwid", "hour", "happendate"],
+        "interval": 3600,
+    },
+    "acctreport": {
+        "target_table_name": "acctreport",
+        "column": "happendate",
+        "keys": ["gwid", "acct", "happendate"],
+        "interval": 3600,
+    },
+}
+# 整个舰队同时同步的网关数量上限
+FLEET_CONCURRENCY = 8
+# 每个网关在周期开始后最多推迟多少秒开始，避免所有网关同时开始
+JITTER = 300
+
+# gw_kv表中保存同步状态的type，id为gwid，key为表名称
+STATUS_TYPE = "sync_status"
+
+STATE_RUNNING = "running"
+STATE_SUCCESS = "success"
+STATE_FAILED = "failed"
+STATE_SKIPPED = "skipped"
+
+class SyncStatusStore:
+    """
+    每个(gwid, table)最近一次定时同步的状态:
+    {"state", "started_at", "finished_at", "last_success", "error", "report"}
+    """
+    def get(self, gwid, table_name):
+        value = getkv(STATUS_TYPE, gwid, table_name)
+        if value is None or value == "":
+            return {}
+        try:
+            return json.loads(value)
+        except Exception:
+            return {}
+
+    def update(self, gwid, table_name, **fields):
+        status = self.get(gwid, table_name)
+        status.update(fields)
+        setkv(STATUS_TYPE, gwid, table_name, json.dumps(status, ensure_ascii=False, default=str))
+        return status
+
+    def list(self, gwid=None):
+        query = supabase.table("gw_kv").select("*").eq("type", STATUS_TYPE)
+        if gwid is not None:
+            query = query.eq("id", gwid)
+        response = query.execute()
+        result = []
+        for row in response.data:
+            try:
+                status = json.loads(row.get("value") or "{}")
+            except Exception:
+                status = {}
+            result.append({"gwid": row.get("id"), "table_name": row.get("key"), **status})
+        return result
+
+sync_status = SyncStatusStore()
+
+def jitter_for(gwid, table_name, interval):
+    """
+    每个网关固定的推迟时间，按gwid散开，同一个网关每个周期的开始时间相同
+    """
+    window = min(JITTER, interval // 4)
+    if window <= 0:
+        return 0
+    return zlib.crc32(f"{gwid}:{table_name}".encode("utf-8")) % window
+
+def is_offline(gw):
+    # 在线探测写入gateway表的online字段，值为"true"/"false"
+    return str(gw.get("online")).lower() == "false"
+
+def is_running(status, interval):
+    """
+    上一次同步还没有结束（并且没有超过一个周期），不重复开始
+    """
+    if status.get("state") != STATE_RUNNING:
+        return False
+    return time.time() - (status.get("started_ts") or 0) < interval
+
+async def sync_gateway_table(gwid, table_name, rebuild=False):
+    """
+    同步一个网关的一张表，并记录状态：取得租约之后才记录running
+    """
+    cfg = SYNC_TABLES[table_name]
+    try:
+        async with sync_lease(gwid, table_name) as lease:
+            await run_with_deadline(sync_status.update, gwid, table_name, state=STATE_RUNNING,
+                                    started_at=datetime.now().isoformat(), started_ts=time.time(), error=None)
+            report = await sync_table_locked(gwid, table_name, cfg["target_table_name"], cfg["column"], cfg["keys"], rebuild, lease=lease)
+    except SyncJobRunning:
+        # 其他进程（例如手动的/sync_traffics）正在同步这个网关，状态由它记录，这一轮跳过
+        return None
+    except Exception as e:
+        print(f"[FleetSync]: sync failed, gwid = {gwid}, table = {table_name}, error = {e}")
+        await run_with_deadline(sync_status.update, gwid, table_name, state=STATE_FAILED,
+                                finished_at=datetime.now().isoformat(), error=str(getattr(e, "detail", e)))
+        return False
+    now = datetime.now().isoformat()
+    await run_with_deadline(sync_status.update, gwid, table_name, state=STATE_SUCCESS,
+                            finished_at=now, last_success=now, report=report)
+    return True
+
+async def run_fleet_sync(table_name, concurrency=FLEET_CONCURRENCY):
+    """
+    同步gateway表中所有网关的一张表:
+    - 在线探测标记为离线、或者熔断中的网关跳过
+    - 每个网关按jitter_for推迟开始，同时进行的数量不超过concurrency
+    """
+    if table_name not in SYNC_TABLES:
+        raise ValueError(f"不支持定时同步的表: {table_name}")
+    interval = SYNC_TABLES[table_name]["interval"]
+    response = await run_with_deadline(supabase.table("gateway").select("id, online").execute)
+    semaphore = asyncio.Semaphore(concurrency)
+    summary = {"table_name": table_name, "total": len(response.data), "success": 0, "failed": 0, "skipped": 0}
+
+    async def one(gw):
+        gwid = gw.get("id")
+        status = await run_with_deadline(sync_status.get, gwid, table_name)
+        if is_running(status, interval):
+            # 正在进行的同步自己记录状态，不覆盖
+            summary["skipped"] += 1
+            return
+        if is_offline(gw) or gateway_breakers.is_open(gwid):
+            await run_with_deadline(sync_status.update, gwid, table_name, state=STATE_SKIPPED,
+                                    skipped_at=datetime.now().isoformat(), error="gateway offline")
+            summary["skipped"] += 1
+            return
+        await asyncio.sleep(jitter_for(gwid, table_name, interval))
+        async with semaphore:
+            ok = await sync_gateway_table(gwid, table_name)
+        if ok is None:
+            summary["skipped"] += 1
+        else:
+            summary["success" if ok else "failed"] += 1
+
+    results = await asyncio.gather(*[one(gw) for gw in response.data], return_exceptions=True)
+    for gw, r in zip(response.data, results):
+        if isinstance(r, Exception):
+            print(f"[FleetSync]: gwid = {gw.get('id')}, error = {r}")
+            summary["failed"] += 1
+    print(f"[FleetSync]: {summary}")
+    return summary
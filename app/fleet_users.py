@@ -0,0 +1,234 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from .supabase import supabase
+from .utils import async_gw_login, get_basic_rpc_result, parse_gw_users, prepare_user, gw_group_row, gw_strategy_row, getkv, setkv
+from .deadline import run_with_deadline
+from .gw_breaker import gateway_breakers
+from .bulk_writer import bulk_upsert
+from .fleet_sync import FLEET_CONCURRENCY, STATUS_TYPE, is_offline
+from .routers.group import parse_gw_groups, parse_virtual_group_users
+from .routers.traffic import parse_bandwidth_strategies
+
+# gw_kv表中保存全舰队用户同步进度的id和key
+FLEET_ID = "fleet"
+FLEET_KEY = "users"
+# 定时同步的周期（秒）
+FLEET_USER_INTERVAL = 3600
+
+class GatewaySnapshot:
+    """
+    一个网关上读取到的账号、组、带宽策略和虚拟组成员
+    """
+    def __init__(self, gwid):
+        self.gwid = gwid
+        self.users = []
+        self.groups = []
+        self.strategies = []
+        self.members = []
+        # 读取失败的部分，例如某个组的list_virtual_group
+        self.errors = []
+
+    @property
+    def members_complete(self):
+        return not any(e["step"] == "wfilter-groups" or e["step"].startswith("list_virtual_group") for e in self.errors)
+
+    def user_rows(self):
+        """
+        账号按global_id写入gw_users，虚拟组成员读取完整时同时带上virtual_group：
+        不在任何虚拟组中的用户写入空字符串，相当于先清空再更新
+        """
+        virtual_group = {m["userid"]: m["group_global_id"] for m in self.members}
+        rows = []
+        for user in self.users:
+            row = prepare_user(dict(user))
+            if self.members_complete:
+                row["virtual_group"] = virtual_group.get(row.get("username"), "")
+            rows.append(row)
+        return rows
+
+def config_values(result, name, snapshot):
+    if result["error"] is not None:
+        snapshot.errors.append({"step": name, "error": str(result["error"])})
+        return None
+    p = get_basic_rpc_result(result["result"])
+    if p is None:
+        return None
+    return p.get("values")
+
+async def read_gateway(gwid):
+    """
+    登录一次网关，两次批量请求读取全部数据：
+    1. 账号（wfilter-account）、组（wfilter-groups）、带宽策略（wfilter-isp）
+    2. 每个组的虚拟组成员（list_virtual_group）
+    """
+    snapshot = GatewaySnapshot(gwid)
+    async with async_gw_login(gwid) as sdk_obj:
+        batch = sdk_obj.batch()
+        batch.list_account()
+        batch.config_load("wfilter-groups")
+        batch.config_load("wfilter-isp")
+        accounts, groups, strategies = await batch.execute()
+        values = config_values(accounts, "wfilter-account", snapshot)
+        if values is None:
+            # 没有读取到账号时不写入，避免把网关上的用户都清空
+            raise Exception(f"读取账号失败: {snapshot.errors}")
+        snapshot.users = parse_gw_users(gwid, values)
+        values = config_values(groups, "wfilter-groups", snapshot)
+        if values is not None:
+            snapshot.groups = parse_gw_groups(gwid, values)
+        values = config_values(strategies, "wfilter-isp", snapshot)
+        if values is not None:
+            snapshot.strategies = parse_bandwidth_strategies(gwid, values)
+        if len(snapshot.groups) > 0:
+            batch = sdk_obj.batch()
+            for group in snapshot.groups:
+                batch.list_virtual_group(group.get("id"))
+            results = await batch.execute()
+            for group, result in zip(snapshot.groups, results):
+                if result["error"] is not None:
+                    snapshot.errors.append({"step": f"list_virtual_group {group.get('id')}", "error": str(result["error"])})
+                    continue
+                snapshot.members.extend(parse_virtual_group_users(gwid, group, result["result"]))
+    return snapshot
+
+class FleetUserSync:
+    """
+    全舰队的用户和组同步：
+    - read: 所有在线网关并行读取（最多concurrency个同时进行），每个网关一个session
+    - write: 所有网关的结果合并后分块批量写入gw_users、gw_groups和gw_bandwidth_strategy
+    progress记录当前阶段和每个网关的结果，可以在运行中查询
+    """
+    def __init__(self, gwids=None, concurrency=FLEET_CONCURRENCY):
+        self.gwids = gwids
+        self.concurrency = concurrency
+        self.progress = {
+            "state": "pending",
+            "phase": None,
+            "started_at": None,
+            "finished_at": None,
+            "total": 0,
+            "read": 0,
+            "failed": 0,
+            "skipped": 0,
+            "failures": [],
+            "writes": {},
+        }
+
+    async def select_gateways(self):
+        if self.gwids:
+            return list(self.gwids)
+        response = await run_with_deadline(supabase.table("gateway").select("id, online").execute)
+        gwids = []
+        for gw in response.data:
+            gwid = gw.get("id")
+            if is_offline(gw) or gateway_breakers.is_open(gwid):
+                self.progress["skipped"] += 1
+                continue
+            gwids.append(gwid)
+        return gwids
+
+    async def read_all(self, gwids):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        snapshots = []
+
+        async def one(gwid):
+            async with semaphore:
+                try:
+                    snapshot = await read_gateway(gwid)
+                except Exception as e:
+                    print(f"[FleetUserSync]: read failed, gwid = {gwid}, error = {e}")
+                    self.progress["failed"] += 1
+                    self.progress["failures"].append({"gwid": gwid, "error": str(getattr(e, "detail", e))})
+                    return
+            if len(snapshot.errors) > 0:
+                self.progress["failures"].append({"gwid": gwid, "partial": True, "error": snapshot.errors})
+            snapshots.append(snapshot)
+            self.progress["read"] += 1
+
+        await asyncio.gather(*[one(gwid) for gwid in gwids])
+        return snapshots
+
+    async def write_all(self, snapshots):
+        # 批量写入的每一行需要有相同的列，是否带virtual_group分成两批
+        users = [row for s in snapshots if s.members_complete for row in s.user_rows()]
+        users_without_group = [row for s in snapshots if not s.members_complete for row in s.user_rows()]
+        groups = [gw_group_row(g) for s in snapshots for g in s.groups]
+        # 带宽策略按网关整体替换（先写入再删除旧的）：只替换成功读取到策略配置的网关
+        replaced = [s.gwid for s in snapshots if not any(e["step"] == "wfilter-isp" for e in s.errors)]
+        strategies = [gw_strategy_row(r) for s in snapshots if s.gwid in replaced for r in s.strategies]
+        reports = await asyncio.gather(
+            bulk_upsert("gw_users", users, on_conflict="global_id"),
+            bulk_upsert("gw_users", users_without_group, on_conflict="global_id"),
+            bulk_upsert("gw_groups", groups, on_conflict="global_id"),
+            bulk_upsert("gw_bandwidth_strategy", strategies),
+        )
+        for report in reports:
+            writes = self.progress["writes"].setdefault(report["table_name"], {"rows": 0, "written": 0, "failed": 0, "errors": []})
+            writes["rows"] += report["rows"]
+            writes["written"] += report["written"]
+            writes["failed"] += report["failed"]
+            writes["errors"].extend(c["error"] for c in report["chunks"] if c["status"] == "failed")
+        # 新的策略写入成功之后，再删除这些网关上已经不存在的策略；有失败的分块时保留旧的行
+        if len(replaced) > 0 and reports[-1]["failed"] == 0:
+            await self.delete_stale_strategies(replaced, [r["strategy_id"] for r in strategies])
+
+    async def delete_stale_strategies(self, gwids, strategy_ids):
+        query = supabase.table("gw_bandwidth_strategy").delete().in_("gwid", gwids)
+        if len(strategy_ids) > 0:
+            query = query.not_.in_("strategy_id", strategy_ids)
+        await run_with_deadline(query.execute)
+
+    async def save(self):
+        """
+        把进度写入gw_kv表，celery worker中运行时也可以通过接口查询
+        """
+        try:
+            await run_with_deadline(setkv, STATUS_TYPE, FLEET_ID, FLEET_KEY, json.dumps(self.progress, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"[FleetUserSync]: save status failed, error = {e}")
+
+    async def run(self):
+        started = time.monotonic()
+        self.progress.update(state="running", phase="select", started_at=datetime.now().isoformat())
+        try:
+            gwids = await self.select_gateways()
+            self.progress.update(phase="read", total=len(gwids))
+            await self.save()
+            snapshots = await self.read_all(gwids)
+            self.progress["phase"] = "write"
+            await self.save()
+            await self.write_all(snapshots)
+        except Exception as e:
+            print(f"[FleetUserSync]: sync failed, error = {e}")
+            self.progress.update(state="failed", error=str(getattr(e, "detail", e)))
+        else:
+            failed_rows = sum(w["failed"] for w in self.progress["writes"].values())
+            self.progress["state"] = "failed" if failed_rows > 0 else "success"
+        self.progress.update(phase=None, finished_at=datetime.now().isoformat(), elapsed=round(time.monotonic() - started, 3))
+        print(f"[FleetUserSync]: {self.progress['state']}, total = {self.progress['total']}, read = {self.progress['read']}, failed = {self.progress['failed']}, elapsed = {self.progress['elapsed']}")
+        await self.save()
+        return self.progress
+
+# 本进程中最近一次（或者正在进行的）全舰队用户同步
+fleet_user_sync = None
+
+async def run_fleet_user_sync(gwids=None, concurrency=FLEET_CONCURRENCY):
+    global fleet_user_sync
+    fleet_user_sync = FleetUserSync(gwids, concurrency)
+    return await fleet_user_sync.run()
+
+def get_fleet_user_sync_status():
+    """
+    最近一次全舰队用户同步的进度，本进程中正在运行的优先
+    """
+    if fleet_user_sync is not None and fleet_user_sync.progress["state"] == "running":
+        return fleet_user_sync.progress
+    value = getkv(STATUS_TYPE, FLEET_ID, FLEET_KEY)
+    if value is None or value == "":
+        return {}
+    try:
+        return json.loads(value)
+    except Exception:
+        return {}
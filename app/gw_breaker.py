@@ -0,0 +1,146 @@
+import threading
+import time
+from contextlib import contextmanager
+from fastapi import HTTPException
+
+# 连续失败多少次后熔断
+FAILURE_THRESHOLD = 3
+# 熔断多少秒后进入半开状态，允许一次试探请求
+OPEN_TIMEOUT = 30
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+class GatewayUnavailable(HTTPException):
+    """
+    网关处于熔断状态时抛出，返回503
+    """
+    def __init__(self, key):
+        super().__init__(status_code=503, detail=f"网关暂时无法连接，请稍后重试: {key}")
+
+class Breaker:
+    def __init__(self, key):
+        self.key = key
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.last_error = None
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "last_error": self.last_error,
+        }
+
+class GatewayBreakers:
+    """
+    每个网关一个熔断器:
+    - 连续FAILURE_THRESHOLD次连接失败或超时后打开，之后的调用直接返回503
+    - 打开OPEN_TIMEOUT秒后，或者在线探测发现网关恢复时，进入半开状态
+    - 半开状态只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+    def __init__(self, threshold=FAILURE_THRESHOLD, open_timeout=OPEN_TIMEOUT):
+        self.threshold = threshold
+        self.open_timeout = open_timeout
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = Breaker(key)
+            self.breakers[key] = breaker
+        return breaker
+
+    def before_call(self, key):
+        with self._lock:
+            breaker = self._get(key)
+            if breaker.state == STATE_OPEN:
+                if time.time() - breaker.opened_at < self.open_timeout:
+                    raise GatewayUnavailable(key)
+                breaker.state = STATE_HALF_OPEN
+                breaker.trial_in_flight = False
+            if breaker.state == STATE_HALF_OPEN:
+                if breaker.trial_in_flight:
+                    raise GatewayUnavailable(key)
+                breaker.trial_in_flight = True
+
+    def record_success(self, key):
+        with self._lock:
+            breaker = self._get(key)
+            if breaker.state != STATE_CLOSED:
+                print(f"[GatewayBreakers]: close breaker, key = {key}")
+            breaker.state = STATE_CLOSED
+            breaker.failures = 0
+            breaker.trial_in_flight = False
+
+    def record_failure(self, key, error):
+        with self._lock:
+            breaker = self._get(key)
+            breaker.failures += 1
+            breaker.last_error = str(error)
+            breaker.trial_in_flight = False
+            if breaker.state == STATE_HALF_OPEN or breaker.failures >= self.threshold:
+                if breaker.state != STATE_OPEN:
+                    print(f"[GatewayBreakers]: open breaker, key = {key}, failures = {breaker.failures}")
+                breaker.state = STATE_OPEN
+                breaker.opened_at = time.time()
+
+    def release(self, key):
+        """
+        调用因为其他原因（例如被取消）中断，不计入成功或失败
+        """
+        with self._lock:
+            breaker = self.breakers.get(key)
+            if breaker is not None:
+                breaker.trial_in_flight = False
+
+    def on_gateway_up(self, key):
+        """
+        在线探测发现网关恢复，打开的熔断器立即进入半开状态
+        """
+        with self._lock:
+            breaker = self.breakers.get(key)
+            if breaker is not None and breaker.state == STATE_OPEN:
+                breaker.state = STATE_HALF_OPEN
+                breaker.trial_in_flight = False
+
+    def is_open(self, key):
+        with self._lock:
+            breaker = self.breakers.get(key)
+            return breaker is not None and breaker.state == STATE_OPEN and time.time() - breaker.opened_at < self.open_timeout
+
+    def reset(self, key=None):
+        with self._lock:
+            if key is None:
+                self.breakers.clear()
+            else:
+                self.breakers.pop(key, None)
+
+    @contextmanager
+    def guard(self, key, failures):
+        """
+        包裹一次网关调用：failures中的异常（连接失败、超时）计为失败，正常返回计为成功
+        """
+        self.before_call(key)
+        try:
+            yield
+        except failures as e:
+            self.record_failure(key, e)
+            raise
+        except BaseException:
+            self.release(key)
+            raise
+        else:
+            self.record_success(key)
+
+    def snapshot(self):
+        with self._lock:
+            return [b.to_dict() for b in self.breakers.values()]
+
+gateway_breakers = GatewayBreakers()
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# 可以缓存的只读调用及其TTL（秒），key是(ubus object, method)
+# uci get包括config_load、list_group和list_account
+CACHE_TTLS = {
+    ("uci", "get"): 60,
+    ("network.interface", "dump"): 30,
+    ("wfilter", "list-virtual-group"): 30,
+}
+# 过期后在这个时间内仍然先返回旧值，同时在后台刷新（秒）
+STALE_TTL = 120
+# 每个网关最多缓存多少条结果
+MAX_ENTRIES_PER_GATEWAY = 64
+
+# 会修改网关配置的调用，执行时清空该网关的缓存
+INVALIDATING_CALLS = {
+    ("uci", "add"),
+    ("uci", "set"),
+    ("uci", "delete"),
+    ("uci", "commit"),
+    ("uci", "apply"),
+    ("wfilter", "exec"),
+    ("wfilter", "add-virtual-group"),
+    ("wfilter", "rm-virtual-group"),
+    ("wfilter", "add-user"),
+    ("wfilter", "rm-user"),
+}
+
+def is_cacheable(object, method):
+    return (object, method) in CACHE_TTLS
+
+def is_invalidating(object, method):
+    return (object, method) in INVALIDATING_CALLS
+
+def is_success(response):
+    """
+    只缓存成功的结果：没有error并且ubus状态码为0
+    """
+    if not isinstance(response, dict) or response.get("error") is not None:
+        return False
+    result = response.get("result")
+    return isinstance(result, list) and len(result) > 0 and result[0] == 0
+
+def make_key(object, method, para):
+    return (object, method, json.dumps(para, sort_keys=True, ensure_ascii=False))
+
+class CacheEntry:
+    def __init__(self, value, ttl):
+        self.value = value
+        self.ttl = ttl
+        self.fetched_at = time.time()
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+class GatewayRpcCache:
+    """
+    网关只读rpc的缓存，按gwid分别做LRU:
+    - 每种调用有自己的TTL，过期STALE_TTL秒内返回旧值并在后台刷新
+    - 同一网关上执行写操作时清空该网关的缓存
+    - 统计命中、未命中、过期命中和淘汰的次数
+    """
+    def __init__(self):
+        self.entries = {}
+        # 每个网关的版本号，写操作时加1；版本变化后，进行中的读取结果不再写入缓存
+        self.generations = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._tasks = set()
+        self.stats = {"hits": 0, "misses": 0, "stale_hits": 0, "evictions": 0, "invalidations": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _get(self, gwid, key):
+        with self._lock:
+            lru = self.entries.get(gwid)
+            if lru is None or key not in lru:
+                return None
+            lru.move_to_end(key)
+            return lru[key]
+
+    def _generation(self, gwid):
+        with self._lock:
+            return self.generations.get(gwid, 0)
+
+    def _put(self, gwid, key, value, ttl, generation):
+        with self._lock:
+            if self.generations.get(gwid, 0) != generation:
+                return
+            lru = self.entries.setdefault(gwid, OrderedDict())
+            lru[key] = CacheEntry(value, ttl)
+            lru.move_to_end(key)
+            while len(lru) > MAX_ENTRIES_PER_GATEWAY:
+                lru.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, gwid=None):
+        """
+        清空gwid对应的缓存；gwid为空时清空全部
+        """
+        with self._lock:
+            self.stats["invalidations"] += 1
+            if gwid is None:
+                self.entries.clear()
+                for k in self.generations:
+                    self.generations[k] += 1
+            else:
+                self.entries.pop(gwid, None)
+                self.generations[gwid] = self.generations.get(gwid, 0) + 1
+
+    async def _fetch(self, gwid, key, ttl, fetch):
+        generation = self._generation(gwid)
+        response = await fetch()
+        if is_success(response):
+            self._put(gwid, key, response, ttl, generation)
+        return response
+
+    def _refresh_in_background(self, gwid, key, ttl, fetch):
+        refresh_key = (gwid, key)
+        if refresh_key in self._refreshing:
+            return
+        self._refreshing.add(refresh_key)
+
+        async def refresh():
+            try:
+                await self._fetch(gwid, key, ttl, fetch)
+            except Exception as e:
+                print(f"[GatewayRpcCache]: refresh failed, gwid = {gwid}, key = {key[:2]}, error = {e}")
+            finally:
+                self._refreshing.discard(refresh_key)
+
+        task = asyncio.create_task(refresh())
+        # 保存task的引用，避免被回收
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def call(self, gwid, object, method, para, fetch):
+        """
+        通过缓存执行一次rpc调用，fetch是真正访问网关的协程函数
+        """
+        if is_invalidating(object, method):
+            self.invalidate(gwid)
+            try:
+                return await fetch()
+            finally:
+                # 写操作期间开始的读取也不能写入缓存
+                self.invalidate(gwid)
+        if not is_cacheable(object, method):
+            return await fetch()
+        ttl = CACHE_TTLS[(object, method)]
+        key = make_key(object, method, para)
+        entry = self._get(gwid, key)
+        if entry is not None:
+            age = entry.age()
+            if age < entry.ttl:
+                self._count("hits")
+                return entry.value
+            if age < entry.ttl + STALE_TTL:
+                self._count("stale_hits")
+                self._refresh_in_background(gwid, key, ttl, fetch)
+                return entry.value
+        self._count("misses")
+        return await self._fetch(gwid, key, ttl, fetch)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["gateways"] = len(self.entries)
+            stats["entries"] = sum(len(lru) for lru in self.entries.values())
+        return stats
+
+rpc_cache = GatewayRpcCache()
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import weakref
+from fastapi import HTTPException
+from .gw_session import session_manager
+from .gw_breaker import GatewayUnavailable
+from .deadline import DeadlineExceeded
+from .utils import get_gateway_by_id
+from .query_stream import stream_query_response
+
+# 只读的SDK方法：并发的相同调用共享同一个进行中的rpc
+READ_ONLY_METHODS = {
+    "config_load",
+    "list_group",
+    "list_account",
+    "list_virtual_group",
+    "list_bandwidth",
+    "list_online_users",
+    "list_online_connections",
+    "get_network_interfaces",
+    "get_network_status",
+    "query_db",
+}
+
+class SingleFlight:
+    """
+    合并并发的相同调用：同一个key同时只有一个进行中的task，其他调用者等待它的结果
+    """
+    def __init__(self):
+        # task不能跨事件循环使用，按事件循环分别保存
+        self._calls = weakref.WeakKeyDictionary()
+        self.stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, fn):
+        loop = asyncio.get_running_loop()
+        calls = self._calls.setdefault(loop, {})
+        self.stats["calls"] += 1
+        task = calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            calls[key] = task
+
+            def done(t):
+                if calls.get(key) is t:
+                    calls.pop(key, None)
+                # 所有调用者都被取消时，避免出现未读取异常的警告
+                if not t.cancelled():
+                    t.exception()
+
+            task.add_done_callback(done)
+        else:
+            self.stats["shared"] += 1
+        # 某个调用者被取消（例如客户端断开）不影响其他等待同一结果的调用者
+        return await asyncio.shield(task)
+
+singleflight = SingleFlight()
+
+async def lookup_gateway(gwid):
+    """
+    返回网关的(address, username, password)，网关不存在时返回400
+    """
+    gw = await get_gateway_by_id(gwid)
+    if gw is None or len(gw.data) == 0:
+        raise HTTPException(status_code=400, detail="gateway not found")
+    username = gw.data[0].get('username')
+    password = gw.data[0].get('password')
+    address = gw.data[0].get('address')
+    return address, username, password
+
+async def call_gateway(gwid, method, *args):
+    """
+    查找网关，从session池获取已登录的AsyncSDK并调用method
+    """
+    address, username, password = await lookup_gateway(gwid)
+    try:
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
+            return await getattr(sdk, method)(*args)
+        else:
+            raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def dispatch(gwid, method, *args):
+    """
+    main.py中网关接口的统一入口。
+    只读调用按(gwid, method, 参数)合并，并发的相同请求只访问网关一次；写操作每次都执行
+    """
+    if method not in READ_ONLY_METHODS:
+        return await call_gateway(gwid, method, *args)
+    key = (gwid, method, json.dumps(args, sort_keys=True, ensure_ascii=False))
+    return await singleflight.do(key, lambda: call_gateway(gwid, method, *args))
+
+async def stream_query_db(gwid, dbname, querysql, fmt, table_name=None):
+    """
+    /query_db的流式版本，不经过合并，直接返回StreamingResponse
+    """
+    address, username, password = await lookup_gateway(gwid)
+    try:
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
+            return await stream_query_response(sdk, dbname, querysql, fmt, table_name)
+        else:
+            raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -0,0 +1,281 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from urllib.parse import urlparse
+from multiping import multi_ping
+from app.supabase import supabase
+from .gw_registry import gateway_registry, GATEWAY_TTL
+from .gw_breaker import gateway_breakers
+
+# 状态未知、刚发生变化或者频繁抖动的网关，按FAST_INTERVAL探测
+FAST_INTERVAL = 10
+# 状态稳定的网关，按SLOW_INTERVAL探测
+SLOW_INTERVAL = 60
+# 后台循环的间隔
+TICK = 5
+# 单次tcp连接的超时
+PROBE_TIMEOUT = 2
+# 保留最近多少次探测结果，用于判断抖动
+FLAP_WINDOW = 10
+# 在FLAP_WINDOW次探测中状态变化达到这个次数认为在抖动
+FLAP_THRESHOLD = 3
+# 超过这个时间没有探测过的结果不再使用
+STALE_AFTER = SLOW_INTERVAL * 3
+
+def parse_host_port(address):
+    """
+    从网关地址中解析出host和ubus的端口，例如http://10.188.188.12 -> (10.188.188.12, 80)
+    """
+    if address is None or address == "":
+        return None, None
+    if "://" not in address:
+        address = f"http://{address}"
+    url = urlparse(address)
+    port = url.port
+    if port is None:
+        port = 443 if url.scheme == "https" else 80
+    return url.hostname, port
+
+class GatewayStatus:
+    """
+    单个网关的在线状态和最近的探测历史
+    """
+    def __init__(self, gwid, address):
+        self.gwid = gwid
+        self.address = address
+        self.online = None
+        self.last_checked = 0.0
+        self.last_changed = 0.0
+        self.history = deque(maxlen=FLAP_WINDOW)
+
+    def record(self, online):
+        """
+        记录一次探测结果，返回状态是否发生了变化
+        """
+        now = time.time()
+        changed = self.online is not None and self.online != online
+        if self.online is None or changed:
+            self.last_changed = now
+        self.online = online
+        self.last_checked = now
+        self.history.append(online)
+        return changed
+
+    def flaps(self):
+        h = list(self.history)
+        return sum(1 for a, b in zip(h, h[1:]) if a != b)
+
+    def is_flapping(self):
+        return self.flaps() >= FLAP_THRESHOLD
+
+    def interval(self):
+        if self.online is None or self.is_flapping():
+            return FAST_INTERVAL
+        if time.time() - self.last_changed < SLOW_INTERVAL:
+            return FAST_INTERVAL
+        return SLOW_INTERVAL
+
+    def is_due(self):
+        return time.time() - self.last_checked >= self.interval()
+
+    def is_stale(self):
+        return self.online is None or time.time() - self.last_checked > STALE_AFTER
+
+    def to_dict(self):
+        return {
+            "gwid": self.gwid,
+            "address": self.address,
+            "online": self.online,
+            "last_checked": self.last_checked,
+            "last_changed": self.last_changed,
+            "flaps": self.flaps(),
+            "interval": self.interval(),
+        }
+
+async def tcp_probe(address, timeout=PROBE_TIMEOUT):
+    """
+    尝试连接网关的ubus端口，能建立连接即认为在线
+    """
+    host, port = parse_host_port(address)
+    if host is None:
+        return False
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        return True
+    except Exception:
+        return False
+
+def tcp_probe_sync(address, timeout=PROBE_TIMEOUT):
+    """
+    tcp_probe的同步版本
+    """
+    host, port = parse_host_port(address)
+    if host is None:
+        return False
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except Exception:
+        return False
+
+def icmp_probe_multi(addresses):
+    """
+    对一批地址做一次multi_ping，返回能ping通的地址集合
+    """
+    hosts = {}
+    for address in addresses:
+        host, _ = parse_host_port(address)
+        if host is not None:
+            hosts[host] = address
+    if len(hosts) == 0:
+        return set()
+    try:
+        responses, _ = multi_ping(list(hosts.keys()), timeout=0.5, retry=2, ignore_lookup_errors=True)
+    except Exception as e:
+        # multi_ping需要raw socket权限，失败时只使用tcp探测结果
+        print(f"[GatewayLiveness]: multi_ping failed, error = {e}")
+        return set()
+    return {hosts[h] for h in responses.keys() if h in hosts}
+
+class GatewayLiveness:
+    """
+    后台探测所有网关的在线状态:
+    - 对ubus端口做tcp连接，连不上的地址再批量multi_ping一次
+    - 按网关状态自适应探测间隔，并保留抖动历史
+    - 状态变化时批量更新gateway表的online字段
+    gw_login通过is_online_cached读取结果，不再每次同步ping
+    """
+    def __init__(self):
+        self.statuses = {}
+        self._task = None
+        self._last_refresh = 0.0
+
+    def _status(self, gwid, address):
+        status = self.statuses.get(gwid)
+        if status is None or status.address != address:
+            status = GatewayStatus(gwid, address)
+            self.statuses[gwid] = status
+        return status
+
+    def is_online_cached(self, gwid, address):
+        """
+        返回缓存的在线状态；没有探测过或者结果过期时返回None
+        """
+        status = self.statuses.get(gwid)
+        if status is None or status.address != address or status.is_stale():
+            return None
+        return status.online
+
+    async def check(self, gwid, address):
+        """
+        优先读取缓存的状态，没有可用的缓存时立即探测一次
+        """
+        online = self.is_online_cached(gwid, address)
+        if online is not None:
+            return online
+        online = await tcp_probe(address)
+        if not online:
+            online = address in await asyncio.to_thread(icmp_probe_multi, [address])
+        self._status(gwid, address).record(online)
+        return online
+
+    def check_sync(self, gwid, address):
+        """
+        check的同步版本
+        """
+        online = self.is_online_cached(gwid, address)
+        if online is not None:
+            return online
+        online = tcp_probe_sync(address)
+        if not online:
+            online = address in icmp_probe_multi([address])
+        self._status(gwid, address).record(online)
+        return online
+
+    async def probe_once(self):
+        """
+        探测所有到期的网关，返回本轮状态发生变化的gwid
+        """
+        # 定期从supabase刷新网关列表
+        if time.time() - self._last_refresh > GATEWAY_TTL:
+            try:
+                await asyncio.to_thread(gateway_registry.warm)
+                self._last_refresh = time.time()
+            except Exception as e:
+                print(f"[GatewayLiveness]: refresh gateways failed, error = {e}")
+        due = []
+        for row in gateway_registry.all():
+            gwid = str(row.get("id"))
+            status = self._status(gwid, row.get("address"))
+            if status.is_due():
+                due.append(status)
+        if len(due) == 0:
+            return []
+        results = await asyncio.gather(*[tcp_probe(s.address) for s in due])
+        failed = [s.address for s, ok in zip(due, results) if not ok]
+        reachable = await asyncio.to_thread(icmp_probe_multi, failed) if len(failed) > 0 else set()
+        changed = []
+        for status, ok in zip(due, results):
+            online = ok or status.address in reachable
+            first = status.online is None
+            if status.record(online) or first:
+                changed.append(status)
+            if online:
+                # 网关已经恢复，让打开的熔断器进入半开状态
+                gateway_breakers.on_gateway_up(status.gwid)
+        if len(changed) > 0:
+            await asyncio.to_thread(self.write_online, changed)
+        return [s.gwid for s in changed]
+
+    def write_online(self, statuses):
+        """
+        把在线状态批量写回gateway表，在线和离线各一次update
+        """
+        online_ids = [s.gwid for s in statuses if s.online]
+        offline_ids = [s.gwid for s in statuses if not s.online]
+        try:
+            if len(online_ids) > 0:
+                supabase.table("gateway").update({"online": "true"}).in_("id", online_ids).execute()
+            if len(offline_ids) > 0:
+                supabase.table("gateway").update({"online": "false"}).in_("id", offline_ids).execute()
+        except Exception as e:
+            print(f"[GatewayLiveness]: update online failed, error = {e}")
+
+    async def run(self):
+        while True:
+            try:
+                changed = await self.probe_once()
+                if len(changed) > 0:
+                    print(f"[GatewayLiveness]: status changed, gwids = {changed}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[GatewayLiveness]: probe failed, error = {e}")
+            await asyncio.sleep(TICK)
+
+    def start(self):
+        # startup时已经加载过网关列表，第一轮不用再刷新
+        if len(gateway_registry.all()) > 0:
+            self._last_refresh = time.time()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self):
+        return [s.to_dict() for s in self.statuses.values()]
+
+gateway_liveness = GatewayLiveness()
@@ -0,0 +1,144 @@
+import urllib.parse
+from fastapi import HTTPException
+from .gw_session import session_manager
+from .gw_dispatch import lookup_gateway
+from .sdk import ASYNC_TRANSPORT_ERRORS
+from .supabase import keys_for_table_name, get_db_for_table
+from .row_parser import get_parser
+
+# 每页从网关读取的行数
+PAGE_SIZE = 2000
+# 单页读取失败（连接断开、超时）时的重试次数，只重试这一页
+PAGE_RETRIES = 2
+
+def quote_value(value):
+    """
+    sql字符串常量，单引号转义
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+def build_keyset_sql(table_name, keys, since=None, after=None, page_size=PAGE_SIZE, start=None, end=None):
+    """
+    生成一页的sql:
+    SELECT * FROM t WHERE k1 > 'since' AND (k1 > 'a' OR (k1 = 'a' AND k2 > 'b')) ORDER BY k1, k2 LIMIT n
+    since: 第一个排序键的下限（不包含），start: 第一个排序键的下限（包含），end: 第一个排序键的上限（不包含）
+    after: 上一页最后一行的排序键
+    """
+    conditions = []
+    if since is not None:
+        conditions.append(f"{keys[0]} > {quote_value(since)}")
+    if start is not None:
+        conditions.append(f"{keys[0]} >= {quote_value(start)}")
+    if end is not None:
+        conditions.append(f"{keys[0]} < {quote_value(end)}")
+    if after is not None:
+        # 展开成OR的形式，不依赖sqlite的行值比较
+        ors = []
+        for i in range(len(keys)):
+            parts = [f"{keys[j]} = {quote_value(after[j])}" for j in range(i)]
+            parts.append(f"{keys[i]} > {quote_value(after[i])}")
+            ors.append("(" + " AND ".join(parts) + ")")
+        conditions.append("(" + " OR ".join(ors) + ")")
+    sql = f"SELECT * FROM {table_name}"
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += f" ORDER BY {', '.join(keys)} LIMIT {int(page_size)}"
+    return sql
+
+def page_stdout(result):
+    """
+    querydb的返回 -> stdout文本
+    """
+    stdout = None
+    if isinstance(result, dict):
+        r = result.get("result")
+        if isinstance(r, list) and len(r) > 1 and isinstance(r[1], dict):
+            stdout = r[1].get("stdout")
+    if stdout is None:
+        raise HTTPException(status_code=400, detail=str(result))
+    return stdout
+
+def cursor_of(row, keys):
+    return [row.get(k, "") for k in keys]
+
+def last_cursor(parser, text, keys):
+    """
+    从最后一行的原始值中取出排序键，不需要解析整页
+    """
+    end = len(text.rstrip("\n"))
+    if end == 0:
+        return None
+    line = text[text.rfind("\n", 0, end) + 1:end]
+    return cursor_of(parser.row(line), keys)
+
+async def query_gateway_table(gwid, table_name, sql):
+    """
+    在网关上执行一条sql，返回stdout；连接断开时重试
+    """
+    sql = urllib.parse.quote(sql)
+    db = get_db_for_table(table_name)
+    address, username, password = await lookup_gateway(gwid)
+    attempt = 0
+    while True:
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is None:
+            raise HTTPException(status_code=401, detail="登录失败")
+        try:
+            result = await sdk.query_db(db, sql)
+            break
+        except ASYNC_TRANSPORT_ERRORS as e:
+            # 卫星链路断开只重新读取这一页，游标不变
+            attempt += 1
+            if attempt > PAGE_RETRIES:
+                raise HTTPException(status_code=400, detail=str(e))
+            print(f"[query_gateway_table]: retry, gwid = {gwid}, table = {table_name}, error = {e}")
+    return page_stdout(result)
+
+async def fetch_bounds(gwid, table_name, column):
+    """
+    返回网关上column的(最小值, 最大值)，表为空时返回(None, None)
+    """
+    text = await query_gateway_table(gwid, table_name, f"SELECT MIN({column}), MAX({column}) FROM {table_name}")
+    fields = text.strip().split("|")
+    if len(fields) < 2 or fields[0] == "" or fields[1] == "":
+        return None, None
+    return fields[0], fields[1]
+
+async def fetch_page_text(gwid, table_name, column="happendate", since=None, after=None, page_size=PAGE_SIZE, start=None, end=None):
+    """
+    读取一页，返回(text, rows, last)：querydb的stdout、行数、最后一行的排序键
+    """
+    parser = get_parser(table_name)
+    keys = keys_for_table_name(table_name, column)
+    text = await query_gateway_table(gwid, table_name, build_keyset_sql(table_name, keys, since, after, page_size, start, end))
+    rows = sum(1 for line in text.splitlines() if line != "")
+    return text, rows, last_cursor(parser, text, keys)
+
+async def iter_page_texts(gwid, table_name, column="happendate", since=None, after=None, page_size=PAGE_SIZE, start=None, end=None):
+    """
+    按排序键分页遍历网关上的表，每次返回(text, rows, last)，不解析内容
+    """
+    while True:
+        text, rows, last = await fetch_page_text(gwid, table_name, column, since, after, page_size, start, end)
+        if rows > 0:
+            yield text, rows, last
+        if rows < page_size:
+            return
+        after = last
+
+async def fetch_page(gwid, table_name, column="happendate", since=None, after=None, page_size=PAGE_SIZE, start=None):
+    """
+    读取一页，返回(rows, next)；next是下一页的游标，已经读完时为None
+    """
+    text, count, last = await fetch_page_text(gwid, table_name, column, since, after, page_size, start)
+    rows = get_parser(table_name).records(text)
+    if count < page_size:
+        return rows, None
+    return rows, last
+
+async def iter_table_pages(gwid, table_name, column="happendate", since=None, after=None, page_size=PAGE_SIZE, start=None):
+    """
+    按排序键分页遍历网关上的表，每次返回一页（dict列表）
+    """
+    async for text, count, last in iter_page_texts(gwid, table_name, column, since, after, page_size, start):
+        yield get_parser(table_name).records(text)
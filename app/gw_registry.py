@@ -0,0 +1,102 @@
+import threading
+import time
+from app.supabase import supabase
+from .deadline import run_with_deadline
+
+# 网关信息在进程内缓存的时间（秒）
+GATEWAY_TTL = 300
+
+class CachedResponse:
+    """
+    与supabase的返回值一样，通过.data访问查询到的行
+    """
+    def __init__(self, data):
+        self.data = data
+
+class GatewayRegistry:
+    """
+    进程内的网关信息缓存，key是gwid，value是gateway表中的一行。
+    - 每一行在GATEWAY_TTL秒后过期，过期后重新从supabase读取
+    - startup时通过warm()一次性加载全部网关
+    - 网关被创建、修改、删除时调用invalidate/put主动更新
+    """
+    def __init__(self, ttl=GATEWAY_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def _fresh_row(self, gwid):
+        with self._lock:
+            entry = self.entries.get(gwid)
+        if entry is None:
+            return None
+        row, expires_at = entry
+        if time.time() >= expires_at:
+            return None
+        return row
+
+    def put(self, row):
+        gwid = row.get("id")
+        if gwid is None:
+            return
+        with self._lock:
+            self.entries[str(gwid)] = (row, time.time() + self.ttl)
+
+    def invalidate(self, gwid=None):
+        """
+        丢弃gwid对应的缓存；gwid为空时丢弃全部
+        """
+        with self._lock:
+            if gwid is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(gwid), None)
+
+    def all(self):
+        """
+        返回缓存中的所有网关行（包括已过期的）
+        """
+        with self._lock:
+            return [row for row, _ in self.entries.values()]
+
+    def _fetch(self, gwid):
+        response = supabase.table("gateway").select("*").eq("id", gwid).execute()
+        if response is None or len(response.data) == 0:
+            # 网关不存在，不缓存，保证新建的网关可以立即被查到
+            self.invalidate(gwid)
+            return None
+        row = response.data[0]
+        self.put(row)
+        return row
+
+    def get(self, gwid):
+        """
+        返回gwid对应的gateway行，不存在时返回None
+        """
+        row = self._fresh_row(str(gwid))
+        if row is not None:
+            return row
+        return self._fetch(gwid)
+
+    async def aget(self, gwid):
+        """
+        get的异步版本，缓存未命中时在线程中访问supabase，最多等待请求剩余的时间
+        """
+        row = self._fresh_row(str(gwid))
+        if row is not None:
+            return row
+        return await run_with_deadline(self._fetch, gwid)
+
+    def warm(self):
+        """
+        一次性加载gateway表中的所有网关，返回加载的数量
+        """
+        response = supabase.table("gateway").select("*").execute()
+        with self._lock:
+            self.entries.clear()
+        for row in response.data:
+            self.put(row)
+        print(f"[GatewayRegistry]: warm up {len(response.data)} gateways")
+        return len(response.data)
+
+gateway_registry = GatewayRegistry()
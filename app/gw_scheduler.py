@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import weakref
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+# 交互请求（页面上的操作）和批量请求（同步、上传配置等）两个优先级
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+# 按优先级从高到低排列
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+# 每个网关同时进行的rpc数量上限
+PER_GATEWAY_LIMIT = 4
+# 每个网关上批量请求最多占用的数量，至少给交互请求留一个
+BULK_LIMIT = PER_GATEWAY_LIMIT - 1
+# 整个进程同时进行的网关rpc数量上限
+GLOBAL_LIMIT = 64
+
+# 当前请求所在的优先级，默认是交互请求
+current_lane = contextvars.ContextVar("gateway_lane", default=LANE_INTERACTIVE)
+
+@contextmanager
+def bulk_lane():
+    """
+    在这个上下文中发起的网关rpc都走批量通道
+    """
+    token = current_lane.set(LANE_BULK)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+class GatewayScheduler:
+    """
+    按网关限制并发的rpc数量:
+    - 每个网关最多PER_GATEWAY_LIMIT个，其中批量请求最多BULK_LIMIT个
+    - 全局最多GLOBAL_LIMIT个，避免全舰队的并发调用耗尽socket
+    - 排队时交互请求总是优先于批量请求获得空位
+    """
+    def __init__(self, per_gateway=PER_GATEWAY_LIMIT, bulk_limit=BULK_LIMIT, global_limit=GLOBAL_LIMIT):
+        self.per_gateway = per_gateway
+        self.bulk_limit = bulk_limit
+        self.global_limit = global_limit
+        self.active_total = 0
+        # gwid -> {lane: 正在进行的数量}
+        self.active = {}
+        self.waiters = {lane: deque() for lane in LANES}
+
+    def _active(self, key):
+        if key not in self.active:
+            self.active[key] = {lane: 0 for lane in LANES}
+        return self.active[key]
+
+    def _can_run(self, key, lane):
+        if self.active_total >= self.global_limit:
+            return False
+        active = self.active.get(key) or {l: 0 for l in LANES}
+        if sum(active.values()) >= self.per_gateway:
+            return False
+        if lane == LANE_BULK and active[LANE_BULK] >= self.bulk_limit:
+            return False
+        return True
+
+    def _grant(self, key, lane):
+        self.active_total += 1
+        self._active(key)[lane] += 1
+
+    def _has_waiters(self, key, lane):
+        return any(k == key and not fut.done() for k, fut in self.waiters[lane])
+
+    def _wake(self):
+        for lane in LANES:
+            remaining = deque()
+            while self.waiters[lane]:
+                key, fut = self.waiters[lane].popleft()
+                if fut.done():
+                    continue
+                if self._can_run(key, lane):
+                    self._grant(key, lane)
+                    fut.set_result(None)
+                else:
+                    remaining.append((key, fut))
+            self.waiters[lane] = remaining
+
+    async def acquire(self, key, lane):
+        # 批量请求不能越过同一网关上正在排队的交互请求
+        if self._can_run(key, lane) and (lane == LANE_INTERACTIVE or not self._has_waiters(key, LANE_INTERACTIVE)):
+            self._grant(key, lane)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[lane].append((key, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # 已经分配到空位但调用者被取消了，归还空位
+            if fut.done() and not fut.cancelled():
+                self.release(key, lane)
+            raise
+
+    def release(self, key, lane):
+        self.active_total -= 1
+        active = self._active(key)
+        active[lane] -= 1
+        if sum(active.values()) == 0:
+            self.active.pop(key, None)
+        self._wake()
+
+    def snapshot(self):
+        return {
+            "active_total": self.active_total,
+            "active": {k: dict(v) for k, v in self.active.items()},
+            "waiting": {lane: sum(1 for _, f in self.waiters[lane] if not f.done()) for lane in LANES},
+        }
+
+# future不能跨事件循环使用，每个事件循环一个调度器
+_schedulers = weakref.WeakKeyDictionary()
+
+def get_scheduler():
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = GatewayScheduler()
+        _schedulers[loop] = scheduler
+    return scheduler
+
+@asynccontextmanager
+async def gateway_slot(key):
+    """
+    占用key对应网关的一个rpc空位，优先级由current_lane决定
+    """
+    scheduler = get_scheduler()
+    lane = current_lane.get()
+    await scheduler.acquire(key, lane)
+    try:
+        yield
+    finally:
+        scheduler.release(key, lane)
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import weakref
+from fastapi import HTTPException
+from .sdk import SDK, AsyncSDK, UBUS_SESSION_TIMEOUT
+
+# 在session过期前多少秒主动续期
+RENEW_MARGIN = 30
+
+class GatewaySession:
+    """
+    缓存的网关ubus session
+    """
+    def __init__(self, gwid, address, username, password):
+        self.gwid = gwid
+        self.address = address
+        self.username = username
+        self.password = password
+        self.session_id = None
+        self.timeout = UBUS_SESSION_TIMEOUT
+        self.last_used = 0.0
+
+    def matches(self, address, username, password):
+        return self.address == address and self.username == username and self.password == password
+
+    def is_fresh(self):
+        """
+        ubus的session在空闲timeout秒后过期，这里提前RENEW_MARGIN秒续期
+        """
+        if self.session_id is None:
+            return False
+        return time.time() - self.last_used < self.timeout - RENEW_MARGIN
+
+    def touch(self):
+        self.last_used = time.time()
+
+class GatewaySessionManager:
+    """
+    按gwid缓存ubus_rpc_session，避免每次网关操作都login/destroy。
+    - session快过期时重新登录
+    - 网关返回Access denied时透明地重新登录并重试
+    - shutdown时统一logout
+    """
+    def __init__(self):
+        self.sessions = {}
+        # 同步登录按gwid加锁，一个网关登录慢不影响其他网关；_sync_locks_guard只保护字典本身
+        self._sync_locks = {}
+        self._sync_locks_guard = threading.Lock()
+        # asyncio.Lock不能跨事件循环使用，按事件循环分别保存
+        self._async_locks = weakref.WeakKeyDictionary()
+
+    def _get_session(self, gwid, address, username, password):
+        session = self.sessions.get(gwid)
+        if session is None or not session.matches(address, username, password):
+            # 网关的地址或者账号变化了，旧的session作废
+            session = GatewaySession(gwid, address, username, password)
+            self.sessions[gwid] = session
+        return session
+
+    def _lock(self, gwid):
+        loop = asyncio.get_running_loop()
+        locks = self._async_locks.setdefault(loop, {})
+        if gwid not in locks:
+            locks[gwid] = asyncio.Lock()
+        return locks[gwid]
+
+    def _sync_lock(self, gwid):
+        with self._sync_locks_guard:
+            lock = self._sync_locks.get(gwid)
+            if lock is None:
+                lock = threading.Lock()
+                self._sync_locks[gwid] = lock
+            return lock
+
+    def invalidate(self, gwid=None):
+        """
+        丢弃gwid对应的session；gwid为空时丢弃全部
+        """
+        if gwid is None:
+            self.sessions.clear()
+        else:
+            self.sessions.pop(gwid, None)
+
+    async def _async_login(self, session):
+        sdk = AsyncSDK()
+        sdk.gwid = session.gwid
+        if await sdk.login(session.address, session.username, session.password):
+            session.session_id = sdk.session_id
+            session.timeout = sdk.session_timeout
+            session.touch()
+            print(f"[GatewaySessionManager]: login success, gwid = {session.gwid}")
+            return True
+        session.session_id = None
+        return False
+
+    def _sync_login(self, session):
+        sdk = SDK()
+        sdk.gwid = session.gwid
+        if sdk.login(session.address, session.username, session.password):
+            session.session_id = sdk.session_id
+            session.timeout = sdk.session_timeout
+            session.touch()
+            print(f"[GatewaySessionManager]: login success, gwid = {session.gwid}")
+            return True
+        session.session_id = None
+        return False
+
+    def _bind_async(self, session):
+        sdk = AsyncSDK()
+        sdk.server = session.address
+        sdk.session_id = session.session_id
+        sdk.session_timeout = session.timeout
+        sdk.gwid = session.gwid
+
+        async def relogin():
+            async with self._lock(session.gwid):
+                # 如果其他协程已经刷新过session，直接使用新的session
+                if session.session_id is None or session.session_id == sdk.session_id:
+                    if not await self._async_login(session):
+                        raise HTTPException(status_code=401, detail="登录失败")
+            return session.session_id
+
+        sdk.on_access_denied = relogin
+        return sdk
+
+    def _bind_sync(self, session):
+        sdk = SDK()
+        sdk.server = session.address
+        sdk.session_id = session.session_id
+        sdk.session_timeout = session.timeout
+        sdk.gwid = session.gwid
+
+        def relogin():
+            with self._sync_lock(session.gwid):
+                if session.session_id is None or session.session_id == sdk.session_id:
+                    if not self._sync_login(session):
+                        raise HTTPException(status_code=401, detail="登录失败")
+            return session.session_id
+
+        sdk.on_access_denied = relogin
+        return sdk
+
+    async def acquire(self, gwid, address, username, password):
+        """
+        返回一个使用缓存session的AsyncSDK，登录失败时返回None
+        """
+        session = self._get_session(gwid, address, username, password)
+        if not session.is_fresh():
+            async with self._lock(gwid):
+                if not session.is_fresh():
+                    if not await self._async_login(session):
+                        return None
+        session.touch()
+        return self._bind_async(session)
+
+    def acquire_sync(self, gwid, address, username, password):
+        """
+        acquire的同步版本，给luigi任务等同步代码使用
+        """
+        session = self._get_session(gwid, address, username, password)
+        if not session.is_fresh():
+            with self._sync_lock(gwid):
+                if not session.is_fresh():
+                    if not self._sync_login(session):
+                        return None
+        session.touch()
+        return self._bind_sync(session)
+
+    async def close_all(self):
+        """
+        注销所有缓存的session，在应用shutdown时调用
+        """
+        sessions = [s for s in self.sessions.values() if s.session_id is not None]
+        self.sessions = {}
+
+        async def destroy(session):
+            sdk = AsyncSDK()
+            sdk.gwid = session.gwid
+            sdk.server = session.address
+            sdk.session_id = session.session_id
+            try:
+                await sdk.logout()
+            except Exception as e:
+                print(f"[GatewaySessionManager]: logout failed, gwid = {session.gwid}, error = {e}")
+
+        await asyncio.gather(*[destroy(s) for s in sessions])
+
+session_manager = GatewaySessionManager()
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from .supabase import GLOBAL_ID_KEYS
+from .gw_pager import PAGE_SIZE, fetch_bounds
+from .sync_pipeline import SyncPipeline
+from .sync_watermark import sync_watermarks, get_sync_start
+from .sync_lease import sync_lease
+
+# 按时间窗口导入的表：时间列和每个窗口的长度（秒）
+LOG_TABLES = {
+    "sessionslog": {"column": "happentime", "window": 3600},
+    "ftplog": {"column": "happentime", "window": 3600},
+    "ipmaclog": {"column": "happentime", "window": 3600},
+    "maillog": {"column": "happentime", "window": 3600},
+    "webpostlog": {"column": "happentime", "window": 3600},
+    "websurflog": {"column": "happentime", "window": 3600},
+    "webreport": {"column": "happendate", "window": 86400},
+    "protocolreport": {"column": "happendate", "window": 86400},
+    "ipreport": {"column": "happendate", "window": 86400},
+}
+# 时间列在网关上的格式
+TIME_FORMATS = {
+    "happentime": "%Y-%m-%d %H:%M:%S",
+    "happendate": "%Y-%m-%d",
+}
+# 同一个网关同时导入的窗口数量，网关上的并发由批量通道进一步限制
+WINDOW_CONCURRENCY = 3
+
+def parse_time(value):
+    return datetime.fromisoformat(str(value).replace("T", " ")[:19])
+
+def iter_windows(lo, hi, window):
+    """
+    [lo, hi]按window秒切分成[start, end)，第一个窗口对齐到window的整数倍
+    """
+    step = timedelta(seconds=window)
+    epoch = datetime(1970, 1, 1)
+    start = epoch + timedelta(seconds=int((lo - epoch).total_seconds()) // window * window)
+    while start <= hi:
+        yield start, start + step
+        start = start + step
+
+async def ingest_log_table(gwid, table_name, since=None, until=None, rebuild=False, concurrency=WINDOW_CONCURRENCY, page_size=PAGE_SIZE):
+    """
+    把网关上的日志表按时间窗口并行导入supabase，每个窗口内部按页流式读取和写入。
+    since/until为空时从同步水位开始，并在窗口完成后推进水位（只推进到第一个没有完成的窗口）
+    同一个网关和表同时只有一个导入任务
+    """
+    async with sync_lease(gwid, table_name) as lease:
+        return await ingest_windows(gwid, table_name, since, until, rebuild, concurrency, page_size, lease)
+
+async def ingest_windows(gwid, table_name, since, until, rebuild, concurrency, page_size, lease=None):
+    cfg = LOG_TABLES[table_name]
+    column = cfg["column"]
+    fmt = TIME_FORMATS[column]
+    keys = GLOBAL_ID_KEYS[table_name]
+    started = time.monotonic()
+    track_watermark = since is None and until is None
+    if since is None:
+        since = await get_sync_start(gwid, table_name, column, rebuild)
+    lo, hi = await fetch_bounds(gwid, table_name, column)
+    summary = {"gwid": gwid, "table_name": table_name, "windows": 0, "success": 0, "failed": 0, "rows": 0, "bytes": 0, "errors": []}
+    if lo is None:
+        return summary
+    lo = parse_time(lo)
+    hi = parse_time(hi)
+    if since is not None:
+        lo = max(lo, parse_time(since))
+    if until is not None:
+        hi = min(hi, parse_time(until))
+    windows = list(iter_windows(lo, hi, cfg["window"]))
+    summary["windows"] = len(windows)
+    done = [False] * len(windows)
+    state = {"next": 0, "committed": 0}
+    lock = asyncio.Lock()
+
+    async def advance():
+        async with lock:
+            await advance_locked()
+
+    async def advance_locked():
+        # 水位只推进到第一个没有完成的窗口的开始
+        committed = state["committed"]
+        while committed < len(windows) and done[committed]:
+            committed += 1
+        if committed == state["committed"] or not track_watermark:
+            state["committed"] = committed
+            return
+        if lease is not None:
+            lease.check()
+        state["committed"] = committed
+        # 全部完成时停在最后一个窗口，下一次重新读取还在增长的最后一段
+        value = windows[min(committed, len(windows) - 1)][0].strftime(fmt)
+        await sync_watermarks.aset(gwid, table_name, column, [value], summary["rows"])
+
+    async def worker():
+        while state["next"] < len(windows):
+            if lease is not None and lease.lost:
+                # 租约已经失效，剩下的窗口不再导入
+                break
+            index = state["next"]
+            state["next"] += 1
+            start, end = windows[index]
+            pipeline = SyncPipeline(gwid, table_name, table_name, column, keys, start.strftime(fmt), page_size,
+                                    on_conflict="global_id", end=end.strftime(fmt), advance_watermark=False, rebuild=rebuild, lease=lease)
+            try:
+                report = await pipeline.run()
+            except Exception as e:
+                print(f"[LogIngest]: window failed, gwid = {gwid}, table = {table_name}, window = {start} ~ {end}, error = {e}")
+                summary["failed"] += 1
+                summary["errors"].append({"start": start.strftime(fmt), "end": end.strftime(fmt), "error": str(getattr(e, "detail", e))})
+                continue
+            summary["success"] += 1
+            summary["rows"] += report["stages"]["write"]["rows"]
+            summary["bytes"] += report["stages"]["read"]["bytes"]
+            done[index] = True
+            await advance()
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    summary["elapsed"] = round(time.monotonic() - started, 3)
+    print(f"[LogIngest]: {summary}")
+    return summary
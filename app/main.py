@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Request ,Depends,status
+from fastapi import FastAPI, Request ,Depends,status
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import csv
@@ -8,7 +8,13 @@ import asyncio
 from starlette.status import HTTP_504_GATEWAY_TIMEOUT
 load_dotenv()
 # from fastapi_jwt_auth.exceptions import AuthJWTException
-from app.sdk import SDK
+from app.sdk import close_async_client
+from app.gw_session import session_manager
+from app.gw_registry import gateway_registry
+from app.gw_liveness import gateway_liveness
+from app.sync_queue import sync_queue
+from app.task import task_runner, mq_publisher
+from app.deadline import budget_for_path, request_deadline
 from .routers import gateway
 from .routers import auth
 from . import db, task
@@ -17,7 +23,8 @@ from .routers import auth2, traffic
 from .routers import account, weather
 from .routers import user, group
 from .routers import admin
-from .utils import settings, gw_login, get_gateway_by_id
+from .utils import settings, async_gw_login
+from .gw_dispatch import dispatch, stream_query_db
 from jose import JWTError, ExpiredSignatureError  # 导入jose的异常类
 
 import time
@@ -94,19 +101,36 @@ async def startup_event():
     print(f"[startup]: ratio file = {ratio_file}")
     if ratio_file is not None:
         settings.ratio_table = await get_csv_as_dict(ratio_file)
+    # 预先加载全部网关信息到缓存
+    try:
+        await asyncio.to_thread(gateway_registry.warm)
+    except Exception as e:
+        print(f"[startup]: warm gateway registry failed, error = {e}")
+    # 启动网关在线状态的后台探测
+    gateway_liveness.start()
+    # 启动后台同步队列和本地任务队列
+    sync_queue.start()
+    task_runner.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 停止在线探测和后台同步队列，注销缓存的网关session，然后关闭共享的http连接池
+    await gateway_liveness.stop()
+    await sync_queue.stop()
+    await task_runner.stop()
+    await asyncio.to_thread(mq_publisher.close)
+    await session_manager.close_all()
+    await close_async_client()
     
 @app.middleware("http")
 async def timeout_middleware(request: Request, call_next):
-    long_timeout_urls = {
-        "/upload_config": 100000,
-        "/sync_traffics": 100000,
-    }
-    timeout = 1000
-    if request.url.path in long_timeout_urls:
-        timeout = long_timeout_urls[request.url.path]
+    # 每个路由的处理时间见deadline.ROUTE_BUDGETS
+    timeout = budget_for_path(request.url.path)
     try:
         start_time = time.time()
-        return await asyncio.wait_for(call_next(request), timeout=timeout)
+        # 设置请求的截止时间，网关、supabase和neo4j调用按剩余时间设置超时
+        with request_deadline(timeout):
+            return await asyncio.wait_for(call_next(request), timeout=timeout)
 
     except asyncio.TimeoutError:
         process_time = time.time() - start_time
@@ -150,8 +174,8 @@ class ListVirtualGroupRequest(BaseModel):
 async def list_virtual_group(request: ListVirtualGroupRequest):
     gwid = request.gwid
     groupid = request.groupid
-    with gw_login(gwid) as sdk_obj:
-        virtual_groups = sdk_obj.list_virtual_group(groupid)  # 传入空字符串作为 groupid
+    async with async_gw_login(gwid) as sdk_obj:
+        virtual_groups = await sdk_obj.list_virtual_group(groupid)  # 传入空字符串作为 groupid
         return {"virtual_groups": virtual_groups}
 
 @app.get("/")
@@ -168,24 +192,9 @@ class ConfigLoadRequest(BaseModel):
 @app.post("/config_load")
 async def config_load(request: ConfigLoadRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
     cfgname = request.cfgname
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            config = sdk.config_load(cfgname)
-            return {"config": config}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    config = await dispatch(gwid, "config_load", cfgname)
+    return {"config": config}
 
 class ConfigSetRequest(BaseModel):
     gwid: str
@@ -196,26 +205,11 @@ class ConfigSetRequest(BaseModel):
 @app.post("/config_set")
 async def config_set(request: ConfigSetRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
     cfgname = request.cfgname
     section = request.section
     values = request.values
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.config_set(cfgname, section, values)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "config_set", cfgname, section, values)
+    return {"result": result}
 
 class AddUserRequest(BaseModel):
     gwid: str
@@ -227,27 +221,12 @@ class AddUserRequest(BaseModel):
 @app.post("/add_user_binding")
 async def add_user_binding(request: AddUserRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
     ip = request.ip
     user = request.user
     from_source = request.from_source
     expire = request.expire
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.add_user(ip, user, from_source, expire)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "add_user", ip, user, from_source, expire)
+    return {"result": result}
 
 class RmUserRequest(BaseModel):
     gwid: str
@@ -257,24 +236,8 @@ class RmUserRequest(BaseModel):
 async def rm_user(request: RmUserRequest):
     gwid = request.gwid
     user = request.user
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.rm_user(user)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "rm_user", user)
+    return {"result": result}
 
 class AddVirtualGroupRequest(BaseModel):
     gwid: str
@@ -288,23 +251,8 @@ async def add_virtual_group(request: AddVirtualGroupRequest):
     groupid = request.groupid
     ip = request.ip
     minutes = request.minutes
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.add_virtual_group(groupid, ip, minutes)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "add_virtual_group", groupid, ip, minutes)
+    return {"result": result}
 
 class RmVirtualGroupRequest(BaseModel):
     gwid: str
@@ -320,17 +268,17 @@ class RmVirtualGroupRequest(BaseModel):
 #     username = gw.data[0].get('username')
 #     password = gw.data[0].get('password')
 #     address = gw.data[0].get('address')
-#     sdk = SDK()
+#     sdk = AsyncSDK()
 #     try:
-#         if sdk.login(address, username, password):
-#             result = sdk.rm_virtual_group(ip)
+#         if await sdk.login(address, username, password):
+#             result = await sdk.rm_virtual_group(ip)
 #             return {"result": result}
 #         else:
 #             raise HTTPException(status_code=401, detail="登录失败")
 #     except Exception as e:
 #         raise HTTPException(status_code=400, detail=str(e))
 #     finally:
-#         sdk.logout()
+#         await sdk.logout()
 
 class NetworkRequest(BaseModel):
     gwid: str
@@ -338,65 +286,20 @@ class NetworkRequest(BaseModel):
 @app.post("/get_network_interfaces")
 async def get_network_interfaces(request: NetworkRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            interfaces = sdk.get_network_interfaces()
-            return {"interfaces": interfaces}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    interfaces = await dispatch(gwid, "get_network_interfaces")
+    return {"interfaces": interfaces}
 
 @app.post("/get_network_status")
 async def get_network_status(request: NetworkRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            status = sdk.get_network_status()
-            return {"status": status}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    status = await dispatch(gwid, "get_network_status")
+    return {"status": status}
 
 @app.post("/list_group")
 async def list_group(request: NetworkRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            groups = sdk.list_group()
-            return {"groups": groups}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    groups = await dispatch(gwid, "list_group")
+    return {"groups": groups}
 
 
 class ListBandWidthRequest(BaseModel):
@@ -407,23 +310,8 @@ class ListBandWidthRequest(BaseModel):
 async def list_bandwidth(request: ListBandWidthRequest):
     gwid = request.gwid
     seconds = request.seconds
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            bandwidth = sdk.list_bandwidth(seconds)
-            return {"bandwidth": bandwidth}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    bandwidth = await dispatch(gwid, "list_bandwidth", seconds)
+    return {"bandwidth": bandwidth}
 
 class ListOnlineUsersRequest(BaseModel):
     gwid: str
@@ -435,23 +323,8 @@ async def list_online_users(request: ListOnlineUsersRequest):
     gwid = request.gwid
     top = request.top
     search = request.search
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            online_users = sdk.list_online_users(top, search)
-            return {"online_users": online_users}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    online_users = await dispatch(gwid, "list_online_users", top, search)
+    return {"online_users": online_users}
 
 class ListOnlineConnectionsRequest(BaseModel):
     gwid: str
@@ -461,23 +334,8 @@ class ListOnlineConnectionsRequest(BaseModel):
 async def list_online_connections(request: ListOnlineConnectionsRequest):
     gwid = request.gwid
     ip = request.ip
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            online_connections = sdk.list_online_connections(ip)
-            return {"online_connections": online_connections}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    online_connections = await dispatch(gwid, "list_online_connections", ip)
+    return {"online_connections": online_connections}
 
 class KillConnectionRequest(BaseModel):
     gwid: str
@@ -495,23 +353,8 @@ async def kill_connection(request: KillConnectionRequest):
     type = request.type
     minutes = request.minutes
     message = request.message
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.kill_connection(ip, port, type, minutes, message)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "kill_connection", ip, port, type, minutes, message)
+    return {"result": result}
 
 class ConfigAddRequest(BaseModel):
     gwid: str
@@ -527,23 +370,8 @@ async def config_add(request: ConfigAddRequest):
     type = request.type
     name = request.name
     values = request.values
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.config_add(cfgname, type, name, values)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "config_add", cfgname, type, name, values)
+    return {"result": result}
 
 class ConfigDelRequest(BaseModel):
     gwid: str
@@ -555,72 +383,33 @@ async def config_del(request: ConfigDelRequest):
     gwid = request.gwid
     cfgname = request.cfgname
     section = request.section
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.config_del(cfgname, section)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "config_del", cfgname, section)
+    return {"result": result}
 
 @app.post("/config_apply")
 async def config_apply(request: NetworkRequest):
     gwid = request.gwid
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.config_apply()
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    result = await dispatch(gwid, "config_apply")
+    return {"result": result}
 
 class QueryDbRequest(BaseModel):
     gwid: str
     dbname: str
     querysql: str
+    # 流式返回的格式：ndjson或者csv，为空时一次性返回
+    format: str | None = None
+    # 用于解析每一行的表名称，为空时从querysql中推断
+    table: str | None = None
 
 @app.post("/query_db")
 async def query_db(request: QueryDbRequest):
     gwid = request.gwid
     dbname = request.dbname
     querysql = request.querysql
-    gw = await get_gateway_by_id(gwid)
-    if gw is None or len(gw.data) == 0:
-        raise HTTPException(status_code=400, detail="gateway not found")
-    username = gw.data[0].get('username')
-    password = gw.data[0].get('password')
-    address = gw.data[0].get('address')
-    sdk = SDK()
-    try:
-        if sdk.login(address, username, password):
-            result = sdk.query_db(dbname, querysql)
-            return {"result": result}
-        else:
-            raise HTTPException(status_code=401, detail="登录失败")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
+    if request.format is not None:
+        return await stream_query_db(gwid, dbname, querysql, request.format, request.table)
+    result = await dispatch(gwid, "query_db", dbname, querysql)
+    return {"result": result}
 
 class LoginRequest(BaseModel):
     username: str
@@ -1,5 +1,6 @@
-from neo4j import GraphDatabase, exceptions
+from neo4j import GraphDatabase, Query, exceptions
 import os
+from .deadline import timeout_for
 
 class Neo4jConnection:
     def __init__(self, uri, user, password):
@@ -18,10 +19,12 @@ class Neo4jConnection:
         :return: 查询结果列表
         """
         results = []
+        # 事务超时取请求剩余的时间，时间已经用完时直接抛出DeadlineExceeded
+        timeout = timeout_for(None)
         try:
             with self.driver.session() as session:
                 # 执行查询
-                result = session.run(query, parameters)
+                result = session.run(Query(query, timeout=timeout), parameters)
                 # 处理结果
                 for record in result:
                     results.append(record.data())
@@ -48,11 +51,12 @@ class Neo4jConnection:
         RETURN g.id AS id, g.ratio AS ratio
         """
         
+        timeout = timeout_for(None)
         try:
             with self.driver.session() as session:
                 # 执行参数化查询
                 result = session.run(
-                    query, 
+                    Query(query, timeout=timeout),
                     id=gateway_id,  # 传递参数
                     ratio=ratio
                 )
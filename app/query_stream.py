@@ -0,0 +1,248 @@
+import codecs
+import csv
+import io
+import json
+import re
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from .supabase import meta_for_table_name, build_dict_from_line
+from .sdk import is_access_denied
+
+# stdout之前的内容最多缓存多少字符，用于在没有stdout时解析错误信息
+MAX_PREFIX = 65536
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+_STDOUT_MARKER = re.compile(r'"stdout"\s*:\s*"')
+
+_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+class StdoutLineExtractor:
+    """
+    从querydb的json返回中增量地取出stdout字段，按行返回。
+    返回格式为{"result": [0, {"stdout": "a|b|\\nc|d|\\n"}]}，stdout是一个json字符串，
+    这里逐字符解码json转义，只保留当前未结束的一行，内存占用与结果大小无关
+    """
+    def __init__(self):
+        self.state = "search"
+        self.prefix = ""
+        self.line = []
+        self.pending = ""
+        self.high_surrogate = None
+
+    @property
+    def found(self):
+        return self.state != "search"
+
+    def _decode_unicode(self, code):
+        if 0xD800 <= code <= 0xDBFF:
+            self.high_surrogate = code
+            return ""
+        if 0xDC00 <= code <= 0xDFFF and self.high_surrogate is not None:
+            code = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self.high_surrogate = None
+        return chr(code)
+
+    def feed(self, text):
+        """
+        输入一段文本，返回其中完整的行
+        """
+        lines = []
+        if self.state == "search":
+            self.prefix += text
+            m = _STDOUT_MARKER.search(self.prefix)
+            if m is None:
+                # 标记可能被分在两段中，只保留末尾的一小段继续查找
+                if len(self.prefix) > MAX_PREFIX:
+                    self.prefix = self.prefix[-MAX_PREFIX:]
+                return lines
+            text = self.prefix[m.end():]
+            self.prefix = self.prefix[:m.start()]
+            self.state = "string"
+        if self.state == "done":
+            return lines
+        text = self.pending + text
+        self.pending = ""
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c == '"':
+                self.state = "done"
+                break
+            if c == '\\':
+                if i + 1 >= n:
+                    self.pending = text[i:]
+                    break
+                e = text[i + 1]
+                if e == 'u':
+                    if i + 6 > n:
+                        self.pending = text[i:]
+                        break
+                    c = self._decode_unicode(int(text[i + 2:i + 6], 16))
+                    i += 6
+                else:
+                    c = _ESCAPES.get(e, e)
+                    i += 2
+            else:
+                i += 1
+            if c == '\n':
+                lines.append("".join(self.line))
+                self.line = []
+            elif c:
+                self.line.append(c)
+        return lines
+
+    def finish(self):
+        """
+        结束输入，返回最后一行（没有换行结尾时）
+        """
+        if len(self.line) > 0:
+            line = "".join(self.line)
+            self.line = []
+            return [line]
+        return []
+
+def guess_table_name(sql):
+    """
+    从sql中取出FROM后面的表名称
+    """
+    m = re.search(r'\bfrom\s+([A-Za-z0-9_]+)', sql or "", re.IGNORECASE)
+    if m is None:
+        return None
+    return m.group(1)
+
+def split_line(line):
+    """
+    a|b|c| -> ["a", "b", "c"]
+    """
+    fields = line.split("|")
+    if len(fields) > 0 and fields[-1] == "":
+        fields = fields[:-1]
+    return fields
+
+class QueryLineStream:
+    """
+    流式执行querydb，逐行返回stdout中的内容。
+    open()读到stdout开始的位置为止，这样网关的错误可以在开始返回结果之前变成正常的http错误
+    """
+    def __init__(self, sdk, dbname, sql):
+        self.sdk = sdk
+        self.dbname = dbname
+        self.sql = sql
+        self.chunks = None
+        self.ready = []
+        self.eof = False
+
+    async def _start(self):
+        """
+        开始一次请求，读到stdout为止；没有stdout时返回解析出的错误信息
+        """
+        if self.chunks is not None:
+            await self.chunks.aclose()
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.extractor = StdoutLineExtractor()
+        self.chunks = self.sdk.stream_query_db(self.dbname, self.sql)
+        self.ready = []
+        self.eof = False
+        async for chunk in self.chunks:
+            self.ready.extend(self.extractor.feed(self.decoder.decode(chunk)))
+            if self.extractor.found:
+                return None
+        self.eof = True
+        self.ready.extend(self.extractor.feed(self.decoder.decode(b"", final=True)))
+        if self.extractor.found:
+            return None
+        try:
+            return json.loads(self.extractor.prefix)
+        except Exception:
+            return {"error": {"message": self.extractor.prefix[:200]}}
+
+    async def open(self):
+        response = await self._start()
+        if response is not None and self.sdk.on_access_denied is not None and is_access_denied(response):
+            # session已经失效：重新登录后重试一次
+            self.sdk.session_id = await self.sdk.on_access_denied()
+            response = await self._start()
+        if response is not None:
+            await self.chunks.aclose()
+            raise HTTPException(status_code=400, detail=str(response))
+
+    async def lines(self):
+        try:
+            for line in self.ready:
+                yield line
+            self.ready = []
+            if not self.eof:
+                async for chunk in self.chunks:
+                    for line in self.extractor.feed(self.decoder.decode(chunk)):
+                        yield line
+                for line in self.extractor.feed(self.decoder.decode(b"", final=True)):
+                    yield line
+            for line in self.extractor.finish():
+                yield line
+        finally:
+            await self.chunks.aclose()
+
+async def iter_query_rows(stream, meta):
+    """
+    逐行解析querydb的结果：有表结构时返回dict，没有时返回字段列表
+    """
+    async for line in stream.lines():
+        if line == "":
+            continue
+        if meta is None:
+            yield split_line(line)
+        else:
+            yield build_dict_from_line(meta, line)
+
+async def iter_ndjson(rows):
+    async for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+async def iter_csv(rows, meta):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    columns = None
+    if meta is not None:
+        columns = split_line(meta)
+        writer.writerow(columns)
+    async for row in rows:
+        if isinstance(row, dict):
+            writer.writerow([row.get(c, "") for c in columns])
+        else:
+            writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell() > 0:
+        yield buf.getvalue()
+
+async def stream_query_response(sdk, dbname, sql, fmt, table_name=None):
+    """
+    把querydb的结果以NDJSON或者CSV流式返回，不在内存中缓存整个结果
+    table_name为空时从sql中推断，用于按meta_for_table_name解析每一行
+    """
+    if fmt not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {fmt}")
+    meta = meta_for_table_name(table_name or guess_table_name(sql))
+    stream = QueryLineStream(sdk, dbname, sql)
+    await stream.open()
+    rows = iter_query_rows(stream, meta)
+    if fmt == "csv":
+        body = iter_csv(rows, meta)
+    else:
+        body = iter_ndjson(rows)
+    return StreamingResponse(body, media_type=STREAM_FORMATS[fmt])
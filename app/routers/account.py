@@ -4,7 +4,7 @@ from app.supabase import supabase
 from app.utils import get_gateway_by_id
 from pydantic import BaseModel,ConfigDict
 from fastapi.encoders import jsonable_encoder
-from app.sdk import SDK
+from app.gw_session import session_manager
 account = APIRouter()
 
 class AccountRequest(BaseModel):
@@ -19,17 +19,15 @@ async def list_account(request: AccountRequest):
     username = gw.data[0].get('username')
     password = gw.data[0].get('password')
     address = gw.data[0].get('address')
-    sdk = SDK()
     try:
-        if sdk.login(address, username, password):
-            accounts = sdk.list_account()
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
+            accounts = await sdk.list_account()
             return {"accounts": accounts}
         else:
             raise HTTPException(status_code=401, detail="登录失败")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
 
 # 将list_account获得的结果，同步到supabase
 @account.post("/sync_account", tags=["account"])
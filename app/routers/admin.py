@@ -4,6 +4,9 @@ from pydantic import BaseModel
 from typing import List, Any
 from ..utils import is_empty
 from app.supabase import supabase
+from app.gw_cache import rpc_cache
+from app.gw_scheduler import get_scheduler
+from app.gw_breaker import gateway_breakers
 admin_router = APIRouter()
 
 
@@ -128,4 +131,52 @@ async def update_user_gws(query: UpdateUserGwsQuery, current_user: UserBase = De
   print(f"[update_user_gws]prepare to append data: f{str(data)}")
   res = supabase.table(TABLE_NAME).upsert(data).execute()
   print(f"[update_user_gws]successfully update user gws: res = f{str(res)}")
-  return { "data": res.data }
\ No newline at end of file
+  return { "data": res.data }
+
+@admin_router.post("/get_gateway_cache_stats", tags=["admin"])
+async def get_gateway_cache_stats(current_user: UserBase = Depends(super_admin_required)):
+  """
+  超级管理员专属调用
+  获取网关rpc缓存的命中、未命中、过期命中和淘汰次数
+  """
+  return {"data": rpc_cache.snapshot()}
+
+class ClearGatewayCacheQuery(BaseModel):
+  gwid: str | None = None
+
+@admin_router.post("/clear_gateway_cache", tags=["admin"])
+async def clear_gateway_cache(query: ClearGatewayCacheQuery, current_user: UserBase = Depends(super_admin_required)):
+  """
+  超级管理员专属调用
+  清空网关rpc缓存，gwid为空时清空全部
+  """
+  rpc_cache.invalidate(query.gwid)
+  return {"data": rpc_cache.snapshot()}
+
+@admin_router.post("/get_gateway_scheduler_stats", tags=["admin"])
+async def get_gateway_scheduler_stats(current_user: UserBase = Depends(super_admin_required)):
+  """
+  超级管理员专属调用
+  获取每个网关正在进行和排队中的rpc数量
+  """
+  return {"data": get_scheduler().snapshot()}
+
+@admin_router.post("/get_gateway_breakers", tags=["admin"])
+async def get_gateway_breakers(current_user: UserBase = Depends(super_admin_required)):
+  """
+  超级管理员专属调用
+  获取每个网关熔断器的状态(closed/open/half_open)和连续失败次数
+  """
+  return {"data": gateway_breakers.snapshot()}
+
+class ResetGatewayBreakerQuery(BaseModel):
+  gwid: str | None = None
+
+@admin_router.post("/reset_gateway_breaker", tags=["admin"])
+async def reset_gateway_breaker(query: ResetGatewayBreakerQuery, current_user: UserBase = Depends(super_admin_required)):
+  """
+  超级管理员专属调用
+  重置网关的熔断器，gwid为空时重置全部
+  """
+  gateway_breakers.reset(query.gwid)
+  return {"data": gateway_breakers.snapshot()}
@@ -5,6 +5,8 @@ from app.supabase import supabase
 from pydantic import BaseModel,ConfigDict
 from fastapi.encoders import jsonable_encoder
 from ..utils import get_device_count, gw_login, get_gws_device_count, get_ratio_by_gwid, is_online, starts_with_number, ping_multi_hosts, is_valid_ipv4, ping, normalize_traffic
+from app.gw_registry import gateway_registry
+from app.gw_session import session_manager
 from .auth import UserBase, get_current_user, get_user_auth_gateways, is_super_admin
 router = APIRouter()
 
@@ -320,6 +322,9 @@ async def create_gateway(gw: Gateway, current_user: UserBase = Depends(get_curre
         "online": "false",
         "fleet": gw.fleet,
     }).execute()
+    # 新建的网关直接放入网关缓存
+    for row in res.data:
+        gateway_registry.put(row)
     return res
 
 
@@ -332,6 +337,9 @@ async def delete_gateway(gwid: str, current_user: UserBase = Depends(get_current
     if not is_super_admin(current_user):
         raise HTTPException(status_code=401, detail="无权限访问该接口。")
     res = supabase.table('gateway').delete().eq('id', gwid).execute()
+    # 清除网关缓存和已登录的session
+    gateway_registry.invalidate(gwid)
+    session_manager.invalidate(gwid)
     return res
 
 @router.post("/fetch_gwids", tags=["gateway"])
@@ -359,6 +367,9 @@ async def update_gateway(gwid: str, gw: Gateway, current_user: UserBase = Depend
     update_gw_encoded = jsonable_encoder(gw)
     print("== update_gw_encoded: ", update_gw_encoded)
     res = supabase.table('gateway').update(update_gw_encoded).eq('id', gwid).execute()
+    # 地址或账号可能已经改变，清除网关缓存和已登录的session
+    gateway_registry.invalidate(gwid)
+    session_manager.invalidate(gwid)
     return res
     
 # creation
@@ -366,4 +377,6 @@ async def update_gateway(gwid: str, gw: Gateway, current_user: UserBase = Depend
 async def create_gateway(gw: Gateway):
     gw_json = jsonable_encoder(gw)
     res = supabase.table('gateway').insert(gw_json).execute()
+    for row in res.data:
+        gateway_registry.put(row)
     return res
\ No newline at end of file
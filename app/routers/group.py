@@ -5,7 +5,7 @@ from app.supabase import supabase, to_date
 import uuid
 from ..sdk import SDK
 from ..task import TaskRequest, run_single_task
-from ..utils import str_strip, is_empty, is_not_empty, batch_update_users_group, batch_update_gw_group, get_basic_rpc_result, gw_login, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
+from ..utils import str_strip, is_empty, is_not_empty, batch_update_users_group, batch_update_gw_group, get_basic_rpc_result, async_gw_login, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
 from pydantic import BaseModel
 from datetime import datetime
 import json
@@ -34,35 +34,40 @@ def get_virtual(v):
     else:
         return virtual
 
-def get_gw_group_impl(gwid:str):
-    with gw_login(gwid) as sdk_obj:
+def parse_gw_groups(gwid:str, p):
+    """
+    将wfilter-groups配置的values解析为组列表
+    """
+    result = []
+    for k, v in p.items():
+        item_type = v.get(".type")
+        if item_type == "group":
+            val = {
+                "gwid": gwid,
+                "id": v.get("id"),
+                "aliaz_en_us": v.get("aliaz_en_us"),
+                "alias_zh_cn": v.get("alias_zh_cn"),
+                "index": v.get(".index"),
+                "anonymous": v.get(".anonymous"),
+                "type": v.get(".type"),
+                "alias": get_group_alias(v),
+                "virtual": get_virtual(v),
+                "global_id": f"{gwid}_{v.get('id')}",
+                "name": v.get(".name"),
+            }
+            result.append(val)
+    return result
+
+async def get_gw_group_impl(gwid:str):
+    async with async_gw_login(gwid) as sdk_obj:
         # 读取配置文件wfilter-isp
         config_key ="wfilter-groups"
-        p = sdk_obj.config_load(config_key)
+        p = await sdk_obj.config_load(config_key)
         p = get_basic_rpc_result(p)
         if p is None:
             return {}
         else:
-            p = p["values"]
-            result = []
-            for k, v in p.items():
-                item_type = v.get(".type")
-                if item_type == "group":
-                    val = {
-                        "gwid": gwid,
-                        "id": v.get("id"),
-                        "aliaz_en_us": v.get("aliaz_en_us"),
-                        "alias_zh_cn": v.get("alias_zh_cn"),
-                        "index": v.get(".index"),
-                        "anonymous": v.get(".anonymous"),
-                        "type": v.get(".type"),
-                        "alias": get_group_alias(v),
-                        "virtual": get_virtual(v),
-                        "global_id": f"{gwid}_{v.get('id')}",
-                        "name": v.get(".name"),
-                    }
-                    result.append(val)
-            return result
+            return parse_gw_groups(gwid, p["values"])
         
 @group.post("/get_gw_group", tags=["group"])
 async def get_gw_group(query: GetGWGroupParam):
@@ -74,7 +79,7 @@ async def get_gw_group(query: GetGWGroupParam):
     gwid = query.gwid
     result = []
     if is_not_empty(gwid):
-        result = get_gw_group_impl(gwid)
+        result = await get_gw_group_impl(gwid)
     else:
         # 使用supabase获取所有的group和网关
         r = supabase.table("gw_groups").select("*").execute()
@@ -100,7 +105,7 @@ class TestBatchSyncGroups(BaseModel):
     gwid: str
 
 async def batch_sync_group_task(gwid: str):
-    group_list = get_gw_group_impl(gwid)
+    group_list = await get_gw_group_impl(gwid)
     print("group_list = ", group_list)
     response = batch_update_gw_group(group_list)
     return { "data": response }
@@ -141,40 +146,56 @@ def decode_username(username):
     # 都没有匹配，返回空字符串
     return ""
 
+def parse_virtual_group_users(gwid: str, group, result):
+    """
+    将一个组的list_virtual_group结果解析为用户和组的关系列表
+    """
+    global_id = group.get("global_id")
+    # 使用list_virtual_group来获取组关联的用户
+    r = get_basic_rpc_result(result)
+    r = str_strip(r.get("result"))
+    r = json.loads(r)
+    # 打印r的信息
+    print(f"list_user_with_groups: Users in group {global_id}: {r}")
+    data = []
+    # 获取users，对于users数组中的每一个项遍历
+    for user in r.get("users") or []:
+        userid = user.get("user")
+        userid = decode_username(userid)
+        u = {
+            "gwid": gwid,
+            "userid": userid,
+            "groupid": group.get("id"),
+            "group_global_id": global_id,
+            "group_name": get_group_alias(group)
+        }
+        data.append(u)
+    return data
+
 async def list_user_with_groups_impl(gwid: str):
     #1. 使用get_gw_group_impl获取已有的组信息
-    group_list = get_gw_group_impl(gwid)
+    group_list = await get_gw_group_impl(gwid)
     #2. 设置返回值为data,一个空数组
     data = []
+    if len(group_list) == 0:
+        return data
+    # 登录一次，所有组的list_virtual_group合并为一次批量请求
+    async with async_gw_login(gwid) as sdk_obj:
+        batch = sdk_obj.batch()
+        for group in group_list:
+            batch.list_virtual_group(group.get("id"))
+        results = await batch.execute()
     # 对于group_list中每个组信息遍历
-    for group in group_list:
+    for group, result in zip(group_list, results):
         global_id = group.get("global_id")
         alias = get_group_alias(group)
         group_id = group.get("id")
         # 打印debug信息
         print(f"list_user_with_groups: Processing group: {global_id}, alias: {alias}, id: {group_id}")
-        # 使用list_virtual_group来获取组关联的用户
-        with gw_login(gwid) as sdk_obj:
-            result = sdk_obj.list_virtual_group(group_id)
-            r = get_basic_rpc_result(result)
-            r = str_strip(r.get("result"))
-            r = json.loads(r)
-            # 打印r的信息
-            print(f"list_user_with_groups: Users in group {global_id}: {r}")
-            # 获取users
-            users = r.get("users")
-            # 对于users数组中的每一个项遍历
-            for user in users:
-                userid = user.get("user")
-                userid = decode_username(userid)
-                u = {
-                    "gwid": gwid,
-                    "userid": userid,
-                    "groupid": group_id,
-                    "group_global_id": global_id,
-                    "group_name": alias
-                }
-                data.append(u)
+        if result["error"] is not None:
+            print(f"list_user_with_groups: list_virtual_group failed, group = {global_id}, error = {result['error']}")
+            continue
+        data.extend(parse_virtual_group_users(gwid, group, result["result"]))
     # 打印data的信息
     print(f"list_user_with_groups: Final data: {data}")
     return data
@@ -234,7 +255,7 @@ async def update_user_group(query: UpdateUserGroupQuery):
     返回值：
     1. {”data”: “success”}
     """
-    return update_user_group_impl(query)
+    return await update_user_group_impl(query)
 
 @group.post("/remove_user_group", tags=["group"])
 async def remove_user_group(query: RemoveUserGroupQuery):
@@ -243,4 +264,4 @@ async def remove_user_group(query: RemoveUserGroupQuery):
     输入参数：gwid=网关id
     输入参数:username=用户名称
     """
-    return remove_user_group_impl(query)
\ No newline at end of file
+    return await remove_user_group_impl(query)
\ No newline at end of file
@@ -1,7 +1,7 @@
 import urllib
 from fastapi import HTTPException
 from pydantic import BaseModel
-from ..utils import is_empty, batch_update_users_group, batch_update_gw_group, get_basic_rpc_result, gw_login, normalize_traffic, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
+from ..utils import is_empty, batch_update_users_group, batch_update_gw_group, get_basic_rpc_result, async_gw_login, normalize_traffic, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
 from app.supabase import supabase, to_date
 
 
@@ -24,7 +24,7 @@ class RemoveUserGroupQuery(BaseModel):
     gwid: str
     username: str
 
-def remove_user_group_impl(query:RemoveUserGroupQuery):
+async def remove_user_group_impl(query:RemoveUserGroupQuery):
     """
     将用户移除出所有虚拟组
     输入1：gwid=网关id
@@ -37,9 +37,9 @@ def remove_user_group_impl(query:RemoveUserGroupQuery):
         raise HTTPException(status_code=400, detail="[remove_user_group_impl]:invalid gwid or username")
     # 记录日志
     print(f"[remove_user_group_impl]: gwid = {gwid}, username = {username}")
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         print(f"[remove_user_group_impl]: encode_username = f{username}")
-        result = sdk_obj.rm_virtual_group(encode_username(username))
+        result = await sdk_obj.rm_virtual_group(encode_username(username))
         print(f"[remove_user_group_impl]: rm_virtual_group result = {result}")
         resp = clear_supabase_user_virtual_group(gwid, username)
         print(f"[remove_user_group_impl]: clear supabase user virtual group, gwid = {gwid}, username = {username}, resp = {str(resp)}")
@@ -65,7 +65,7 @@ class UpdateUserGroupQuery(BaseModel):
     username: str
     groupid: str | None
 
-def update_user_group_impl(query: UpdateUserGroupQuery):
+async def update_user_group_impl(query: UpdateUserGroupQuery):
     gwid = query.gwid
     username = query.username
     groupid = query.groupid
@@ -76,9 +76,9 @@ def update_user_group_impl(query: UpdateUserGroupQuery):
     if len(groupid) <= 0:
         action_remove = True
 
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         # 1. 首先调用remove_virtual_group移除用户的所有组，然后apply
-        result = sdk_obj.rm_virtual_group(encode_username(username))
+        result = await sdk_obj.rm_virtual_group(encode_username(username))
         print(f"update_user_group: rm_virtual_group result = {result}")
         
         # 3. 然后调用add_virtual_group增加指定组，然后apply
@@ -88,7 +88,7 @@ def update_user_group_impl(query: UpdateUserGroupQuery):
             # name = encode_username(username)
             name = f"CN={username},DC=wflocal"
             print(f"start calling add_virtual_group, groupid = {groupid}, name = {name}, timeout = {timeout}")
-            result = sdk_obj.add_virtual_group(groupid, name, timeout)
+            result = await sdk_obj.add_virtual_group(groupid, name, timeout)
             print(f"update_user_group: add_virtual_group result = {result}")
         # 4. 将组内容增加到gw_users的virtual_group列
         TABLENAME = "gw_users"
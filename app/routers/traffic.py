@@ -1,17 +1,15 @@
 from fastapi import APIRouter, HTTPException, BackgroundTasks, UploadFile
-import luigi
 import csv
 import codecs
 from app.supabase import supabase, to_date
 import uuid
-from ..sdk import SDK
 from ..task import TaskRequest, run_single_task
-from ..utils import get_ratio_by_gwid, get_digits, str2float, get_unit_from_format, parse_int, is_empty, is_not_empty, batch_update_gw_strategy, get_basic_rpc_result, gw_login, normalize_traffic, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
+from ..utils import get_ratio_by_gwid, get_digits, str2float, get_unit_from_format, parse_int, is_empty, is_not_empty, batch_update_gw_strategy, get_basic_rpc_result, async_gw_login, normalize_traffic, get_date_obj_from_str, get_start_of_month, get_end_of_month, get_date
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 import json
 import pandas as pd
-from ..tasks.sync_user import SyncGwUsers, ReadGwUsers 
+from ..sync_queue import sync_queue, JOB_USERS
 from .group_service import remove_user_group_impl, RemoveUserGroupQuery
 traffic = APIRouter()
 
@@ -82,31 +80,36 @@ def get_traffic_total(data):
         total += sub
     return total
     
+def parse_bandwidth_strategies(gwid:str, p):
+    """
+    将wfilter-isp配置的values解析为带宽策略列表
+    """
+    result = []
+    for k, v in p.items():
+        item_type = v.get(".type")
+        if item_type == "bandwidth":
+            val = {
+                "gwid": gwid,
+                "period": v.get("period"),
+                "threshold": v.get("threshold"),
+                "exceed": v.get("exceed"),
+                "id": v.get("id"),
+                "remark": v.get("remark")
+            }
+            result.append(val)
+    return result
+
 @traffic.post("/get_bandwidth_strategy_impl", tags=["traffic"])
-def get_bandwidth_strategy_impl(gwid:str):
-    with gw_login(gwid) as sdk_obj:
+async def get_bandwidth_strategy_impl(gwid:str):
+    async with async_gw_login(gwid) as sdk_obj:
         # 读取配置文件wfilter-isp
         config_key ="wfilter-isp"
-        p = sdk_obj.config_load(config_key)
+        p = await sdk_obj.config_load(config_key)
         p = get_basic_rpc_result(p)
         if p is None:
             return { "data": [] }
         else:
-            p = p["values"]
-            result = []
-            for k, v in p.items():
-                item_type = v.get(".type")
-                if item_type == "bandwidth":
-                    val = {
-                        "gwid": gwid,
-                        "period": v.get("period"),
-                        "threshold": v.get("threshold"),
-                        "exceed": v.get("exceed"),
-                        "id": v.get("id"),
-                        "remark": v.get("remark")
-                    }
-                    result.append(val)
-            return result
+            return parse_bandwidth_strategies(gwid, p["values"])
 
 def aggregate_gw_user_traffic_view(gwid, response, format):
     """
@@ -265,7 +268,7 @@ async def get_bandwidth_strategy(query: GetbandwidthStrategyParam):
     gwid = query.gwid
     result = []
     if is_not_empty(gwid):
-        result = get_bandwidth_strategy_impl(gwid)
+        result = await get_bandwidth_strategy_impl(gwid)
     else:
         # 从gw_bandwidth_strategy表中读取所有的策略
         TABLE_NAME = "gw_bandwidth_strategy"
@@ -289,7 +292,7 @@ class TestBatchSyncStrategy(BaseModel):
 @traffic.post("/test_batch_sync_strategy", tags=["test"])
 async def test_batch_sync_strategy(query: TestBatchSyncStrategy):
     gwid = query.gwid
-    strategy_list = get_bandwidth_strategy_impl(gwid)
+    strategy_list = await get_bandwidth_strategy_impl(gwid)
     print("strategy_list = ", strategy_list)
     response = batch_update_gw_strategy(strategy_list)
     return { "data": response }
@@ -309,7 +312,7 @@ async def batch_remove_strategy(gwid:str):
 @traffic.post("/batch_sync_strategy", tags=["traffic"])
 async def batch_sync_strategy(query: TestBatchSyncStrategy):
     gwid = query.gwid
-    strategy_list = get_bandwidth_strategy_impl(gwid)
+    strategy_list = await get_bandwidth_strategy_impl(gwid)
     print("strategy_list = ", strategy_list)
     # 在同步之前，先去掉现有的strategy
     await batch_remove_strategy(gwid)
@@ -398,7 +401,7 @@ def fetch_user_sid(gwid:str, userid:str):
         return {"sid": "", "username": ""}
 
 async def update_user_traffic_strategy_impl(gwid:str, userid:str, sid: str):
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         # $values = "{\"enabled\":\"false\"}";    //把规则状态改成不启用
         # $result = $ngf->config_set( "wfilter-appcontrol",  "rule12345", $values );
         # echo "config_set:$result";
@@ -406,9 +409,9 @@ async def update_user_traffic_strategy_impl(gwid:str, userid:str, sid: str):
         cfgname = "wfilter-account"
         section = userid
         values = {"remark": build_remark(sid)}
-        result = sdk_obj.config_set(cfgname, section, values)
+        result = await sdk_obj.config_set(cfgname, section, values)
         # 应用配置更新
-        sdk_obj.config_apply()
+        await sdk_obj.config_apply()
 
         # 获取用户的sid
         # old_sid = await fetch_user_sid(gwid, userid)
@@ -431,12 +434,9 @@ async def update_user_traffic_strategy_impl(gwid:str, userid:str, sid: str):
         await insert_user_strategy_logs(gwid, userid, old_sid, sid)
         # 将用户的虚拟组清理
         print("[update_user_traffic_strategy_impl] remove_user_group, gwid = {gwid}, username = {username}")
-        remove_user_group_impl(RemoveUserGroupQuery(gwid=gwid, username=username))
-        # 启动luigi任务，同步用户表到supabase
-        tasks = [
-            SyncGwUsers(gwid=gwid),
-        ]
-        luigi.build(tasks, local_scheduler=True)
+        await remove_user_group_impl(RemoveUserGroupQuery(gwid=gwid, username=username))
+        # 在后台从网关读取用户表并同步到supabase
+        sync_queue.submit(gwid, JOB_USERS)
         return { "data": result }
 
 @traffic.post("/update_user_traffic_strategy", tags=["traffic"])
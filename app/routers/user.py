@@ -1,7 +1,6 @@
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 from app.supabase import supabase
-from ..sdk import SDK
-from ..utils import is_future_date, yyyymmdd, get_milliseconds, gw_login, get_gateway_by_id, gw_login
+from ..utils import is_future_date, yyyymmdd, get_milliseconds, async_gw_login, get_gateway_by_id
 from .group_service import update_user_group_impl, UpdateUserGroupQuery
 from pydantic import BaseModel
 import json
@@ -153,7 +152,7 @@ async def add_user(param: AddUserParam):
     remark = f"ISP-1-{sid}"
     ret = None
     user_id = gen_user_id()
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         cfgname = 'wfilter-account'
         type = 'wfuser'
         value = {
@@ -176,9 +175,9 @@ async def add_user(param: AddUserParam):
         # 打印value
         print("add_user: value = " + str(value))
         # 调用sdk
-        result1 = sdk_obj.config_add(cfgname, type, user_id, value)
+        result1 = await sdk_obj.config_add(cfgname, type, user_id, value)
         print("result1 = " + str(result1))
-        result2 = sdk_obj.config_apply()
+        result2 = await sdk_obj.config_apply()
         print("result2 = " + str(result2))
         # 最终结果赋值
         ret = value
@@ -209,7 +208,7 @@ async def add_user(param: AddUserParam):
     
     # 更新group_id
     query = UpdateUserGroupQuery(gwid=gwid, username=username, groupid=group_id)
-    update_user_group_impl(query)
+    await update_user_group_impl(query)
     return {"data": ret}
 
 class DeleteUserParam(BaseModel):
@@ -252,17 +251,17 @@ async def delete_user(param: DeleteUserParam):
         raise HTTPException(status_code=400, detail="用户名不存在")
     # 2. 登陆sdk
     gwid = param.gwid
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         user_info = get_user_info_by_gwid_username(gwid, param.username)
         if sdk_obj is None:
             raise HTTPException(status_code=400, detail="登录失败")
         # 3. 调用sdk.config_del删除相关内容
         cfgname = "wfilter-account"
         id = get_user_id_by_gwid_username(gwid, param.username)
-        result1 = sdk_obj.config_del(cfgname, id)
+        result1 = await sdk_obj.config_del(cfgname, id)
         print("result1 = " + str(result1))
         # 4. 调用sdk.config_apply实现修改
-        result2 = sdk_obj.config_apply()
+        result2 = await sdk_obj.config_apply()
         print("result2 = " + str(result2))
         # 5. 在supabase的gw_users表中，将username,id相关匹配到的行的删除标记置为true
         mark_user_as_deleted(gwid, param.username)
@@ -295,11 +294,11 @@ async def update_user_datelimit(param: UpdateUserDatelimitParam):
     cfgname = "wfilter-account"
     section = userid
     values = {"datelimit": datelimit}
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         print("update_user_datelimit: cfgname = {cfgname}, section = {section}, values = {values}")
-        result = sdk_obj.config_set(cfgname, section, values)
+        result = await sdk_obj.config_set(cfgname, section, values)
         # 应用配置更新
-        sdk_obj.config_apply()
+        await sdk_obj.config_apply()
     # 4. 更新supabase的gw_users表中的datelimit字段
     TABLE_NAME = "gw_users"
     r = {"datelimit": datelimit}
@@ -330,11 +329,11 @@ async def update_user_password(param: UpdateUserPasswordParam):
     cfgname = "wfilter-account"
     section = userid
     values = {"password": password}
-    with gw_login(gwid) as sdk_obj:
+    async with async_gw_login(gwid) as sdk_obj:
         print("update_user_password: cfgname = {cfgname}, section = {section}, values = {values}")
-        result = sdk_obj.config_set(cfgname, section, values)
+        result = await sdk_obj.config_set(cfgname, section, values)
         # 应用配置更新
-        sdk_obj.config_apply()
+        await sdk_obj.config_apply()
     # 4. 更新supabase的gw_users表中的datelimit字段
     # TABLE_NAME = "gw_users"
     # r = {"datelimit": password}
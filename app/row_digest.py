@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import json
+from .upstash import redis
+
+# 做变化检测的表：旧的行不再变化，只有当天的行在累加
+DIGEST_TABLES = {"hourreport", "acctreport", "ipreport", "webreport", "protocolreport"}
+# 摘要保存的天数，超过之后的行不会再被重新同步
+DIGEST_TTL = 40 * 86400
+# 摘要的长度（十六进制字符数）
+DIGEST_SIZE = 16
+
+def short_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=DIGEST_SIZE // 2).hexdigest()
+
+def row_hash(row):
+    return short_hash(json.dumps(row, sort_keys=True, ensure_ascii=False, default=str))
+
+class RowDigests:
+    """
+    每个(gwid, table, day)一个redis hash，记录已经写入supabase的行的摘要:
+    "starlink.sync.digest.<gwid>.<table>.<day>" = {hash(global_id): hash(row)}
+    filter()只返回新的或者内容变化的行，写入成功后commit()更新摘要；
+    force为True时（全量重建）不跳过任何行，只重新记录摘要
+    """
+    def __init__(self, gwid, table_name, column, force=False):
+        self.gwid = gwid
+        self.table_name = table_name
+        self.column = column
+        self.force = force
+        # day -> {field: digest}，同一次同步中每天只读取一次
+        self.days = {}
+
+    def _key(self, day):
+        return f"starlink.sync.digest.{self.gwid}.{self.table_name}.{day}"
+
+    def _day(self, row):
+        return str(row.get(self.column, ""))[:10]
+
+    def _load(self, day):
+        digests = self.days.get(day)
+        if digests is None:
+            digests = redis.hgetall(self._key(day)) or {}
+            self.days[day] = digests
+        return digests
+
+    def _filter(self, rows):
+        changed = []
+        pending = {}
+        for row in rows:
+            global_id = row.get("global_id")
+            if global_id is None:
+                changed.append(row)
+                continue
+            day = self._day(row)
+            field = short_hash(str(global_id))
+            digest = row_hash(row)
+            if not self.force and self._load(day).get(field) == digest:
+                continue
+            changed.append(row)
+            pending.setdefault(day, {})[field] = digest
+        return changed, pending
+
+    def _commit(self, pending):
+        for day, values in pending.items():
+            key = self._key(day)
+            redis.hset(key, values=values)
+            redis.expire(key, DIGEST_TTL)
+            if day in self.days:
+                self.days[day].update(values)
+
+    async def filter(self, rows):
+        """
+        返回(changed, pending)：changed是需要写入的行，pending在写入成功后传给commit
+        """
+        return await asyncio.to_thread(self._filter, rows)
+
+    async def commit(self, pending):
+        if len(pending) > 0:
+            await asyncio.to_thread(self._commit, pending)
@@ -0,0 +1,137 @@
+import csv
+import io
+import pandas as pd
+from fastapi import HTTPException
+from .supabase import meta_for_table_name, make_list
+
+# 整数列，网关返回的都是字符串。hour是global_id的一部分，保持原始字符串
+INT_COLUMNS = {"uptraffic", "downtraffic", "visitcnt", "during", "postsize", "filesize"}
+# 写入supabase时日期时间的格式，和make_date_and_hour的结果一致
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class TableParser:
+    """
+    按表结构编译的解析器：整段querydb的stdout一次切分成列，按列转换类型，
+    不再为每一行切分meta、构建dict
+    """
+    def __init__(self, table_name):
+        meta = meta_for_table_name(table_name)
+        if meta is None:
+            raise HTTPException(status_code=400, detail="不存在的表名称")
+        self.table_name = table_name
+        self.columns = [c for c in make_list(meta) if c != ""]
+        self.int_columns = [c for c in self.columns if c in INT_COLUMNS]
+        self.dtype = {c: ("int64" if c in INT_COLUMNS else str) for c in self.columns}
+
+    def row(self, line):
+        """
+        单独一行 -> dict，值保持原始字符串
+        """
+        return dict(zip(self.columns, line.split("|")))
+
+    def _read(self, text, dtype):
+        # 每行末尾有一个|，多出来的一列丢掉
+        return pd.read_csv(io.StringIO(text), sep="|", header=None, names=self.columns + ["_tail"],
+                           usecols=self.columns, dtype=dtype, keep_default_na=False,
+                           quoting=csv.QUOTE_NONE, skip_blank_lines=True, engine="c")
+
+    def frame(self, text):
+        """
+        a|b|c|\\n... -> DataFrame，整数列在解析时直接转换
+        """
+        if text is None or text.strip() == "":
+            return pd.DataFrame({c: pd.Series(dtype="int64" if c in INT_COLUMNS else object) for c in self.columns})
+        try:
+            return self._read(text, self.dtype)
+        except ValueError:
+            # 整数列中有空值或者非数字，或者个别行的字段数和表结构不一致，按字符串解析后再转换
+            pass
+        try:
+            df = self._read(text, str)
+        except ValueError:
+            # 字段数不一致（例如值中包含|），按build_dict_from_line的规则按位置截断
+            lines = pd.Series([line for line in text.splitlines() if line != ""], dtype=object)
+            df = lines.str.split("|", n=len(self.columns), expand=True)
+            df = df.reindex(columns=range(len(self.columns))).fillna("")
+            df.columns = self.columns
+        for c in self.int_columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0).astype("int64")
+        return df
+
+    def parse(self, text, fold_hour=False):
+        """
+        fold_hour为True时把hour合并到happendate中
+        """
+        df = self.frame(text)
+        if fold_hour:
+            fold_hour_column(df)
+        return df
+
+    def records(self, text, fold_hour=False):
+        return to_records(self.parse(text, fold_hour))
+
+def to_records(df):
+    """
+    DataFrame -> dict列表，值为python原生类型。比DataFrame.to_dict("records")快
+    """
+    columns = list(df.columns)
+    values = [df[c].tolist() for c in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+def fold_hour_column(df):
+    """
+    happendate + hour -> "2024-11-07 14:00:00"，和update_task_hour的结果一致
+    """
+    if "happendate" not in df.columns or "hour" not in df.columns or len(df) == 0:
+        return df
+    # 不同的(日期, 小时)组合很少，只对去重后的组合做日期计算
+    pairs = pd.MultiIndex.from_arrays([df["happendate"].astype(str), df["hour"].astype(str)])
+    codes, uniques = pd.factorize(pairs)
+    days = pd.Series(uniques.get_level_values(0), dtype=object)
+    dates = pd.to_datetime(days, format="%Y-%m-%d", errors="coerce")
+    hours = pd.to_timedelta(pd.to_numeric(pd.Series(uniques.get_level_values(1)), errors="coerce"), unit="h")
+    folded = (dates + hours).dt.strftime(DATETIME_FORMAT).astype(object)
+    # 已经合并过或者无法解析的值保持不变
+    folded = folded.where(dates.notna() & hours.notna(), days)
+    df["happendate"] = folded.to_numpy()[codes]
+    return df
+
+def add_global_id(df, keys, gwid):
+    """
+    按keys拼接global_id，和update_global_id_for_task的规则一致：只使用存在的列，最后加上gwid
+    """
+    actual_keys = [k for k in keys if k in df.columns]
+    global_id = pd.Series([""] * len(df), index=df.index, dtype=object)
+    for key in actual_keys:
+        global_id = global_id + df[key].astype(str).astype(object) + "_"
+    df["global_id"] = global_id + gwid
+    return df
+
+def transform_frame(df, gwid, keys):
+    """
+    按列完成hour合并和global_id构建
+    """
+    fold_hour_column(df)
+    # 和build_bulk_task_cmds一致，先构建global_id再加上gwid列
+    if len(keys) > 0:
+        add_global_id(df, keys, gwid)
+    df["gwid"] = gwid
+    return df
+
+def transform_records(rows, gwid, keys):
+    """
+    transform_frame的dict列表版本，返回新的dict列表
+    """
+    if len(rows) == 0:
+        return rows
+    df = pd.DataFrame.from_records(rows)
+    return to_records(transform_frame(df, gwid, keys))
+
+_parsers = {}
+
+def get_parser(table_name):
+    parser = _parsers.get(table_name)
+    if parser is None:
+        parser = TableParser(table_name)
+        _parsers[table_name] = parser
+    return parser
@@ -1,8 +1,138 @@
 import requests
+import httpx
+import asyncio
+import weakref
 import json
 import hashlib
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from .gw_cache import rpc_cache, is_invalidating
+from .gw_scheduler import gateway_slot
+from .gw_breaker import gateway_breakers
+from .deadline import timeout_for, DeadlineExceeded
+
+# 网关RPC的默认超时时间（秒）
+RPC_TIMEOUT = 20
+
+# ubus返回的"Access denied"错误码：session过期或者被销毁
+UBUS_ACCESS_DENIED = -32002
+# ubus的默认session超时时间（秒）
+UBUS_SESSION_TIMEOUT = 300
+
+# 计入熔断器失败次数的异常：连接失败和超时
+SYNC_TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+ASYNC_TRANSPORT_ERRORS = (httpx.TransportError,)
+
+def is_access_denied(response):
+    """
+    判断rpc的返回结果是否为session失效导致的拒绝访问
+    """
+    if not isinstance(response, dict):
+        return False
+    error = response.get("error")
+    return error is not None and error.get("code") == UBUS_ACCESS_DENIED
+
+# 一个批量请求最多包含的调用数，避免单个http请求过大
+MAX_BATCH_SIZE = 50
+
+def build_batch_payload(sdk, calls):
+    """
+    将(object, method, para)列表转换为JSON-RPC 2.0的数组请求
+    """
+    payload = []
+    for object, method, para in calls:
+        payload.append({
+            "jsonrpc": "2.0",
+            "id": sdk.cmd_id,
+            "method": "call",
+            "params": [sdk.session_id, object, method, para]
+        })
+        sdk.cmd_id += 1
+    return payload
+
+def parse_batch_response(payload, response):
+    """
+    按请求顺序返回每个调用的结果：{"result": 单个调用的rpc返回, "error": 错误信息或None}
+    """
+    by_id = {}
+    if isinstance(response, list):
+        for item in response:
+            if isinstance(item, dict):
+                by_id[item.get("id")] = item
+    results = []
+    for req in payload:
+        item = by_id.get(req["id"])
+        if item is None:
+            # 整个批量请求失败时，网关只返回一个错误对象
+            error = response.get("error") if isinstance(response, dict) else None
+            results.append({"result": None, "error": error or {"message": "missing response"}})
+            continue
+        error = item.get("error")
+        result = item.get("result")
+        # ubus的调用状态码在result[0]，非0表示调用失败
+        if error is None and isinstance(result, list) and len(result) > 0 and result[0] != 0:
+            error = {"code": result[0], "message": "ubus call failed"}
+        results.append({"result": item, "error": error})
+    return results
+
+def chunk_calls(calls, size=MAX_BATCH_SIZE):
+    for i in range(0, len(calls), size):
+        yield calls[i:i + size]
+
+class RpcBatch:
+    """
+    收集多个rpc调用，作为JSON-RPC 2.0数组一次发送给网关。
+    sdk.batch()获取；SDK上execute()直接返回结果，AsyncSDK上需要await。
+    execute()返回的列表与调用顺序一致，每一项为{"result": ..., "error": ...}
+    """
+    def __init__(self, sdk):
+        self.sdk = sdk
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call(self, object, method, para):
+        """
+        添加一个调用，返回它在结果列表中的下标
+        """
+        self.calls.append((object, method, para))
+        return len(self.calls) - 1
+
+    def list_virtual_group(self, groupid):
+        return self.call("wfilter", "list-virtual-group", {"data": groupid})
+
+    def list_account(self):
+        return self.call("uci", "get", {"config": "wfilter-account"})
+
+    def config_load(self, cfgname):
+        return self.call("uci", "get", {"config": cfgname})
+
+    def config_add(self, cfgname, type, name, values):
+        data = {
+            "config": cfgname,
+            "type": type,
+            "name": name,
+            "values": values
+        }
+        return self.call("uci", "add", data)
+
+    def config_set(self, cfgname, section, values):
+        data = {
+            "config": cfgname,
+            "section": section,
+            "values": values
+        }
+        return self.call("uci", "set", data)
+
+    def config_del(self, cfgname, section):
+        return self.call("uci", "delete", {"config": cfgname, "section": section})
+
+    def query_db(self, dbname, querysql):
+        return self.call("wfilter", "querydb", {"dbname": dbname, "sql": querysql})
+
+    def execute(self):
+        return self.sdk.send_batch(self.calls)
 
 # 将 WFilterNGF 类重命名为 SDK
 class SDK:
@@ -10,9 +140,31 @@ class SDK:
         self.session_id = "00000000000000000000000000000000"
         self.cmd_id = 1
         self.server = ""
+        self.session_timeout = UBUS_SESSION_TIMEOUT
+        # session失效时的回调，返回新的session_id；由session池设置
+        self.on_access_denied = None
+        # sdk所属网关的gwid，由session池设置；设置后调用会经过网关的rpc缓存
+        self.gwid = None
 
-    def rpc_call(self, object, method, para):
+    def post_json(self, payload):
+        """
+        向网关发送一次ubus请求，超时取RPC_TIMEOUT和请求剩余时间中较小的一个
+        """
         headers = {'Content-Type': 'application/json'}
+        timeout = timeout_for(RPC_TIMEOUT)
+        # 熔断中的网关直接返回503，不再等待超时
+        with gateway_breakers.guard(self.gwid or self.server, SYNC_TRANSPORT_ERRORS):
+            try:
+                response = requests.post(f"{self.server}/ubus", json=payload, headers=headers, timeout=timeout)
+            except requests.exceptions.Timeout:
+                if timeout < RPC_TIMEOUT:
+                    # 请求的剩余时间用完了，不算网关的失败
+                    raise DeadlineExceeded()
+                raise
+        response.raise_for_status()
+        return response.json()
+
+    def post_rpc(self, object, method, para):
         data = {
             "jsonrpc": "2.0",
             "id": self.cmd_id,
@@ -20,10 +172,37 @@ class SDK:
             "params": [self.session_id, object, method, para]
         }
         self.cmd_id += 1
-        
-        response = requests.post(f"{self.server}/ubus", json=data, headers=headers, timeout=20)
-        response.raise_for_status()
-        return response.json()
+        return self.post_json(data)
+
+    def rpc_call(self, object, method, para):
+        response = self.post_rpc(object, method, para)
+        if self.on_access_denied is not None and is_access_denied(response):
+            # session已经失效：重新登录后重试一次
+            self.session_id = self.on_access_denied()
+            response = self.post_rpc(object, method, para)
+        if self.gwid is not None and is_invalidating(object, method):
+            # 同步sdk不读缓存，但写操作仍然要清空网关的缓存
+            rpc_cache.invalidate(self.gwid)
+        return response
+
+    def batch(self):
+        return RpcBatch(self)
+
+    def post_batch(self, calls):
+        payload = build_batch_payload(self, calls)
+        return parse_batch_response(payload, self.post_json(payload))
+
+    def send_batch(self, calls):
+        results = []
+        for chunk in chunk_calls(calls):
+            chunk_results = self.post_batch(chunk)
+            if self.on_access_denied is not None and any(is_access_denied({"error": r["error"]}) for r in chunk_results):
+                self.session_id = self.on_access_denied()
+                chunk_results = self.post_batch(chunk)
+            results.extend(chunk_results)
+        if self.gwid is not None and any(is_invalidating(object, method) for object, method, _ in calls):
+            rpc_cache.invalidate(self.gwid)
+        return results
 
     def login(self, server, username, password):
         self.server = server
@@ -31,6 +210,7 @@ class SDK:
         response = self.rpc_call("session", "login", data)
         if "result" in response and len(response["result"]) > 1:
             self.session_id = response["result"][1]["ubus_rpc_session"]
+            self.session_timeout = response["result"][1].get("timeout") or UBUS_SESSION_TIMEOUT
             return True
         return False
 
@@ -147,6 +327,263 @@ class SDK:
         }
         return self.rpc_call("wfilter", "querydb", data)
 
+# 异步http客户端的连接池参数：保持长连接，避免每次调用都重新建立TCP连接
+ASYNC_POOL_LIMITS = httpx.Limits(max_connections=500, max_keepalive_connections=200, keepalive_expiry=60)
+
+# 每个事件循环共享一个AsyncClient（httpx的连接池不能跨事件循环使用）
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    """
+    获取当前事件循环上共享的httpx.AsyncClient，不存在时创建
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=ASYNC_POOL_LIMITS, timeout=RPC_TIMEOUT)
+        _async_clients[loop] = client
+    return client
+
+async def close_async_client():
+    """
+    关闭当前事件循环上的AsyncClient，在应用shutdown时调用
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.pop(loop, None)
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+class AsyncSDK:
+    """
+    SDK的异步版本，所有方法都是awaitable的。
+    使用共享的httpx.AsyncClient连接池，调用网关时不会阻塞事件循环。
+    """
+    def __init__(self, client=None):
+        self.session_id = "00000000000000000000000000000000"
+        self.cmd_id = 1
+        self.server = ""
+        self.client = client
+        self.session_timeout = UBUS_SESSION_TIMEOUT
+        # session失效时的异步回调，返回新的session_id；由session池设置
+        self.on_access_denied = None
+        # sdk所属网关的gwid，由session池设置；设置后调用会经过网关的rpc缓存
+        self.gwid = None
+
+    async def post_json(self, payload):
+        """
+        向网关发送一次ubus请求，超时取RPC_TIMEOUT和请求剩余时间中较小的一个
+        """
+        headers = {'Content-Type': 'application/json'}
+        client = self.client or get_async_client()
+        key = self.gwid or self.server
+        # 熔断中的网关直接返回503，不再排队和等待超时
+        with gateway_breakers.guard(key, ASYNC_TRANSPORT_ERRORS):
+            # 按网关限制并发，交互请求优先于批量请求
+            async with gateway_slot(key):
+                # 排队之后再计算超时，排队的时间也计入请求的处理时间
+                timeout = timeout_for(RPC_TIMEOUT)
+                try:
+                    response = await client.post(f"{self.server}/ubus", json=payload, headers=headers, timeout=timeout)
+                except httpx.TimeoutException:
+                    if timeout < RPC_TIMEOUT:
+                        # 请求的剩余时间用完了，不算网关的失败
+                        raise DeadlineExceeded()
+                    raise
+        response.raise_for_status()
+        return response.json()
+
+    async def post_rpc(self, object, method, para):
+        data = {
+            "jsonrpc": "2.0",
+            "id": self.cmd_id,
+            "method": "call",
+            "params": [self.session_id, object, method, para]
+        }
+        self.cmd_id += 1
+        return await self.post_json(data)
+
+    async def rpc_call(self, object, method, para):
+        if self.gwid is not None:
+            return await rpc_cache.call(self.gwid, object, method, para, lambda: self.call_gateway(object, method, para))
+        return await self.call_gateway(object, method, para)
+
+    async def call_gateway(self, object, method, para):
+        """
+        不经过缓存，直接调用网关
+        """
+        response = await self.post_rpc(object, method, para)
+        if self.on_access_denied is not None and is_access_denied(response):
+            # session已经失效：重新登录后重试一次
+            self.session_id = await self.on_access_denied()
+            response = await self.post_rpc(object, method, para)
+        return response
+
+    def batch(self):
+        return RpcBatch(self)
+
+    async def post_batch(self, calls):
+        payload = build_batch_payload(self, calls)
+        return parse_batch_response(payload, await self.post_json(payload))
+
+    async def send_batch(self, calls):
+        results = []
+        for chunk in chunk_calls(calls):
+            chunk_results = await self.post_batch(chunk)
+            if self.on_access_denied is not None and any(is_access_denied({"error": r["error"]}) for r in chunk_results):
+                self.session_id = await self.on_access_denied()
+                chunk_results = await self.post_batch(chunk)
+            results.extend(chunk_results)
+        if self.gwid is not None and any(is_invalidating(object, method) for object, method, _ in calls):
+            rpc_cache.invalidate(self.gwid)
+        return results
+
+    async def login(self, server, username, password):
+        self.server = server
+        data = {"username": username, "password": hashlib.md5(password.encode()).hexdigest()}
+        response = await self.rpc_call("session", "login", data)
+        if "result" in response and len(response["result"]) > 1:
+            self.session_id = response["result"][1]["ubus_rpc_session"]
+            self.session_timeout = response["result"][1].get("timeout") or UBUS_SESSION_TIMEOUT
+            return True
+        return False
+
+    async def logout(self):
+        await self.rpc_call("session", "destroy", "")
+
+    async def renew_user(self, userid, newdate):
+        data = {"data": f"wfilter-isp renew {userid} {newdate}"}
+        response = await self.rpc_call("wfilter", "exec", data)
+        return newdate in str(response)
+
+    async def add_virtual_group(self, groupid, ip, minutes):
+        data = {"id": groupid, "ip": ip, "minute": str(minutes)}
+        response = await self.rpc_call("wfilter", "add-virtual-group", data)
+        return "0000" in str(response)
+
+    async def list_virtual_group(self, groupid):
+        data = {"data": groupid}
+        return await self.rpc_call("wfilter", "list-virtual-group", data)
+
+    async def rm_virtual_group(self, ip):
+        data = {"data": ip}
+        response = await self.rpc_call("wfilter", "rm-virtual-group", data)
+        return "0000" in str(response)
+
+    async def list_group(self):
+        data = {"config": "wfilter-groups"}
+        return await self.rpc_call("uci", "get", data)
+
+    async def list_account(self):
+        data = {"config": "wfilter-account"}
+        return await self.rpc_call("uci", "get", data)
+
+    async def list_bandwidth(self, seconds):
+        data = {"data": str(seconds)}
+        return await self.rpc_call("wfilter", "list-bandwidth", data)
+
+    async def list_online_users(self, top, search):
+        data = {"row": str(top), "search": search}
+        return await self.rpc_call("wfilter", "get-top-bandwidth", data)
+
+    async def list_online_connections(self, ip):
+        data = {"data": ip}
+        return await self.rpc_call("wfilter", "get-links", data)
+
+    async def kill_connection(self, ip, port, type, minutes, message):
+        data = {
+            "ip": ip,
+            "port": str(port),
+            "proto": type,
+            "minutes": str(minutes),
+            "message": message
+        }
+        response = await self.rpc_call("wfilter", "kill-link", data)
+        return "0000" in str(response)
+
+    async def get_network_interfaces(self):
+        return await self.rpc_call("network.interface", "dump", {})
+
+    async def get_network_status(self):
+        return await self.rpc_call("network.device", "status", {})
+
+    async def add_user(self, ip, user, from_source, expire):
+        data = {
+            "ip": ip,
+            "user": user,
+            "from": from_source,
+            "expire": str(expire)
+        }
+        response = await self.rpc_call("wfilter", "add-user", data)
+        return "0000" in str(response)
+
+    async def rm_user(self, user):
+        data = {"data": user}
+        response = await self.rpc_call("wfilter", "rm-user", data)
+        return "0000" in str(response)
+
+    async def config_load(self, cfgname):
+        data = {"config": cfgname}
+        return await self.rpc_call("uci", "get", data)
+
+    async def config_add(self, cfgname, type, name, values):
+        data = {
+            "config": cfgname,
+            "type": type,
+            "name": name,
+            "values": values
+        }
+        return await self.rpc_call("uci", "add", data)
+
+    async def config_set(self, cfgname, section, values):
+        data = {
+            "config": cfgname,
+            "section": section,
+            "values": values
+        }
+        return await self.rpc_call("uci", "set", data)
+
+    async def config_del(self, cfgname, section):
+        data = {
+            "config": cfgname,
+            "section": section
+        }
+        return await self.rpc_call("uci", "delete", data)
+
+    async def config_apply(self):
+        data = {"data": "busybox sh /usr/sbin/wfilter-apply"}
+        return await self.rpc_call("wfilter", "exec", data)
+
+    async def query_db(self, dbname, querysql):
+        data = {
+            "dbname": dbname,
+            "sql": querysql
+        }
+        return await self.rpc_call("wfilter", "querydb", data)
+
+    async def stream_query_db(self, dbname, querysql):
+        """
+        流式执行querydb，逐块返回网关的原始响应，不在内存中缓存整个结果。
+        解析见query_stream.QueryLineStream
+        """
+        headers = {'Content-Type': 'application/json'}
+        data = {
+            "jsonrpc": "2.0",
+            "id": self.cmd_id,
+            "method": "call",
+            "params": [self.session_id, "wfilter", "querydb", {"dbname": dbname, "sql": querysql}]
+        }
+        self.cmd_id += 1
+        client = self.client or get_async_client()
+        key = self.gwid or self.server
+        with gateway_breakers.guard(key, ASYNC_TRANSPORT_ERRORS):
+            async with gateway_slot(key):
+                # 超时是两次读取之间的最长等待时间，不限制整个传输的时间
+                timeout = timeout_for(RPC_TIMEOUT)
+                async with client.stream("POST", f"{self.server}/ubus", json=data, headers=headers, timeout=timeout) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        yield chunk
+
 # app = FastAPI()
 
 # 删除或注释掉这行
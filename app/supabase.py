@@ -1,6 +1,8 @@
 from supabase import create_client, Client
 from .config import Config
 from datetime import datetime
+from functools import lru_cache
+from .deadline import run_with_deadline
 import os 
 
 env = os.environ.get('env')
@@ -20,7 +22,9 @@ print("ratio = ", cfg.TRAFFIC_RATIO)
 supabase: Client = create_client(url, key)
 
 async def get_supabase_table_latest_row(table_name, gwid, column="happendate"):
-    response = supabase.table(table_name).select(column).eq("gwid", gwid).order(column, desc=True).limit(1).execute()
+    # 在线程中查询，最多等待请求剩余的时间
+    query = supabase.table(table_name).select(column).eq("gwid", gwid).order(column, desc=True).limit(1)
+    response = await run_with_deadline(query.execute)
     data = response.data
     if len(data) <= 0:
         return None
@@ -59,6 +63,49 @@ def meta_for_table_name(table_name):
     else:
         return None
     
+# 分页读取网关表时的排序键：第一个是时间列，后面的列和时间列一起确定一行
+TABLE_KEYS = {
+    "hourreport": ["happendate", "hour"],
+    "ipreport": ["happendate", "ip"],
+    "acctreport": ["happendate", "acct"],
+    "webreport": ["happendate", "ip", "acct", "host", "category1", "category2"],
+    "webreport_today": ["happendate", "ip", "acct", "host", "category1", "category2"],
+    "protocolreport": ["happendate", "ip", "acct", "category", "protocol"],
+    "protocolreport_today": ["happendate", "ip", "acct", "category", "protocol"],
+    "sessionslog": ["happentime", "ip", "mac", "direction", "proto", "target"],
+    "ftplog": ["happentime", "ip", "mac", "direction", "fileid", "target"],
+    "ipmaclog": ["happentime", "ip", "mac"],
+    "maillog": ["happentime", "ip", "mac", "direction", "messageid"],
+    "webpostlog": ["happentime", "ip", "mac", "host", "fileid"],
+    "websurflog": ["happentime", "ip", "mac", "url"],
+}
+
+# 构建global_id使用的列，gwid总是放在最后（见update_global_id_for_task）
+GLOBAL_ID_KEYS = {
+    "hourreport": ["gwid", "hour", "happendate"],
+    "ipreport": ["gwid", "ip", "happendate"],
+    "acctreport": ["gwid", "acct", "happendate"],
+    "webreport": ["gwid", "ip", "acct", "host", "category1", "category2", "happendate"],
+    "webreport_today": ["gwid", "ip", "acct", "host", "category1", "category2", "happendate"],
+    "protocolreport": ["gwid", "ip", "acct", "category", "protocol", "happendate"],
+    "protocolreport_today": ["gwid", "ip", "acct", "category", "protocol", "happendate"],
+    "sessionslog": ["gwid", "ip", "mac", "happentime", "direction", "proto", "target"],
+    "ftplog": ["gwid", "ip", "mac", "happentime", "direction", "fileid", "target"],
+    "ipmaclog": ["gwid", "ip", "mac", "happentime"],
+    "maillog": ["gwid", "ip", "mac", "happentime", "direction", "messageid"],
+    "webpostlog": ["gwid", "ip", "mac", "happentime", "host", "fileid"],
+    "websurflog": ["gwid", "ip", "mac", "happentime", "url"],
+}
+
+def keys_for_table_name(table_name, column=None):
+    """
+    返回分页用的排序键；column不为空时把它放在第一位
+    """
+    keys = TABLE_KEYS.get(table_name) or []
+    if column is None:
+        return list(keys)
+    return [column] + [k for k in keys if k != column]
+
 def formalize_supabase_datetime(dt):
     d = dt
     # regex = re.compile(r'T')
@@ -73,13 +120,20 @@ def make_list(row):
     return list(filter(lambda x: len(x)>=0, my_lst))
 
 
+@lru_cache(maxsize=64)
+def meta_columns(meta):
+    """
+    meta按|切分的结果，每个meta只切分一次
+    """
+    return make_list(meta)
+
 def build_dict_from_line(meta, line):
     """
     meta: happendate|hour|uptraffic|downtraffic|
     line: 2024-11-07|14|5772895|21432009|
     """
     dict = {}
-    meta_list = make_list(meta)
+    meta_list = meta_columns(meta)
     meta_len = len(meta_list)
     data_list = make_list(line)
     data_len = len(data_list)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from .upstash import redis
+
+# 租约的有效期（秒），持有者每RENEW_INTERVAL秒续期一次；进程异常退出时租约自动过期
+LEASE_TTL = 120
+RENEW_INTERVAL = 40
+
+# 只有持有者（token相同）才能续期和释放
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class SyncJobRunning(HTTPException):
+    """
+    同一个网关、同一张表的同步已经在进行中，返回409
+    """
+    def __init__(self, gwid, table_name):
+        super().__init__(status_code=409, detail=f"同步任务正在进行中: {gwid}, {table_name}")
+
+class SyncLeaseLost(HTTPException):
+    """
+    同步过程中租约过期或者被其他任务取得，停止写入，不再推进检查点和水位
+    """
+    def __init__(self, key):
+        super().__init__(status_code=409, detail=f"同步租约已经失效: {key}")
+
+class SyncLease:
+    """
+    redis中的同步租约，保证同一个(gwid, table)同时只有一个同步任务:
+    "starlink.sync.lease.<gwid>.<table>" = token
+    """
+    def __init__(self, gwid, table_name, ttl=LEASE_TTL):
+        self.key = f"starlink.sync.lease.{gwid}.{table_name}"
+        self.token = str(uuid.uuid4())
+        self.ttl = ttl
+        # 续期失败（租约已经不属于自己）之后为True
+        self.lost = False
+
+    def check(self):
+        """
+        写入数据、记录检查点和水位之前调用，租约已经失效时抛出SyncLeaseLost
+        """
+        if self.lost:
+            raise SyncLeaseLost(self.key)
+
+    def acquire(self):
+        return bool(redis.set(self.key, self.token, nx=True, ex=self.ttl))
+
+    def renew(self):
+        return bool(redis.eval(_RENEW_SCRIPT, keys=[self.key], args=[self.token, str(self.ttl)]))
+
+    def release(self):
+        return bool(redis.eval(_RELEASE_SCRIPT, keys=[self.key], args=[self.token]))
+
+@asynccontextmanager
+async def sync_lease(gwid, table_name):
+    """
+    持有租约执行同步，已经有其他任务在同步时抛出SyncJobRunning。
+    续期失败时设置lease.lost，同步过程中通过lease.check()停止
+    """
+    lease = SyncLease(gwid, table_name)
+    if not await asyncio.to_thread(lease.acquire):
+        raise SyncJobRunning(gwid, table_name)
+
+    async def keep_alive():
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(RENEW_INTERVAL)
+            try:
+                ok = await asyncio.to_thread(lease.renew)
+            except Exception as e:
+                print(f"[SyncLease]: renew failed, key = {lease.key}, error = {e}")
+                # redis暂时不可用：超过ttl没有续期成功时，租约可能已经过期
+                ok = time.monotonic() - renewed < lease.ttl
+                if ok:
+                    continue
+            if not ok:
+                print(f"[SyncLease]: lease lost, key = {lease.key}")
+                lease.lost = True
+                return
+            renewed = time.monotonic()
+
+    renew_task = asyncio.ensure_future(keep_alive())
+    try:
+        yield lease
+    finally:
+        renew_task.cancel()
+        try:
+            await asyncio.to_thread(lease.release)
+        except Exception as e:
+            print(f"[SyncLease]: release failed, key = {lease.key}, error = {e}")
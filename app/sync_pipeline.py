@@ -0,0 +1,200 @@
+import asyncio
+import time
+from fastapi import HTTPException
+from .gw_pager import PAGE_SIZE, iter_page_texts
+from .gw_scheduler import bulk_lane
+from .row_parser import get_parser, transform_frame, to_records
+from .bulk_writer import BulkWriter
+from .sync_watermark import sync_watermarks, get_sync_checkpoint
+from .sync_lease import sync_lease
+from .row_digest import RowDigests, DIGEST_TABLES
+
+# 阶段之间最多缓存的页数，内存占用与表的大小无关
+QUEUE_SIZE = 2
+
+_DONE = object()
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.pages = 0
+        self.rows = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    def add(self, rows, size, started):
+        self.pages += 1
+        self.rows += rows
+        self.bytes += size
+        self.busy += time.monotonic() - started
+
+    def to_dict(self):
+        return {
+            "pages": self.pages,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "busy": round(self.busy, 3),
+        }
+
+class SyncPipeline:
+    """
+    网关表 -> supabase的流式同步，四个阶段通过有界队列连接，并发执行:
+    read: 按排序键分页读取querydb的stdout
+    parse: 按表结构解析成列
+    transform: 合并hour、构建global_id
+    write: 跳过内容没有变化的行，分块写入supabase，每页写完后记录检查点，全部写完后标记水位完成
+    网关读取和supabase写入同时进行，任何时候最多只有几页数据在内存中
+    """
+    def __init__(self, gwid, table_name, target_table_name=None, column="happendate", keys=None,
+                 start=None, page_size=PAGE_SIZE, queue_size=QUEUE_SIZE, on_conflict=None, end=None, advance_watermark=True, after=None, rebuild=False, lease=None):
+        self.gwid = gwid
+        self.table_name = table_name
+        self.target_table_name = target_table_name or table_name
+        self.column = column
+        self.keys = keys or []
+        self.start = start
+        # 只读取[start, end)的行；按时间窗口并行读取时由调用者统一推进水位
+        self.end = end
+        self.advance_watermark = advance_watermark
+        # 从检查点after之后继续读取，last是最后一个写入的页的检查点
+        self.after = after
+        self.last = after
+        # 持有的同步租约，失效之后不再写入和推进水位
+        self.lease = lease
+        self.page_size = page_size
+        self.queue_size = queue_size
+        self.parser = get_parser(table_name)
+        self.writer = BulkWriter(self.target_table_name, on_conflict)
+        self.stats = {name: StageStats(name) for name in ("read", "parse", "transform", "write")}
+        # 按(gwid, table, day)的行摘要跳过没有变化的行，全量重建时不跳过，只重新记录摘要
+        self.digests = None
+        if table_name in DIGEST_TABLES:
+            self.digests = RowDigests(gwid, table_name, column, force=rebuild)
+        self.unchanged = 0
+
+    async def _read(self, out):
+        stats = self.stats["read"]
+        started = time.monotonic()
+        async for text, rows, last in iter_page_texts(self.gwid, self.table_name, self.column, after=self.after, page_size=self.page_size, start=self.start, end=self.end):
+            size = len(text.encode("utf-8"))
+            stats.add(rows, size, started)
+            await out.put((text, size, last))
+            started = time.monotonic()
+        await out.put(_DONE)
+
+    async def _parse(self, inp, out):
+        stats = self.stats["parse"]
+        while True:
+            item = await inp.get()
+            if item is _DONE:
+                break
+            text, size, last = item
+            started = time.monotonic()
+            df = self.parser.frame(text)
+            stats.add(len(df), size, started)
+            await out.put((df, last))
+        await out.put(_DONE)
+
+    async def _transform(self, inp, out):
+        stats = self.stats["transform"]
+        while True:
+            item = await inp.get()
+            if item is _DONE:
+                break
+            df, last = item
+            started = time.monotonic()
+            # 水位使用网关上的原始值，last在转换之前已经取出
+            df = transform_frame(df, self.gwid, self.keys)
+            size = int(df.memory_usage(index=False).sum())
+            rows = to_records(df)
+            stats.add(len(rows), size, started)
+            await out.put((rows, last))
+        await out.put(_DONE)
+
+    async def _write(self, inp):
+        stats = self.stats["write"]
+        while True:
+            item = await inp.get()
+            if item is _DONE:
+                break
+            rows, last = item
+            self.check_lease()
+            started = time.monotonic()
+            pending = {}
+            if self.digests is not None:
+                total = len(rows)
+                rows, pending = await self.digests.filter(rows)
+                self.unchanged += total - len(rows)
+            result = await self.writer.write(rows)
+            size = sum(c["bytes"] for c in result["chunks"] if c["status"] == "ok")
+            if result["failed"] > 0:
+                # 有分块没有写入，不推进水位，下一次同步重新读取这一页
+                raise HTTPException(status_code=500, detail=f"同步{self.table_name}失败: {result['failed']}行没有写入")
+            if self.digests is not None:
+                await self.digests.commit(pending)
+            if self.advance_watermark:
+                self.check_lease()
+                # 检查点：中途断开时下一次从这里继续
+                await sync_watermarks.aset(self.gwid, self.table_name, self.column, last, len(rows), complete=False)
+            self.last = last
+            stats.add(result["written"], size, started)
+
+    async def run(self):
+        started = time.monotonic()
+        q1 = asyncio.Queue(self.queue_size)
+        q2 = asyncio.Queue(self.queue_size)
+        q3 = asyncio.Queue(self.queue_size)
+        # 在批量通道中创建task，网关读取不阻塞交互请求
+        with bulk_lane():
+            tasks = [
+                asyncio.ensure_future(self._read(q1)),
+                asyncio.ensure_future(self._parse(q1, q2)),
+                asyncio.ensure_future(self._transform(q2, q3)),
+                asyncio.ensure_future(self._write(q3)),
+            ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 某个阶段失败时停止其他阶段，避免阻塞在队列上
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        if self.advance_watermark and self.last is not None:
+            self.check_lease()
+            await sync_watermarks.aset(self.gwid, self.table_name, self.column, self.last, self.stats["write"].rows, complete=True)
+        return self.report(time.monotonic() - started)
+
+    def check_lease(self):
+        if self.lease is not None:
+            self.lease.check()
+
+    def report(self, elapsed):
+        return {
+            "gwid": self.gwid,
+            "table_name": self.table_name,
+            "target_table_name": self.target_table_name,
+            "start": self.start,
+            "end": self.end,
+            "after": self.after,
+            "elapsed": round(elapsed, 3),
+            "unchanged": self.unchanged,
+            "stages": {name: s.to_dict() for name, s in self.stats.items()},
+        }
+
+async def sync_table(gwid, table_name, target_table_name=None, column="happendate", keys=None, rebuild=False, page_size=PAGE_SIZE):
+    """
+    同步一个网关的一张表：持有租约避免重复执行，从上一次的检查点或者水位继续
+    """
+    async with sync_lease(gwid, table_name) as lease:
+        return await sync_table_locked(gwid, table_name, target_table_name, column, keys, rebuild, page_size, lease)
+
+async def sync_table_locked(gwid, table_name, target_table_name=None, column="happendate", keys=None, rebuild=False, page_size=PAGE_SIZE, lease=None):
+    """
+    sync_table的同步部分，调用者已经持有租约lease
+    """
+    start, after = await get_sync_checkpoint(gwid, table_name, column, rebuild)
+    pipeline = SyncPipeline(gwid, table_name, target_table_name, column, keys, start, page_size, after=after, rebuild=rebuild, lease=lease)
+    report = await pipeline.run()
+    print(f"[SyncPipeline]: {report}")
+    return report
@@ -0,0 +1,192 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from .utils import fetch_gw_users_list, prepare_user
+from .bulk_writer import bulk_upsert
+
+# 后台同步任务的类型
+JOB_USERS = "users"
+JOB_DEVICES = "devices"
+
+STATE_QUEUED = "queued"
+STATE_RUNNING = "running"
+STATE_SUCCESS = "success"
+STATE_FAILED = "failed"
+
+# 同时执行的后台任务数量
+WORKERS = 4
+# 内存中保留的已完成任务数量，用于查询任务状态
+KEEP_FINISHED = 1000
+# 接口等待后台任务完成的最长时间（秒），超过之后直接返回已有的数据
+WAIT_TIMEOUT = 20
+
+class SyncJob:
+    """
+    一个后台同步任务，payload为None时由任务自己从网关读取数据
+    """
+    def __init__(self, gwid, job_type, payload=None):
+        self.id = uuid.uuid4().hex
+        self.gwid = gwid
+        self.job_type = job_type
+        self.payload = payload
+        self.state = STATE_QUEUED
+        # 还没有开始时又提交了多少次，被合并到这个任务中
+        self.merged = 0
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.elapsed = None
+        self.error = None
+        self.result = None
+        self.done = asyncio.Event()
+
+    @property
+    def key(self):
+        return (self.gwid, self.job_type)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "gwid": self.gwid,
+            "job_type": self.job_type,
+            "state": self.state,
+            "merged": self.merged,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed": self.elapsed,
+            "error": self.error,
+            "result": self.result,
+        }
+
+async def sync_users_job(gwid, users):
+    if users is None:
+        users = await fetch_gw_users_list(gwid)
+    rows = [prepare_user(dict(user)) for user in users]
+    return await bulk_upsert("gw_users", rows, on_conflict="global_id")
+
+async def sync_devices_job(gwid, devices):
+    return await bulk_upsert("device_list", devices or [])
+
+class SyncQueue:
+    """
+    进程内的后台同步队列，取代在接口中同步执行的luigi.build:
+    - 同一个(gwid, job_type)最多一个排队中的任务，重复提交合并到排队中的任务，并使用最新的payload
+    - 同一个(gwid, job_type)同时只有一个任务在执行
+    - 任务状态保存在内存中，不再写入data/*.json标记文件
+    """
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.handlers = {
+            JOB_USERS: sync_users_job,
+            JOB_DEVICES: sync_devices_job,
+        }
+        # id -> job，按提交顺序保存，超过KEEP_FINISHED时丢弃最早完成的任务
+        self.jobs = OrderedDict()
+        # (gwid, job_type) -> 排队中的任务
+        self.queued = {}
+        self.locks = {}
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        if self._queue is not None and any(not t.done() for t in self._tasks):
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # 重启之前提交但是还没有执行的任务
+        for job in self.queued.values():
+            self._queue.put_nowait(job)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, gwid, job_type, payload=None):
+        """
+        提交一个后台同步任务，立即返回任务（可能是合并后的已有任务）
+        """
+        if job_type not in self.handlers:
+            raise ValueError(f"不支持的同步任务类型: {job_type}")
+        self.start()
+        key = (gwid, job_type)
+        job = self.queued.get(key)
+        if job is not None:
+            if payload is not None:
+                job.payload = payload
+            job.merged += 1
+            return job
+        job = SyncJob(gwid, job_type, payload)
+        self.queued[key] = job
+        self._remember(job)
+        self._queue.put_nowait(job)
+        return job
+
+    async def wait(self, job, timeout=WAIT_TIMEOUT):
+        """
+        等待任务完成，超时返回False
+        """
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        return None if job is None else job.to_dict()
+
+    def list(self, gwid=None):
+        return [job.to_dict() for job in self.jobs.values() if gwid is None or job.gwid == gwid]
+
+    def _remember(self, job):
+        self.jobs[job.id] = job
+        finished = [j.id for j in self.jobs.values() if j.done.is_set()]
+        for job_id in finished[:max(0, len(self.jobs) - KEEP_FINISHED)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                lock = self.locks.setdefault(job.key, asyncio.Lock())
+                async with lock:
+                    # 拿到锁之后才离开排队状态，等待期间的重复提交仍然合并到这个任务
+                    if self.queued.get(job.key) is job:
+                        del self.queued[job.key]
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        job.state = STATE_RUNNING
+        job.started_at = datetime.now().isoformat()
+        start = time.monotonic()
+        try:
+            result = await self.handlers[job.job_type](job.gwid, job.payload)
+            job.result = {k: v for k, v in result.items() if k != "chunks"}
+            job.result["errors"] = [c["error"] for c in result.get("chunks", []) if c["status"] == "failed"]
+            job.state = STATE_FAILED if result.get("failed") else STATE_SUCCESS
+            if result.get("failed"):
+                job.error = f"{result['failed']} rows failed"
+        except Exception as e:
+            print(f"[SyncQueue]: job failed, gwid = {job.gwid}, type = {job.job_type}, error = {e}")
+            job.state = STATE_FAILED
+            job.error = str(getattr(e, "detail", e))
+        finally:
+            job.payload = None
+            job.elapsed = round(time.monotonic() - start, 3)
+            job.finished_at = datetime.now().isoformat()
+            job.done.set()
+        print(f"[SyncQueue]: {job.job_type} done, gwid = {job.gwid}, state = {job.state}, elapsed = {job.elapsed}")
+
+sync_queue = SyncQueue()
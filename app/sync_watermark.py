@@ -0,0 +1,109 @@
+import json
+from datetime import datetime
+from .utils import getkv, setkv
+from .supabase import supabase, get_supabase_table_latest_row, formalize_supabase_datetime
+from .deadline import run_with_deadline
+
+# gw_kv表中保存同步水位的type，id为gwid，key为网关上的表名称
+WATERMARK_TYPE = "sync_watermark"
+
+class SyncWatermarks:
+    """
+    记录每个(gwid, table)最后一次成功写入supabase的位置:
+    {"column": "happendate", "value": "2024-11-07", "after": ["2024-11-07", "14"], "rows": 24, "complete": true, "updated_at": "..."}
+    上一次同步正常结束（complete）时，下一次从value开始（包含value），这样最后一天里还在累加的行会被重新读取并覆盖；
+    中途断开时after是最后一个写入的页的检查点，下一次从after之后继续
+    """
+    def get(self, gwid, table_name):
+        value = getkv(WATERMARK_TYPE, gwid, table_name)
+        if value is None or value == "":
+            return None
+        try:
+            return json.loads(value)
+        except Exception as e:
+            print(f"[SyncWatermarks]: invalid watermark, gwid = {gwid}, table = {table_name}, value = {value}, error = {e}")
+            return None
+
+    def set(self, gwid, table_name, column, after, rows=0, complete=True):
+        """
+        after: 已经写入的最后一行的排序键，第一个元素是column的值
+        complete: 为False时表示同步还在进行中，after是检查点
+        """
+        watermark = {
+            "column": column,
+            "value": after[0],
+            "after": after,
+            "rows": rows,
+            "complete": complete,
+            "updated_at": datetime.now().isoformat(),
+        }
+        setkv(WATERMARK_TYPE, gwid, table_name, json.dumps(watermark, ensure_ascii=False))
+        return watermark
+
+    def clear(self, gwid, table_name=None):
+        query = supabase.table("gw_kv").delete().eq("type", WATERMARK_TYPE).eq("id", gwid)
+        if table_name is not None:
+            query = query.eq("key", table_name)
+        return query.execute()
+
+    def list(self, gwid=None):
+        query = supabase.table("gw_kv").select("*").eq("type", WATERMARK_TYPE)
+        if gwid is not None:
+            query = query.eq("id", gwid)
+        response = query.execute()
+        result = []
+        for row in response.data:
+            try:
+                watermark = json.loads(row.get("value") or "{}")
+            except Exception:
+                watermark = {}
+            result.append({"gwid": row.get("id"), "table_name": row.get("key"), "watermark": watermark})
+        return result
+
+    async def aget(self, gwid, table_name):
+        return await run_with_deadline(self.get, gwid, table_name)
+
+    async def aset(self, gwid, table_name, column, after, rows=0, complete=True):
+        return await run_with_deadline(self.set, gwid, table_name, column, after, rows, complete)
+
+    async def aclear(self, gwid, table_name=None):
+        return await run_with_deadline(self.clear, gwid, table_name)
+
+sync_watermarks = SyncWatermarks()
+
+async def supabase_start(gwid, table_name, column):
+    """
+    没有水位时，以supabase中已有的最后一天为起点
+    """
+    supabase_last_row = await get_supabase_table_latest_row(table_name, gwid, column)
+    if supabase_last_row is None:
+        return None
+    return formalize_supabase_datetime(supabase_last_row)
+
+async def get_sync_checkpoint(gwid, table_name, column, rebuild=False):
+    """
+    返回本次同步的(start, after)：
+    上一次中途断开时从检查点after之后继续，否则从start开始（包含），两者都为None表示从头读取
+    """
+    if rebuild:
+        await sync_watermarks.aclear(gwid, table_name)
+        return None, None
+    watermark = await sync_watermarks.aget(gwid, table_name)
+    if watermark is not None and watermark.get("column") == column:
+        # 旧的水位没有complete字段，按正常结束处理
+        if watermark.get("complete", True) is False and watermark.get("after"):
+            return None, watermark.get("after")
+        return watermark.get("value"), None
+    return await supabase_start(gwid, table_name, column), None
+
+async def get_sync_start(gwid, table_name, column, rebuild=False):
+    """
+    返回本次同步的起点（包含），None表示从头读取
+    """
+    if rebuild:
+        await sync_watermarks.aclear(gwid, table_name)
+        return None
+    watermark = await sync_watermarks.aget(gwid, table_name)
+    if watermark is not None and watermark.get("column") == column:
+        return watermark.get("value")
+    return await supabase_start(gwid, table_name, column)
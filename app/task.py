@@ -2,11 +2,25 @@ from fastapi import APIRouter, HTTPException
 from .supabase import supabase
 from pydantic import BaseModel
 from .utils import ping
+from .bulk_writer import bulk_upsert
+from .deadline import run_with_deadline
+from .task_queue import task_queue
+import asyncio
+import threading
+import uuid
 import pika
 import json
 
 mq_url = 'rmq.bingbing.tv'
 mq_port = 80
+mq_queue = 'tasks'
+
+# 本地任务队列每次领取的任务数量和同时执行的任务数量
+CLAIM_BATCH = 50
+TASK_CONCURRENCY = 8
+# 没有任务时的等待间隔（秒），以及写回supabase的间隔
+POLL_INTERVAL = 1
+FLUSH_INTERVAL = 5
 
 task = APIRouter()
 
@@ -24,50 +38,144 @@ async def change_task_status(task_id, status):
     }
     if status not in valid_status:
         raise HTTPException(status_code=400, detail="status只能是todo, doing, done")
-    res = supabase.table("tasks").update({ "status": status }).eq("task_id", task_id).execute()
+    res = await run_with_deadline(supabase.table("tasks").update({ "status": status }).eq("task_id", task_id).execute)
     return res
 
 async def set_task_result(task_id, result):
-    res = supabase.table("tasks").update({ "result": result }).eq("task_id", task_id).execute()
+    res = await run_with_deadline(supabase.table("tasks").update({ "result": result }).eq("task_id", task_id).execute)
     return res
 
 class GetTaskStatusRequest(BaseModel):
     id: str
 async def get_task_status(req: GetTaskStatusRequest):
     task_id = req.id
-    res = supabase.table("tasks").select("status").eq("task_id", task_id).execute()
+    res = await run_with_deadline(supabase.table("tasks").select("status").eq("task_id", task_id).execute)
     return res.data[0].get("status")
 
 
+def task_id_of(task):
+    if isinstance(task, dict):
+        return task.get("task_id") or task.get("id")
+    return getattr(task, "id", None)
+
 async def perform_task(task):
-    task_id = task.get("id")
-    command = task.get("cmd")
-    data = task.get("data")
-    task_id = task.id
+    """
+    执行supabase的tasks表中的一个任务。状态保存在本地任务队列中：
+    领取（todo -> doing）、写入结果和状态都是本地事务，定期批量写回supabase
+    """
+    task_id = task_id_of(task)
     if task_id is None:
         raise HTTPException(status_code=400, detail="task_id不能为空")
-    # 1. 检查task的状态是否为todo,如果不是todo则不做任何处理，直接结束
-    gts_req = GetTaskStatusRequest(id=task_id)
-    status = await get_task_status(gts_req)
-    if status != "todo":
+    results = await perform_tasks([task], remote=True)
+    if len(results) == 0:
         return {"data": [], "result": "status不是todo,跳过"}
-    # 2. 将task的状态改变为doing, 开始执行任务
-    await change_task_status(task_id, "doing")
-    tr = TaskRequest(id=task_id, command=command, data=data)
-    # 3. 执行，按照执行结果分情况处理
-    # 3.0 执行
-    res = await run_single_task(tr)
-    # 3.1.1 将结果写回到result字段
-    await set_task_result(task_id, res)
-    if "error" not in res:
-        # 3.1 执行成功：将task的状态改变为done
-        await change_task_status(task_id, "done")
+    return results[0][2]
+
+def task_item(task):
+    if isinstance(task, dict):
+        command = task.get("cmd") or task.get("command")
+        data = task.get("data")
     else:
-        # 3.2 执行失败：将task的状态改变为todo，将错误信息写入task的result字段
-        await change_task_status(task_id, "todo")
-    return res
+        command = task.command
+        data = task.data
+    return {"task_id": task_id_of(task) or str(uuid.uuid4()), "cmd": command, "data": data or {}}
+
+async def perform_tasks(tasks, concurrency=TASK_CONCURRENCY, queue=task_queue, remote=False):
+    """
+    批量执行任务：一个事务写入并领取，最多concurrency个同时执行，一个事务写入结果。
+    task_id已经存在并且不是todo的任务跳过；返回[(task_id, ok, result)]。
+    remote为True表示任务来自supabase的tasks表，结果会写回
+    """
+    items = [task_item(t) for t in tasks]
+    await asyncio.to_thread(queue.put, items, remote)
+    claimed = await asyncio.to_thread(queue.claim, len(items), [item["task_id"] for item in items])
+    results = await execute_claimed(claimed, concurrency)
+    await asyncio.to_thread(queue.finish, results)
+    return results
+
+async def execute_claimed(claimed, concurrency=TASK_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with semaphore:
+            res = await execute_task(item)
+        return (item["task_id"], "error" not in res, res)
+
+    return await asyncio.gather(*[one(item) for item in claimed])
+
+async def execute_task(claimed):
+    tr = TaskRequest(id=claimed["task_id"], command=claimed["cmd"] or "", data=claimed["data"] or {})
+    try:
+        res = await run_single_task(tr)
+    except Exception as e:
+        print(f"[TaskRunner]: task failed, task_id = {tr.id}, error = {e}")
+        return {"error": str(getattr(e, "detail", e))}
+    if isinstance(res, dict):
+        return res
+    # supabase的返回结果等对象转换为dict，保存到result字段
+    return {"data": getattr(res, "data", str(res))}
+
+class TaskRunner:
+    """
+    后台执行本地任务队列中的任务：按批领取，最多TASK_CONCURRENCY个同时执行，
+    一批完成后在一个事务中写入结果；每FLUSH_INTERVAL秒把变化的任务批量写回supabase
+    """
+    def __init__(self, queue=task_queue, batch=CLAIM_BATCH, concurrency=TASK_CONCURRENCY):
+        self.queue = queue
+        self.batch = batch
+        self.concurrency = concurrency
+        self._task = None
+        self._flush_task = None
+
+    async def run_batch(self):
+        claimed = await asyncio.to_thread(self.queue.claim, self.batch)
+        if len(claimed) == 0:
+            return 0
+        results = await execute_claimed(claimed, self.concurrency)
+        await asyncio.to_thread(self.queue.finish, results)
+        return len(results)
+
+    async def run(self):
+        while True:
+            try:
+                count = await self.run_batch()
+            except Exception as e:
+                print(f"[TaskRunner]: run batch failed, error = {e}")
+                count = 0
+            if count == 0:
+                await asyncio.sleep(POLL_INTERVAL)
 
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.queue.flush()
+            except Exception as e:
+                print(f"[TaskRunner]: flush failed, error = {e}")
 
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush_loop())
+
+    async def stop(self):
+        for t in (self._task, self._flush_task):
+            if t is not None:
+                t.cancel()
+                try:
+                    await t
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._flush_task = None
+        # 退出前把最后的状态写回supabase
+        try:
+            await self.queue.flush()
+        except Exception as e:
+            print(f"[TaskRunner]: final flush failed, error = {e}")
+
+task_runner = TaskRunner()
 
 # async def fetch_task_list(background_tasks: BackgroundTasks):
 #     res = supabase.table("tasks").select("*").eq("status", "todo").execute()
@@ -86,7 +194,8 @@ async def insert_supabase(id, data):
     # get table_data
     if table_data is None:
         raise HTTPException(status_code=400, detail="table_data不能为空")
-    res = supabase.table(table_name).insert(table_data).execute()
+    # 在线程中执行，不阻塞worker的事件循环
+    res = await run_with_deadline(supabase.table(table_name).insert(table_data).execute)
     return res
 
 async def upsert_supabase(id, data):
@@ -108,13 +217,19 @@ async def upsert_supabase(id, data):
     #     res = supabase.table(table_name).insert(table_data).execute()
     #     return res
     # else:
+    if strategy == "UPSERT" and isinstance(table_data, list):
+        # 多行数据分块并行写入，返回每个分块的结果；有失败的分块时带上error，任务会被重试
+        report = await bulk_upsert(table_name, table_data, data.get("on_conflict"))
+        if report["failed"] > 0:
+            report["error"] = f"{report['failed']}/{report['rows']} rows failed"
+        return report
     if strategy == "UPSERT":
         # r = supabase.table(table_name).update(table_data)
         # for i in range(len(keys)):
         #   r = r.eq(keys[i], table_data[keys[i]])
         # res = r.execute()
         # return res
-        return supabase.table(table_name).upsert(table_data).execute()
+        return await run_with_deadline(supabase.table(table_name).upsert(table_data).execute)
     else: # IGNORE
         return {"data": [], "count": 0 }
 
@@ -138,17 +253,18 @@ def set_supabase_gateway_status(gwid: str, is_online: bool):
 
 async def ping_server(id, data):
     gwid = data.get("gwid")
-    address = get_address_for_gwid(gwid)
+    # supabase查询和ping都是阻塞调用，在线程中执行，同一批的任务可以并发
+    address = await run_with_deadline(get_address_for_gwid, gwid)
     # ping this address
     if address is None:
-        return set_supabase_gateway_status(gwid, False)
+        return await run_with_deadline(set_supabase_gateway_status, gwid, False)
     else:
         # use util's ping function
-        val = ping(address)
+        val = await run_with_deadline(ping, address)
         if val is False:
-            return set_supabase_gateway_status(gwid, False)
+            return await run_with_deadline(set_supabase_gateway_status, gwid, False)
         else:
-            return set_supabase_gateway_status(gwid, True)
+            return await run_with_deadline(set_supabase_gateway_status, gwid, True)
 
 @task.post("/run_single_task", tags=["task"])
 async def run_single_task(request: TaskRequest):
@@ -165,14 +281,92 @@ async def run_single_task(request: TaskRequest):
         return {"error": "command not found"}
     
 async def post_single_task(task):
-    return supabase.table("tasks").insert(task).execute()
+    return await run_with_deadline(supabase.table("tasks").insert(task).execute)
+
+class MqPublisher:
+    """
+    持久的rabbitmq连接，开启publisher confirms：basic_publish在broker确认之后才返回，
+    连接断开时重新连接一次再发送。BlockingConnection不是线程安全的，发送时加锁
+    """
+    def __init__(self, host=mq_url, port=mq_port, queue=mq_queue):
+        self.host = host
+        self.port = port
+        self.queue = queue
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+
+    def _connect(self):
+        self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host, port=self.port))
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=self.queue)
+        self._channel.confirm_delivery()
+
+    def _publish(self, bodies):
+        if self._channel is None or self._channel.is_closed or self._connection.is_closed:
+            self._connect()
+        # 处理心跳，避免空闲的连接被broker关闭
+        self._connection.process_data_events(time_limit=0)
+        properties = pika.BasicProperties(delivery_mode=2, content_type="application/json")
+        for body in bodies:
+            self._channel.basic_publish(exchange='', routing_key=self.queue, body=body, properties=properties, mandatory=True)
+
+    def publish(self, tasks):
+        """
+        发送一批任务，全部被broker确认后返回发送的数量
+        """
+        bodies = [json.dumps(t) for t in tasks]
+        with self._lock:
+            try:
+                self._publish(bodies)
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError, pika.exceptions.StreamLostError) as e:
+                print(f"[MqPublisher]: reconnect, error = {e}")
+                self.close()
+                self._publish(bodies)
+        return len(bodies)
+
+    def close(self):
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except Exception as e:
+            print(f"[MqPublisher]: close failed, error = {e}")
+        self._connection = None
+        self._channel = None
+
+mq_publisher = MqPublisher()
 
 @task.post("/post_single_task", tags=["task"])
 async def post_single_task_mq(task):
-    # TODO
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=mq_url, port=mq_port))
-    channel = connection.channel()
-    channel.queue_declare(queue='tasks')
-    # 发送任务到队列中
-    channel.basic_publish(exchange='',routing_key='tasks', body=json.dumps(task))
-    print(f"[x] send {json.dumps(task)}")
\ No newline at end of file
+    # 使用持久连接发送任务到队列中，等待broker确认
+    await asyncio.to_thread(mq_publisher.publish, [task])
+    print(f"[x] send {json.dumps(task)}")
+    return {"result": "success"}
+
+class EnqueueTasksRequest(BaseModel):
+    tasks: list[dict]
+
+@task.post("/enqueue_tasks", tags=["task"])
+async def enqueue_tasks(request: EnqueueTasksRequest):
+    """
+    把任务写入本地任务队列，由task_runner在后台执行。
+    每个任务为{"cmd", "data"}，可选task_id（重复的task_id只保留一个）
+    """
+    tasks = [{"task_id": t.get("task_id") or str(uuid.uuid4()), "cmd": t.get("cmd"), "data": t.get("data") or {}} for t in request.tasks]
+    count = await asyncio.to_thread(task_queue.put, tasks)
+    return {"task_ids": [t["task_id"] for t in tasks], "inserted": count}
+
+class LocalTaskStatusRequest(BaseModel):
+    id: str | None = None
+
+@task.post("/local_task_status", tags=["task"])
+async def local_task_status(request: LocalTaskStatusRequest):
+    """
+    查询本地任务队列：id不为空时返回单个任务，否则返回每个状态的任务数量和待写回的数量
+    """
+    if request.id is not None:
+        item = await asyncio.to_thread(task_queue.get, request.id)
+        if item is None:
+            raise HTTPException(status_code=404, detail=f"任务不存在: {request.id}")
+        return {"data": item}
+    return {"data": await asyncio.to_thread(task_queue.stats)}
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from .bulk_writer import bulk_upsert
+
+# 本地任务队列的数据库文件
+TASK_DB = os.environ.get("TASK_QUEUE_DB", "data/tasks.db")
+# doing状态超过CLAIM_LEASE秒没有结束（例如进程退出），可以被重新领取
+CLAIM_LEASE = 300
+# 任务最多领取的次数（领取时计数，执行中进程退出也算一次），用完之后进入failed状态
+MAX_ATTEMPTS = 5
+# 每次写回supabase的最大行数
+FLUSH_BATCH = 500
+# 本地的failed状态（领取次数用完）写回supabase时使用的状态：tasks表只有todo/doing/done，
+# 和原来执行失败时一样写回todo，错误信息在result中
+REMOTE_STATUS = {"failed": "todo"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    cmd TEXT,
+    data TEXT,
+    status TEXT NOT NULL DEFAULT 'todo',
+    result TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    updated_at REAL NOT NULL,
+    remote INTEGER NOT NULL DEFAULT 0,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    flush_failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, attempts);
+CREATE INDEX IF NOT EXISTS tasks_dirty ON tasks (dirty, flush_failed);
+"""
+# 旧版本创建的数据库文件中缺少的列
+_COLUMNS = {
+    "remote": "INTEGER NOT NULL DEFAULT 0",
+    "flush_failed": "INTEGER NOT NULL DEFAULT 0",
+}
+
+def dump_result(result):
+    return json.dumps(result, ensure_ascii=False, default=str)
+
+def load_result(text):
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+class LocalTaskQueue:
+    """
+    SQLite（WAL模式）中的持久任务队列，取代每个任务对supabase tasks表的多次读写:
+    - put: 写入todo任务，task_id相同的任务只保留一个
+    - claim: 在一个事务中把一批todo任务改成doing并计数，多个进程同时领取不会重复
+    - finish: 一个事务中批量写入结果和状态，失败并且领取次数用完的任务改为failed
+    - 状态变化只在本地记录，supabase的tasks表中已有的任务（remote）标记为dirty，
+      由flush定期批量写回status和result；celery等只在本地的任务不写回
+    """
+    def __init__(self, path=TASK_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None：自己控制事务
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(tasks)")}
+            for name, definition in _COLUMNS.items():
+                if len(columns) > 0 and name not in columns:
+                    conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {definition}")
+            if len(columns) > 0 and "remote" not in columns:
+                # 旧版本中的任务都来自celery或者本地接口，supabase中没有对应的行，不再写回
+                conn.execute("UPDATE tasks SET dirty = 0")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def put(self, tasks, remote=False):
+        """
+        tasks: [{"task_id", "cmd", "data"}]，返回新写入的数量。
+        remote为True表示任务来自supabase的tasks表，状态变化需要写回
+        """
+        now = time.time()
+        remote = 1 if remote else 0
+        rows = [(t["task_id"], t.get("cmd"), dump_result(t.get("data") or {}), now, remote) for t in tasks]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO tasks (task_id, cmd, data, updated_at, remote) VALUES (?, ?, ?, ?, ?)", rows)
+            count = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def claim(self, limit=1, task_ids=None, lease=CLAIM_LEASE):
+        """
+        领取最多limit个任务（todo，或者doing但是已经超时），返回[{"task_id", "cmd", "data", "attempts"}]
+        attempts是包含本次在内的领取次数；task_ids不为空时只领取其中的任务
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 超时的doing任务如果已经用完次数（例如每次执行都让进程退出），不再领取
+            conn.execute("UPDATE tasks SET status = 'failed', claimed_at = NULL, updated_at = ?, dirty = remote "
+                         "WHERE status = 'doing' AND claimed_at < ? AND attempts >= ?", (now, now - lease, MAX_ATTEMPTS))
+            sql = "SELECT task_id, cmd, data, attempts FROM tasks WHERE (status = 'todo' OR (status = 'doing' AND claimed_at < ?)) AND attempts < ?"
+            args = [now - lease, MAX_ATTEMPTS]
+            if task_ids is not None:
+                sql += f" AND task_id IN ({','.join('?' * len(task_ids))})"
+                args.extend(task_ids)
+            sql += " ORDER BY rowid LIMIT ?"
+            args.append(limit)
+            rows = conn.execute(sql, args).fetchall()
+            conn.executemany("UPDATE tasks SET status = 'doing', attempts = attempts + 1, claimed_at = ?, updated_at = ?, dirty = remote WHERE task_id = ?",
+                             [(now, now, row["task_id"]) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [{"task_id": row["task_id"], "cmd": row["cmd"], "data": json.loads(row["data"] or "{}"), "attempts": row["attempts"] + 1} for row in rows]
+
+    def finish(self, results):
+        """
+        results: [(task_id, ok, result)]，成功的任务改为done，失败的改回todo等待重试，
+        已经用完领取次数的改为failed
+        """
+        now = time.time()
+        rows = [{"status": "done" if ok else "todo", "max_attempts": MAX_ATTEMPTS, "result": dump_result(result), "now": now, "task_id": task_id}
+                for task_id, ok, result in results]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE tasks SET status = CASE WHEN :status = 'todo' AND attempts >= :max_attempts THEN 'failed' ELSE :status END, "
+                             "result = :result, claimed_at = NULL, updated_at = :now, dirty = remote WHERE task_id = :task_id", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, task_id):
+        row = self._conn().execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) AS count, SUM(dirty) AS dirty FROM tasks GROUP BY status").fetchall()
+        return {row["status"]: {"count": row["count"], "dirty": row["dirty"]} for row in rows}
+
+    def dirty(self, limit=FLUSH_BATCH, flush_failed=False):
+        """
+        需要写回的任务；flush_failed为True时返回批量写回被拒绝过、需要逐个写回的任务
+        """
+        rows = self._conn().execute("SELECT task_id, status, result, updated_at FROM tasks WHERE dirty = 1 AND flush_failed = ? LIMIT ?",
+                                    (1 if flush_failed else 0, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_clean(self, rows):
+        """
+        写回supabase之后清除dirty，期间又发生变化（updated_at不同）的任务保留到下一次
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE tasks SET dirty = 0, flush_failed = 0 WHERE task_id = ? AND updated_at = ?",
+                             [(row["task_id"], row["updated_at"]) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def mark_flush_failed(self, rows):
+        """
+        批量写回被supabase拒绝（不是可以重试的错误），之后逐个写回，找出具体是哪一行
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE tasks SET flush_failed = 1 WHERE task_id = ?", [(row["task_id"],) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def flush(self, limit=FLUSH_BATCH):
+        """
+        把本地变化的任务批量写回supabase的tasks表（只写status和result），返回写回的数量:
+        - 可以重试的错误（supabase不可用）保留dirty，下一次重新写回
+        - 被拒绝的批次改为逐个写回，仍然被拒绝的行不再写回
+        """
+        total = 0
+        while True:
+            rows = await asyncio.to_thread(self.dirty, limit)
+            if len(rows) == 0:
+                break
+            report = await bulk_upsert("tasks", [remote_row(row) for row in rows], on_conflict="task_id")
+            if report["failed"] > 0:
+                print(f"[LocalTaskQueue]: flush failed, rows = {report['failed']}/{report['rows']}")
+                if transient(report):
+                    return total
+                await asyncio.to_thread(self.mark_flush_failed, rows)
+                continue
+            await asyncio.to_thread(self.mark_clean, rows)
+            total += len(rows)
+            if len(rows) < limit:
+                break
+        for row in await asyncio.to_thread(self.dirty, limit, True):
+            report = await bulk_upsert("tasks", [remote_row(row)], on_conflict="task_id")
+            if report["failed"] > 0 and transient(report):
+                return total
+            if report["failed"] > 0:
+                errors = [c["error"] for c in report["chunks"] if c["status"] == "failed"]
+                print(f"[LocalTaskQueue]: drop task from flush, task_id = {row['task_id']}, error = {errors}")
+            else:
+                total += 1
+            await asyncio.to_thread(self.mark_clean, [row])
+        return total
+
+def remote_row(row):
+    return {
+        "task_id": row["task_id"],
+        "status": REMOTE_STATUS.get(row["status"], row["status"]),
+        "result": load_result(row["result"]),
+    }
+
+def transient(report):
+    """
+    失败的分块中有可以重试的错误（重试次数用完），说明是supabase暂时不可用，不是数据的问题
+    """
+    return any(c.get("retryable") for c in report["chunks"] if c["status"] == "failed")
+
+task_queue = LocalTaskQueue()
@@ -1,9 +1,11 @@
 import luigi
 import json
+import asyncio
 import logging
 from typing import List, Dict
-from ..supabase import supabase
-from ..utils import get_gw_users_list, upsert_user
+from ..utils import get_gw_users_list, prepare_user
+from ..bulk_writer import bulk_upsert
+from ..fleet_users import run_fleet_user_sync
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +21,28 @@ if not logger.handlers:
     logger.addHandler(logging.StreamHandler())
     logger.addHandler(logging.FileHandler("luigi.log"))
 
+def bulk_write(table_name, rows, on_conflict=None):
+    """
+    分块批量upsert，记录每个失败的分块；有失败的分块时抛出异常，luigi会把任务标记为失败
+    """
+    report = asyncio.run(bulk_upsert(table_name, rows, on_conflict=on_conflict))
+    errors = []
+    for chunk in report["chunks"]:
+        if chunk["status"] == "failed":
+            logger.error(f"upsert {table_name} chunk {chunk['index']} failed, rows = {chunk['rows']}, error = {chunk['error']}")
+            errors.append({"index": chunk["index"], "rows": chunk["rows"], "error": chunk["error"]})
+    logger.info(f"upsert {table_name}: rows = {report['rows']}, written = {report['written']}, failed = {report['failed']}, chunks = {len(report['chunks'])}")
+    if len(errors) > 0:
+        raise Exception(f"Supabase操作失败: {table_name}, {report['failed']}/{report['rows']} rows, chunks = {errors}")
+    return {"status": "success", "count": report["rows"], "written": report["written"], "chunks": len(report["chunks"])}
+
+def upsert_users(users):
+    """
+    按global_id批量upsert用户到gw_users表
+    """
+    rows = [prepare_user(user) for user in users]
+    return bulk_write("gw_users", rows, on_conflict="global_id")
+
 class UpsertDeviceToSupabase(luigi.Task):
     """
     将设备列表数据upsert到Supabase的device_list表
@@ -33,16 +57,11 @@ class UpsertDeviceToSupabase(luigi.Task):
             devices: List[Dict] = json.loads(self.device_json)
         except json.JSONDecodeError as e:
             raise ValueError("无效的JSON格式数据") from e
-        # 批量执行upsert操作
-        for device in devices:
-            # 执行upsert操作
-            response = supabase.table("device_list").upsert(device).execute()
-            # 检查错误（supabase-python的响应结构可能不同，请根据实际情况调整）
-            if hasattr(response, 'error') and response.error:
-                raise Exception(f"Supabase操作失败: {response.error}")
+        # 分块批量执行upsert操作
+        result = bulk_write("device_list", devices)
         # 写入完成标记
         with self.output().open("w") as f:
-            f.write(json.dumps({"status": "success", "count": len(devices)}))
+            f.write(json.dumps(result))
     def output(self):
         """任务完成标记文件"""
         return luigi.LocalTarget(f"data/upsert_complete_{self.task_id}.json")
@@ -65,22 +84,11 @@ class UpsertUsersToSupabase(luigi.Task):
         except json.JSONDecodeError as e:
             raise ValueError("无效的JSON格式数据") from e
 
-        # 批量执行upsert操作
-        for user in users:
-            # if "online" in user:
-            #     #删除online字段
-            #     del user["online"]
-            # 执行upsert操作
-            logger.info(f"upsert user: {user}")
-            response = upsert_user(user)
-            # response = supabase.table("gw_users").upsert(user).execute()
-            # 检查错误（supabase-python的响应结构可能不同，请根据实际情况调整）
-            logger.info(f"response: {response}")
-            if hasattr(response, 'error') and response.error:
-                raise Exception(f"Supabase操作失败: {response.error}")
+        # 按global_id分块批量执行upsert操作
+        result = upsert_users(users)
         # 写入完成标记
         with self.output().open("w") as f:
-            f.write(json.dumps({"status": "success", "count": len(users)}))
+            f.write(json.dumps(result))
 
     def output(self):
         """任务完成标记文件"""
@@ -127,19 +135,32 @@ class SyncGwUsers(luigi.Task):
             except json.JSONDecodeError as e:
                 raise ValueError("无效的JSON格式数据") from e
 
-            # 批量执行upsert操作
-            for user in users:
-                # if "online" in user:
-                #     #删除online字段
-                #     del user["online"]
-                # 执行upsert操作
-                logger.info(f"upsert user: {user}")
-                response = upsert_user(user)
-                # response = supabase.table("gw_users").upsert(user).execute()
-                # 检查错误（supabase-python的响应结构可能不同，请根据实际情况调整）
-                logger.info(f"response: {response}")
-                if hasattr(response, 'error') and response.error:
-                    raise Exception(f"Supabase操作失败: {response.error}")
+            # 按global_id分块批量执行upsert操作
+            result = upsert_users(users)
             # 写入完成标记
-            outfile.write(json.dumps({"status": "success", "count": len(users)}))
-    
\ No newline at end of file
+            outfile.write(json.dumps(result))
+    
+
+class SyncFleetUsers(luigi.Task):
+    """
+    在一次任务中同步多个网关的账号、组、带宽策略和虚拟组成员，见fleet_users.FleetUserSync
+    参数说明：
+    - gwids: 需要同步的网关列表，为空时同步所有在线的网关
+    - run_id: 区分不同的运行（例如日期或者时间戳），相同参数的任务完成后不会重复运行
+    """
+    gwids = luigi.ListParameter(default=[])
+    run_id = luigi.Parameter(default="")
+
+    def run(self):
+        # 与celery定时任务使用同一个全舰队同步（账号、组、带宽策略和虚拟组成员）
+        result = asyncio.run(run_fleet_user_sync(list(self.gwids) or None))
+        logger.info(f"sync fleet users: {result}")
+        if result["state"] != "success":
+            raise Exception(f"全舰队用户同步失败: {result.get('error')}, writes = {result['writes']}")
+        # 写入完成标记，读取失败的网关记录在结果中
+        with self.output().open("w") as f:
+            f.write(json.dumps(result, default=str))
+
+    def output(self):
+        """任务完成标记文件"""
+        return luigi.LocalTarget(f"data/sync_fleet_users_complete_{self.task_id}.json")
@@ -9,7 +9,11 @@ import json
 import time
 import ipaddress
 from fastapi import HTTPException
-from .sdk import SDK
+from .gw_session import session_manager
+from .gw_registry import gateway_registry, CachedResponse
+from .gw_liveness import gateway_liveness
+from .gw_breaker import gateway_breakers, GatewayUnavailable
+from .deadline import DeadlineExceeded
 from datetime import datetime, date
 import calendar
 import os
@@ -17,7 +21,7 @@ import asyncio
 from .config import Config
 from multiping import multi_ping
 from pydantic_settings import BaseSettings
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 
 # 环境变量配置类
 class _Settings(BaseSettings):
@@ -148,8 +152,9 @@ def is_valid_netloc(netloc):
     return is_valid_ipv4(netloc) or is_valid_domain(netloc)
 
 async def get_gateway_by_id(gwid: str):
-    response = supabase.table("gateway").select("*").eq("id", gwid).execute()
-    return response
+    # 优先从进程内的网关缓存读取，未命中时才访问supabase
+    row = await gateway_registry.aget(gwid)
+    return CachedResponse([row] if row is not None else [])
 
 def is_url(url):
     try:
@@ -184,11 +189,10 @@ def ping(host):
     command = ['ping', param, '1', host]
     return subprocess.call(command) == 0
 
-def upsert_user(user):
+def prepare_user(user):
     """
-    将用户列表数据upsert到Supabase的gw_user表
+    补齐gw_users表需要的global_id和online字段
     """
-    TABLE_NAME = "gw_users"
     gwid = user["gwid"]
     id = user["id"]
     global_id = f"{gwid}_{id}"
@@ -196,6 +200,14 @@ def upsert_user(user):
     online = user.get("online")
     if online is None:
         user["online"] = "true"
+    return user
+
+def upsert_user(user):
+    """
+    将用户列表数据upsert到Supabase的gw_user表
+    """
+    TABLE_NAME = "gw_users"
+    user = prepare_user(user)
     response = supabase.table(TABLE_NAME).upsert(user).execute()
     return response
 
@@ -204,22 +216,26 @@ def batch_update_gw_strategy(strategy_list):
     将策略列表数据批量upsert到Supabase的gw_strategy表
     """
     TABLE_NAME = "gw_bandwidth_strategy"
-    list = []
-    for item in strategy_list:
-        r = {}
-        gwid = item.get("gwid")
-        id = item.get("id")
-        r["gwid"] = gwid
-        r["id"] = id
-        r["strategy_id"] = f"{gwid}_{id}"
-        r["period"] = item["period"]
-        r["threshold"] = item["threshold"]
-        r["exceed"] = item["exceed"]
-        r["remark"] = item["remark"]
-        list.append(r)
+    list = [gw_strategy_row(item) for item in strategy_list]
     response = supabase.table(TABLE_NAME).upsert(list).execute()
     return response
 
+def gw_strategy_row(item):
+    """
+    网关上的带宽策略转换为gw_bandwidth_strategy表的一行
+    """
+    r = {}
+    gwid = item.get("gwid")
+    id = item.get("id")
+    r["gwid"] = gwid
+    r["id"] = id
+    r["strategy_id"] = f"{gwid}_{id}"
+    r["period"] = item["period"]
+    r["threshold"] = item["threshold"]
+    r["exceed"] = item["exceed"]
+    r["remark"] = item["remark"]
+    return r
+
 def batch_update_gw_group(group_list):
     """
     将策略列表数据批量upsert到Supabase的gw_groups表,同步下列域:
@@ -236,26 +252,30 @@ def batch_update_gw_group(group_list):
     11. anonymous
     """
     TABLE_NAME = "gw_groups"
-    list = []
-    for item in group_list:
-        r = {}
-        gwid = item.get("gwid")
-        id = item.get("id")
-        r["gwid"] = gwid
-        r["id"] = id
-        r["global_id"] = f"{gwid}_{id}"
-        r["name"] = item.get("name")
-        r["virtual"] = item.get("virtual")
-        r["alias"] = item.get("alias")
-        r["alias_zh_cn"] = item.get("alias_zh_cn")
-        r["alias_en_us"] = item.get("alias_en_us")
-        r["index"] = item.get("index")
-        r["type"] = item.get("type")
-        r["anonymous"] = item.get("anonymous")
-        list.append(r)
+    list = [gw_group_row(item) for item in group_list]
     response = supabase.table(TABLE_NAME).upsert(list).execute()
     return response
 
+def gw_group_row(item):
+    """
+    网关上的组转换为gw_groups表的一行
+    """
+    r = {}
+    gwid = item.get("gwid")
+    id = item.get("id")
+    r["gwid"] = gwid
+    r["id"] = id
+    r["global_id"] = f"{gwid}_{id}"
+    r["name"] = item.get("name")
+    r["virtual"] = item.get("virtual")
+    r["alias"] = item.get("alias")
+    r["alias_zh_cn"] = item.get("alias_zh_cn")
+    r["alias_en_us"] = item.get("alias_en_us")
+    r["index"] = item.get("index")
+    r["type"] = item.get("type")
+    r["anonymous"] = item.get("anonymous")
+    return r
+
 def batch_update_users_group(user_group_list):
     """
     将用户和表之间的关系，更新到gw_users表中的virtual_group字段。
@@ -317,8 +337,9 @@ def setkv(type, id, key, value):
 def gw_login(gwid:str):
     print("==gw_login")
     try:
-        # 从supabase获取网关信息
-        gw = supabase.table("gateway").select("*").eq("id", gwid).execute()
+        # 从网关缓存获取网关信息
+        row = gateway_registry.get(gwid)
+        gw = CachedResponse([row] if row is not None else [])
     except Exception as e:
         # 如果没有获取到，抛出网关不在列表中的错误信息
         raise HTTPException(status_code=400, detail="网关不在列表中")
@@ -329,11 +350,14 @@ def gw_login(gwid:str):
     username = gw.data[0].get('username')
     password = gw.data[0].get('password')
     address = gw.data[0].get('address')
+    # 熔断中的网关直接返回503，不再探测和登录
+    if gateway_breakers.is_open(gwid):
+        raise GatewayUnavailable(gwid)
     # 初始化online变量值为False
     online = False
     try:
-        # 调用is_online来判断对应的地址是否在线
-        online = is_online(address)
+        # 读取后台探测的在线状态，没有缓存时才立即探测
+        online = gateway_liveness.check_sync(gwid, address)
     except Exception as e:
         # 如果过程中发生问题，说明网关不在线
         raise HTTPException(status_code=400, detail="网关不在线1")
@@ -343,16 +367,59 @@ def gw_login(gwid:str):
     
     # TODO:增加要ping通网关才行
     try:
-        # get gateway username, password and address
-        sdk = SDK()
-        if sdk.login(address, username, password):
+        # 复用session池中缓存的session，不再每次login/logout
+        sdk = session_manager.acquire_sync(gwid, address, username, password)
+        if sdk is not None:
             yield sdk
         else:
             raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@asynccontextmanager
+async def async_gw_login(gwid:str):
+    """
+    gw_login的异步版本，yield一个已登录的AsyncSDK。
+    ping和网关调用都不会阻塞事件循环。
+    """
+    print("==async_gw_login")
+    try:
+        # 从网关缓存获取网关信息
+        gw = await get_gateway_by_id(gwid)
+    except Exception as e:
+        # 如果没有获取到，抛出网关不在列表中的错误信息
+        raise HTTPException(status_code=400, detail="网关不在列表中")
+    # 如果成功获取supabase的列表但是列表内容为空， 则返回未找到网关
+    if gw is None or len(gw.data) == 0:
+        raise HTTPException(status_code=400, detail="未找到网关")
+    # 获取用户名、密码和地址
+    username = gw.data[0].get('username')
+    password = gw.data[0].get('password')
+    address = gw.data[0].get('address')
+    # 熔断中的网关直接返回503，不再探测和登录
+    if gateway_breakers.is_open(gwid):
+        raise GatewayUnavailable(gwid)
+    online = False
+    try:
+        # 读取后台探测的在线状态，没有缓存时才立即探测
+        online = await gateway_liveness.check(gwid, address)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="网关不在线1")
+    if online is False:
+        raise HTTPException(status_code=400, detail="网关不在线")
+    try:
+        # 复用session池中缓存的session，不再每次login/logout
+        sdk = await session_manager.acquire(gwid, address, username, password)
+        if sdk is not None:
+            yield sdk
+        else:
+            raise HTTPException(status_code=401, detail="登录失败")
+    except (GatewayUnavailable, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        sdk.logout()
 
 def get_date_obj_from_str(s):
     # 如果s是以/作为分隔符，将/替换为-
@@ -407,6 +474,32 @@ def get_basic_rpc_result(data):
                 return p
     return None
 
+def parse_gw_users(gwid: str, p):
+    """
+    将list_account的values解析为用户列表
+    """
+    lst = []
+    for key, value in p.items():
+        if value[".type"] == "wfuser" and key != "admin":
+            user = {
+                "gwid": gwid,
+                "username": value["username"],
+                "remark": value.get("remark") or "",
+                "pppoe": value["pppoe"],
+                "webauth": value["webauth"],
+                "static": value["static"],
+                "staticip": value["staticip"],
+                "datelimit": value["datelimit"],
+                "group": value["group"],
+                "logins": value["logins"],
+                "macbound": value["macbound"],
+                "changepwd": value["changepwd"],
+                "id": value.get("id") or "",
+                # "online": str(get_gw_online_status_by_id(gwid, value["id"]))
+            }
+            lst.append(user)
+    return lst
+
 # 从网关设备sdk中读取用户列表
 def get_gw_users_list(gwid: str):
     with gw_login(gwid) as sdk_obj:
@@ -415,30 +508,17 @@ def get_gw_users_list(gwid: str):
         p = get_basic_rpc_result(p)
         print("====list_account, get_basic_rpc_result p = ", str(p))
         p = p["values"]
-        print("====list_account, value p = ", str(p))
-        
-        lst = []   
-        for key, value in p.items():
-            if value[".type"] == "wfuser" and key != "admin":
-                print("====list_account, value = ", str(value))
-                user = {
-                    "gwid": gwid,
-                    "username": value["username"],
-                    "remark": value.get("remark") or "",
-                    "pppoe": value["pppoe"],
-                    "webauth": value["webauth"],
-                    "static": value["static"],
-                    "staticip": value["staticip"],
-                    "datelimit": value["datelimit"],
-                    "group": value["group"],
-                    "logins": value["logins"],
-                    "macbound": value["macbound"],
-                    "changepwd": value["changepwd"],
-                    "id": value.get("id") or "",
-                    # "online": str(get_gw_online_status_by_id(gwid, value["id"]))
-                }
-                lst.append(user)
-        return lst
+        return parse_gw_users(gwid, p)
+
+async def fetch_gw_users_list(gwid: str):
+    """
+    get_gw_users_list的异步版本，在async的接口中使用
+    """
+    async with async_gw_login(gwid) as sdk_obj:
+        p = await sdk_obj.list_account()
+        p = get_basic_rpc_result(p)
+        p = p["values"]
+        return parse_gw_users(gwid, p)
     
 def get_milliseconds():
     milis = int(round(time.time() * 1000))
@@ -575,8 +655,8 @@ async def get_device_count(gwid):
     如果发生错误，则返回0
     """
     try:
-        with gw_login(gwid) as sdk_obj:
-            r = sdk_obj.list_online_users(1000, "")
+        async with async_gw_login(gwid) as sdk_obj:
+            r = await sdk_obj.list_online_users(1000, "")
             r = get_basic_rpc_result(r)
             r = str_strip(r["result"])
             print(r)
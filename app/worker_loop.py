@@ -0,0 +1,63 @@
+import os
+import asyncio
+import threading
+from .sdk import close_async_client
+from .gw_session import session_manager
+
+class WorkerLoop:
+    """
+    celery worker进程中长期运行的事件循环，运行在后台线程中。
+    所有任务提交到同一个循环执行，共享的httpx连接池和网关session在任务之间复用，
+    不再像asyncio.run那样每个任务创建和关闭一次
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            # fork之后子进程里继承的循环不可用，按pid重新创建
+            if self.loop is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="worker-loop", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """
+        在共享的循环中执行coro，阻塞等待结果；可以从多个线程同时调用
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def spawn(self, coro):
+        """
+        在共享的循环中启动一个后台协程，不等待结果
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _close(self):
+        await session_manager.close_all()
+        await close_async_client()
+
+    def stop(self):
+        if self.loop is None or self.pid != os.getpid():
+            return
+        try:
+            self.run(self._close())
+        except Exception as e:
+            print(f"[WorkerLoop]: close clients failed, error = {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop = None
+        self.thread = None
+
+worker_loop = WorkerLoop()
@@ -0,0 +1,14 @@
+import os
+import sys
+
+# 单元测试不访问外部服务，只需要能创建客户端；已经配置的环境变量不覆盖
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "test")
+os.environ.setdefault("UPSTASH_URL", "http://localhost:8079")
+os.environ.setdefault("UPSTASH_KEY", "test")
+os.environ.setdefault("APP_NEO4J_URI", "bolt://localhost:7687")
+os.environ.setdefault("APP_NEO4J_USER", "neo4j")
+os.environ.setdefault("APP_NEO4J_PASSWORD", "test")
+os.environ.setdefault("APP_RATIO_FILE", "ratio.csv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+import httpx
+from postgrest.exceptions import APIError, generate_default_error_message
+from app.bulk_writer import is_retryable, should_shrink
+
+
+def json_error(code, message="error"):
+    # PostgREST返回json错误时，postgrest-py抛出的APIError
+    return APIError({"message": message, "code": code, "hint": None, "details": None})
+
+
+def status_error(status, body=b"<html>bad gateway</html>"):
+    # 错误内容不是PostgREST的json时，code是http状态码
+    return APIError(generate_default_error_message(httpx.Response(status, content=body)))
+
+
+def test_http_status_without_json_body():
+    for status in [429, 500, 502, 503, 504]:
+        assert is_retryable(status_error(status)), status
+    for status in [400, 401, 404, 409]:
+        assert not is_retryable(status_error(status)), status
+
+
+def test_rate_limit_json_without_postgrest_fields_uses_status():
+    e = status_error(429, b'{"message": "API rate limit exceeded"}')
+    assert is_retryable(e)
+    assert should_shrink(e)
+
+
+def test_postgrest_json_errors_for_5xx_are_retried():
+    for code in ["PGRST000", "PGRST001", "PGRST002", "PGRST003", "57P01", "40001", "40P01", "08006", "53300"]:
+        assert is_retryable(json_error(code)), code
+
+
+def test_statement_timeout_retries_and_shrinks():
+    e = json_error("57014", "canceling statement due to statement timeout")
+    assert is_retryable(e)
+    assert should_shrink(e)
+
+
+def test_client_errors_are_not_retried():
+    for code in ["23505", "42P01", "PGRST204", "22P02"]:
+        assert not is_retryable(json_error(code)), code
+        assert not should_shrink(json_error(code)), code
+
+
+def test_transport_errors():
+    assert is_retryable(httpx.ConnectError("refused"))
+    assert is_retryable(httpx.ReadTimeout("timeout"))
+    assert should_shrink(httpx.ReadTimeout("timeout"))
+    assert not should_shrink(httpx.ConnectError("refused"))
+    assert not is_retryable(ValueError("x"))
+
+
+def test_write_retries_rejected_chunk_while_other_workers_wait(monkeypatch):
+    import asyncio
+    import app.bulk_writer as bulk_writer
+    from app.bulk_writer import BulkWriter
+    monkeypatch.setattr(bulk_writer, "BACKOFF_BASE", 0.01)
+    sent = []
+    failures = [status_error(503)]
+
+    def send(self, rows):
+        if failures:
+            raise failures.pop()
+        sent.extend(r["id"] for r in rows)
+
+    monkeypatch.setattr(BulkWriter, "_send", send)
+    writer = BulkWriter("t", max_rows=10, parallel=4)
+    report = asyncio.run(writer.write([{"id": i} for i in range(10)]))
+    assert sorted(sent) == list(range(10))
+    assert (report["written"], report["failed"]) == (10, 0)
+    assert [c["status"] for c in report["chunks"]] == ["retry", "ok"]
+
+
+def test_write_reports_non_retryable_failure():
+    import asyncio
+    from app.bulk_writer import BulkWriter
+
+    class Writer(BulkWriter):
+        def _send(self, rows):
+            raise json_error("23505")
+
+    report = asyncio.run(Writer("t", max_rows=2, parallel=2).write([{"id": i} for i in range(4)]))
+    assert (report["written"], report["failed"]) == (0, 4)
+    assert all(c["status"] == "failed" and c["retryable"] is False for c in report["chunks"])
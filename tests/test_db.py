@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+import app.db as db
+from app.deadline import DeadlineExceeded
+from app.gw_breaker import GatewayUnavailable
+
+
+class FakeGateway:
+    data = [{"username": "u", "password": "p", "address": "10.0.0.1"}]
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    async def get_gateway_by_id(gwid):
+        return FakeGateway()
+    monkeypatch.setattr(db, "get_gateway_by_id", get_gateway_by_id)
+
+
+def fail_acquire_with(monkeypatch, error):
+    async def acquire(*args, **kwargs):
+        raise error
+    monkeypatch.setattr(db.session_manager, "acquire", acquire)
+
+
+@pytest.mark.parametrize("error, status", [(GatewayUnavailable("g"), 503), (DeadlineExceeded(), 504), (ValueError("bad"), 400)])
+def test_gateway_errors_keep_their_status(gateway, monkeypatch, error, status):
+    fail_acquire_with(monkeypatch, error)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(db.get_gw_table_latest_row("hourreport", "g"))
+    assert e.value.status_code == status
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(db.sync_account_list(db.GetAccountListQuery(gwid="g")))
+    assert e.value.status_code == status
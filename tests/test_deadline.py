@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import pytest
+import app.deadline as deadline
+from app.deadline import DeadlineExceeded, request_deadline, run_with_deadline
+
+
+def test_run_with_deadline_returns_result_and_keeps_context():
+    async def main():
+        with request_deadline(5):
+            return await run_with_deadline(lambda x: (x, deadline.remaining() is not None), 1)
+    assert asyncio.run(main()) == (1, True)
+
+
+def test_timeout_outside_request_uses_call_timeout(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(deadline, "CALL_TIMEOUT", 0.05)
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(run_with_deadline(release.wait, 5))
+    release.set()
+
+
+def test_queued_calls_are_cancelled_after_timeout(monkeypatch):
+    # 线程池占满时新的调用排队，超时之后不会再执行
+    from concurrent.futures import ThreadPoolExecutor
+    release = threading.Event()
+    ran = []
+    monkeypatch.setattr(deadline, "_executor", ThreadPoolExecutor(max_workers=1))
+
+    async def main():
+        blocker = asyncio.ensure_future(run_with_deadline(release.wait, 5))
+        await asyncio.sleep(0.01)
+        with request_deadline(0.05):
+            with pytest.raises(DeadlineExceeded):
+                await run_with_deadline(ran.append, 1)
+        release.set()
+        await blocker
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert ran == []
@@ -0,0 +1,54 @@
+import asyncio
+from contextlib import asynccontextmanager
+import app.fleet_sync as fleet_sync
+from app.sync_lease import SyncJobRunning
+
+
+class FakeStatus:
+    def __init__(self, status):
+        self.status = status
+        self.updates = []
+
+    def get(self, gwid, table_name):
+        return dict(self.status)
+
+    def update(self, gwid, table_name, **fields):
+        self.updates.append(fields)
+        self.status.update(fields)
+        return self.status
+
+
+def test_lease_held_elsewhere_keeps_its_status(monkeypatch):
+    store = FakeStatus({"state": fleet_sync.STATE_RUNNING, "started_ts": 1})
+    monkeypatch.setattr(fleet_sync, "sync_status", store)
+
+    @asynccontextmanager
+    async def busy_lease(gwid, table_name):
+        raise SyncJobRunning(gwid, table_name)
+        yield
+
+    monkeypatch.setattr(fleet_sync, "sync_lease", busy_lease)
+    assert asyncio.run(fleet_sync.sync_gateway_table("g", "hourreport")) is None
+    assert store.updates == []
+    assert store.status["state"] == fleet_sync.STATE_RUNNING
+
+
+def test_running_is_written_after_the_lease_is_taken(monkeypatch):
+    store = FakeStatus({})
+    events = []
+    monkeypatch.setattr(fleet_sync, "sync_status", store)
+
+    @asynccontextmanager
+    async def lease(gwid, table_name):
+        events.append("lease")
+        yield
+
+    async def sync_table_locked(*args, **kwargs):
+        events.append(store.status["state"])
+        return {"rows": 1}
+
+    monkeypatch.setattr(fleet_sync, "sync_lease", lease)
+    monkeypatch.setattr(fleet_sync, "sync_table_locked", sync_table_locked)
+    assert asyncio.run(fleet_sync.sync_gateway_table("g", "hourreport")) is True
+    assert events == ["lease", fleet_sync.STATE_RUNNING]
+    assert store.status["state"] == fleet_sync.STATE_SUCCESS
@@ -0,0 +1,38 @@
+import asyncio
+import app.fleet_users as fu
+from app.fleet_users import FleetUserSync, GatewaySnapshot
+
+
+def snapshot(gwid):
+    s = GatewaySnapshot(gwid)
+    s.users = [{"gwid": gwid, "id": "1", "username": "u1"}]
+    s.strategies = [{"gwid": gwid, "id": "s1", "period": "month", "threshold": "10", "exceed": "drop", "remark": ""}]
+    return s
+
+
+def run_write(monkeypatch, strategy_failed):
+    calls = []
+
+    async def fake_bulk_upsert(table_name, rows, on_conflict=None):
+        calls.append(("upsert", table_name))
+        failed = len(rows) if strategy_failed and table_name == "gw_bandwidth_strategy" else 0
+        return {"table_name": table_name, "rows": len(rows), "written": len(rows) - failed, "failed": failed, "chunks": []}
+
+    async def fake_delete(self, gwids, strategy_ids):
+        calls.append(("delete", sorted(gwids), sorted(strategy_ids)))
+
+    monkeypatch.setattr(fu, "bulk_upsert", fake_bulk_upsert)
+    monkeypatch.setattr(FleetUserSync, "delete_stale_strategies", fake_delete)
+    asyncio.run(FleetUserSync().write_all([snapshot("g1"), snapshot("g2")]))
+    return calls
+
+
+def test_stale_strategies_deleted_after_upsert(monkeypatch):
+    calls = run_write(monkeypatch, strategy_failed=False)
+    assert calls[-1] == ("delete", ["g1", "g2"], ["g1_s1", "g2_s1"])
+    assert ("upsert", "gw_bandwidth_strategy") in calls[:-1]
+
+
+def test_strategies_kept_when_upsert_fails(monkeypatch):
+    calls = run_write(monkeypatch, strategy_failed=True)
+    assert not any(c[0] == "delete" for c in calls)
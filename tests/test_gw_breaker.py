@@ -0,0 +1,92 @@
+import pytest
+import app.gw_breaker as gw_breaker
+from app.gw_breaker import GatewayBreakers, GatewayUnavailable, STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gw_breaker.time, "time", clock.time)
+    return clock
+
+
+def fail(breakers, key="g"):
+    breakers.before_call(key)
+    breakers.record_failure(key, "timeout")
+
+
+def test_opens_after_threshold_failures(clock):
+    breakers = GatewayBreakers(threshold=3, open_timeout=30)
+    fail(breakers)
+    fail(breakers)
+    assert breakers.breakers["g"].state == STATE_CLOSED
+    fail(breakers)
+    assert breakers.breakers["g"].state == STATE_OPEN
+    assert breakers.is_open("g")
+    with pytest.raises(GatewayUnavailable):
+        breakers.before_call("g")
+
+
+def test_success_resets_failure_count(clock):
+    breakers = GatewayBreakers(threshold=2, open_timeout=30)
+    fail(breakers)
+    breakers.before_call("g")
+    breakers.record_success("g")
+    fail(breakers)
+    assert breakers.breakers["g"].state == STATE_CLOSED
+
+
+def test_half_open_allows_one_trial(clock):
+    breakers = GatewayBreakers(threshold=1, open_timeout=30)
+    fail(breakers)
+    clock.now += 31
+    assert not breakers.is_open("g")
+    breakers.before_call("g")
+    assert breakers.breakers["g"].state == STATE_HALF_OPEN
+    with pytest.raises(GatewayUnavailable):
+        breakers.before_call("g")
+    breakers.record_success("g")
+    assert breakers.breakers["g"].state == STATE_CLOSED
+    breakers.before_call("g")
+
+
+def test_failed_trial_reopens(clock):
+    breakers = GatewayBreakers(threshold=3, open_timeout=30)
+    for _ in range(3):
+        fail(breakers)
+    clock.now += 31
+    fail(breakers)
+    assert breakers.breakers["g"].state == STATE_OPEN
+    assert breakers.breakers["g"].opened_at == clock.now
+
+
+def test_gateway_up_and_release(clock):
+    breakers = GatewayBreakers(threshold=1, open_timeout=30)
+    fail(breakers)
+    breakers.on_gateway_up("g")
+    assert breakers.breakers["g"].state == STATE_HALF_OPEN
+    breakers.before_call("g")
+    # 试探被取消，不计入成功或失败，下一个调用可以继续试探
+    breakers.release("g")
+    breakers.before_call("g")
+    assert breakers.breakers["g"].state == STATE_HALF_OPEN
+
+
+def test_guard_counts_only_given_failures(clock):
+    breakers = GatewayBreakers(threshold=1, open_timeout=30)
+    with pytest.raises(KeyError):
+        with breakers.guard("g", (TimeoutError,)):
+            raise KeyError("not a gateway failure")
+    assert breakers.breakers["g"].failures == 0
+    with pytest.raises(TimeoutError):
+        with breakers.guard("g", (TimeoutError,)):
+            raise TimeoutError()
+    assert breakers.is_open("g")
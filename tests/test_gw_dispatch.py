@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from app.gw_dispatch import SingleFlight
+
+
+def test_concurrent_calls_share_one_task():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        return await asyncio.gather(*[flight.do("k", fetch) for _ in range(5)])
+
+    assert asyncio.run(main()) == ["value"] * 5
+    assert len(calls) == 1
+    assert flight.stats == {"calls": 5, "shared": 4}
+
+
+def test_finished_call_is_not_reused_and_keys_are_separate():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        first = await flight.do("k", fetch)
+        second = await flight.do("k", fetch)
+        other = await flight.do("other", fetch)
+        return first, second, other
+
+    assert asyncio.run(main()) == (1, 2, 3)
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        return await asyncio.gather(flight.do("k", fail), flight.do("k", fail), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "value"
+
+    async def main():
+        first = asyncio.ensure_future(flight.do("k", fetch))
+        second = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "value"
@@ -0,0 +1,45 @@
+import sqlite3
+from app.gw_pager import build_keyset_sql, cursor_of
+from app.supabase import TABLE_KEYS, GLOBAL_ID_KEYS, keys_for_table_name
+
+
+def test_table_keys_cover_global_id_keys():
+    # 排序键必须能唯一确定一行，否则分页时会丢掉跨页的并列行
+    for table_name, keys in GLOBAL_ID_KEYS.items():
+        missing = [k for k in keys if k != "gwid" and k not in TABLE_KEYS[table_name]]
+        assert missing == [], f"{table_name}: {missing}"
+
+
+def test_build_keyset_sql_after_expands_to_or():
+    sql = build_keyset_sql("t", ["a", "b"], after=["x", "y"], page_size=10)
+    assert sql == "SELECT * FROM t WHERE ((a > 'x') OR (a = 'x' AND b > 'y')) ORDER BY a, b LIMIT 10"
+
+
+def test_build_keyset_sql_bounds_and_quoting():
+    sql = build_keyset_sql("t", ["a"], since="s'1", start="s2", end="s3", page_size=5)
+    assert sql == "SELECT * FROM t WHERE a > 's''1' AND a >= 's2' AND a < 's3' ORDER BY a LIMIT 5"
+
+
+def test_keyset_pages_keep_tied_leading_keys():
+    # 同一时间、ip、mac和target的多行，只有direction和proto不同，分页边界落在它们中间
+    keys = keys_for_table_name("sessionslog", "happentime")
+    columns = ["happentime", "ip", "mac", "direction", "proto", "target"]
+    rows = []
+    for direction in ["in", "out"]:
+        for proto in ["icmp", "tcp", "udp"]:
+            rows.append(("2024-11-07 10:00:00", "10.0.0.1", "aa:bb", direction, proto, "host0"))
+    rows.append(("2024-11-07 10:00:01", "10.0.0.1", "aa:bb", "in", "udp", "host0"))
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"CREATE TABLE sessionslog ({', '.join(columns)})")
+    conn.executemany(f"INSERT INTO sessionslog VALUES ({', '.join('?' * len(columns))})", rows)
+
+    seen = []
+    after = None
+    while True:
+        page = [dict(r) for r in conn.execute(build_keyset_sql("sessionslog", keys, after=after, page_size=3))]
+        if len(page) == 0:
+            break
+        seen.extend(tuple(r[c] for c in columns) for r in page)
+        after = cursor_of(page[-1], keys)
+    assert sorted(seen) == sorted(rows)
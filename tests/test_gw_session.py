@@ -0,0 +1,49 @@
+import threading
+import time
+from app.gw_session import GatewaySessionManager
+
+
+def test_slow_sync_login_does_not_block_other_gateways(monkeypatch):
+    manager = GatewaySessionManager()
+    release = threading.Event()
+    logged_in = []
+
+    def sync_login(session):
+        if session.gwid == "slow":
+            release.wait(5)
+        session.session_id = f"sid-{session.gwid}"
+        session.touch()
+        logged_in.append(session.gwid)
+        return True
+
+    monkeypatch.setattr(manager, "_sync_login", sync_login)
+    slow = threading.Thread(target=manager.acquire_sync, args=("slow", "10.0.0.1", "u", "p"))
+    slow.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    sdk = manager.acquire_sync("fast", "10.0.0.2", "u", "p")
+    assert time.monotonic() - started < 1
+    assert sdk.session_id == "sid-fast"
+    release.set()
+    slow.join()
+    assert logged_in == ["fast", "slow"]
+
+
+def test_concurrent_sync_acquire_logs_in_once(monkeypatch):
+    manager = GatewaySessionManager()
+    calls = []
+
+    def sync_login(session):
+        calls.append(session.gwid)
+        time.sleep(0.05)
+        session.session_id = "sid"
+        session.touch()
+        return True
+
+    monkeypatch.setattr(manager, "_sync_login", sync_login)
+    threads = [threading.Thread(target=manager.acquire_sync, args=("g", "10.0.0.1", "u", "p")) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ["g"]
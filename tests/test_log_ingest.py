@@ -0,0 +1,19 @@
+from datetime import datetime
+from app.log_ingest import iter_windows
+
+
+def test_iter_windows_aligns_first_window_and_covers_hi():
+    lo = datetime(2024, 11, 7, 10, 20, 5)
+    hi = datetime(2024, 11, 7, 12, 0, 0)
+    windows = list(iter_windows(lo, hi, 3600))
+    assert windows[0] == (datetime(2024, 11, 7, 10), datetime(2024, 11, 7, 11))
+    assert windows[-1] == (datetime(2024, 11, 7, 12), datetime(2024, 11, 7, 13))
+    assert len(windows) == 3
+    # 窗口首尾相接，没有空隙和重叠
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+
+
+def test_iter_windows_single_point_and_empty_range():
+    t = datetime(2024, 11, 7, 10, 0, 0)
+    assert list(iter_windows(t, t, 600)) == [(t, datetime(2024, 11, 7, 10, 10))]
+    assert list(iter_windows(datetime(2024, 11, 7, 11), t, 600)) == []
@@ -0,0 +1,102 @@
+import app.row_digest as row_digest
+from app.row_digest import RowDigests, row_hash, short_hash
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.reads = 0
+
+    def hgetall(self, key):
+        self.reads += 1
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, values):
+        self.hashes.setdefault(key, {}).update(values)
+
+    def expire(self, key, seconds):
+        pass
+
+
+def make_row(global_id, up, day="2024-11-07"):
+    return {"global_id": global_id, "happendate": f"{day} 10:00:00", "up": up}
+
+
+def test_filter_skips_unchanged_rows_after_commit(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(row_digest, "redis", redis)
+    digests = RowDigests("g", "hourreport", "happendate")
+    rows = [make_row("a", 1), make_row("b", 2)]
+    changed, pending = digests._filter(rows)
+    assert changed == rows
+    digests._commit(pending)
+    assert redis.hashes["starlink.sync.digest.g.hourreport.2024-11-07"][short_hash("a")] == row_hash(rows[0])
+
+    changed, _ = RowDigests("g", "hourreport", "happendate")._filter([make_row("a", 1), make_row("b", 3)])
+    assert changed == [make_row("b", 3)]
+
+
+def test_filter_without_commit_does_not_skip(monkeypatch):
+    monkeypatch.setattr(row_digest, "redis", FakeRedis())
+    digests = RowDigests("g", "hourreport", "happendate")
+    digests._filter([make_row("a", 1)])
+    changed, _ = digests._filter([make_row("a", 1)])
+    assert changed == [make_row("a", 1)]
+
+
+def test_filter_force_and_rows_without_global_id(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(row_digest, "redis", redis)
+    digests = RowDigests("g", "hourreport", "happendate")
+    digests._commit(digests._filter([make_row("a", 1)])[1])
+    forced = RowDigests("g", "hourreport", "happendate", force=True)
+    changed, pending = forced._filter([make_row("a", 1), {"up": 1}])
+    assert changed == [make_row("a", 1), {"up": 1}]
+    assert list(pending) == ["2024-11-07"]
+
+
+def test_each_day_is_loaded_once(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(row_digest, "redis", redis)
+    digests = RowDigests("g", "hourreport", "happendate")
+    digests._filter([make_row("a", 1), make_row("b", 1), make_row("c", 1, day="2024-11-08")])
+    digests._filter([make_row("d", 1)])
+    assert redis.reads == 2
+
+
+def test_ingest_rebuild_rewrites_rows_with_matching_digests(monkeypatch):
+    import asyncio
+    import app.log_ingest as log_ingest
+    import app.sync_pipeline as sync_pipeline
+    monkeypatch.setattr(row_digest, "redis", FakeRedis())
+    rows = [make_row("a", 1), make_row("b", 2)]
+    written = []
+
+    async def fetch_bounds(gwid, table_name, column):
+        return "2024-11-07", "2024-11-07"
+
+    async def read(self, out):
+        await out.put((rows, 0, ["2024-11-07"]))
+        await out.put(sync_pipeline._DONE)
+
+    async def passthrough(self, inp, out):
+        while True:
+            item = await inp.get()
+            await out.put(item if item is sync_pipeline._DONE else (item[0], item[-1]))
+            if item is sync_pipeline._DONE:
+                break
+
+    monkeypatch.setattr(log_ingest, "fetch_bounds", fetch_bounds)
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_read", read)
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_parse", passthrough)
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_transform", passthrough)
+    monkeypatch.setattr(sync_pipeline.BulkWriter, "_send", lambda self, chunk: written.extend(chunk))
+
+    def ingest(rebuild):
+        written.clear()
+        asyncio.run(log_ingest.ingest_windows("g", "webreport", "2024-11-07", "2024-11-07", rebuild, 1, 100))
+        return list(written)
+
+    assert ingest(False) == rows
+    assert ingest(False) == []
+    assert ingest(True) == rows
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+import app.sync_lease as sync_lease_module
+import app.sync_pipeline as sync_pipeline
+from app.sync_lease import SyncLease, SyncLeaseLost, sync_lease
+
+
+@pytest.fixture
+def fast_renew(monkeypatch):
+    monkeypatch.setattr(sync_lease_module, "RENEW_INTERVAL", 0.01)
+    monkeypatch.setattr(SyncLease, "acquire", lambda self: True)
+    monkeypatch.setattr(SyncLease, "release", lambda self: True)
+
+
+def test_failed_renew_marks_lease_lost(fast_renew, monkeypatch):
+    monkeypatch.setattr(SyncLease, "renew", lambda self: False)
+
+    async def main():
+        async with sync_lease("g", "hourreport") as lease:
+            assert not lease.lost
+            await asyncio.sleep(0.05)
+            return lease
+
+    lease = asyncio.run(main())
+    assert lease.lost
+    with pytest.raises(SyncLeaseLost):
+        lease.check()
+
+
+def test_renew_errors_within_ttl_keep_the_lease(fast_renew, monkeypatch):
+    def renew(self):
+        raise ConnectionError("redis unavailable")
+
+    monkeypatch.setattr(SyncLease, "renew", renew)
+
+    async def main():
+        async with sync_lease("g", "hourreport") as lease:
+            await asyncio.sleep(0.05)
+            return lease
+
+    assert not asyncio.run(main()).lost
+
+
+def test_pipeline_stops_without_checkpoint_when_lease_is_lost(monkeypatch):
+    checkpoints = []
+    written = []
+    lease = SyncLease("g", "hourreport")
+    pages = [([{"global_id": "a"}], ["1"]), ([{"global_id": "b"}], ["2"])]
+
+    async def read(self, out):
+        for rows, last in pages:
+            await out.put((rows, 0, last))
+        await out.put(sync_pipeline._DONE)
+
+    async def passthrough(self, inp, out):
+        while True:
+            item = await inp.get()
+            await out.put(item if item is sync_pipeline._DONE else (item[0], item[-1]))
+            if item is sync_pipeline._DONE:
+                break
+
+    async def aset(*args, **kwargs):
+        checkpoints.append(args)
+        # 第一页的检查点写入之后租约失效
+        lease.lost = True
+
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_read", read)
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_parse", passthrough)
+    monkeypatch.setattr(sync_pipeline.SyncPipeline, "_transform", passthrough)
+    monkeypatch.setattr(sync_pipeline.BulkWriter, "_send", lambda self, chunk: written.extend(chunk))
+    monkeypatch.setattr(sync_pipeline.sync_watermarks, "aset", aset)
+    pipeline = sync_pipeline.SyncPipeline("g", "sessionslog", lease=lease)
+    with pytest.raises(SyncLeaseLost):
+        asyncio.run(pipeline.run())
+    assert written == [{"global_id": "a"}]
+    assert len(checkpoints) == 1
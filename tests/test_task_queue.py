@@ -0,0 +1,186 @@
+import asyncio
+import app.task_queue as tq
+from app.task_queue import LocalTaskQueue, MAX_ATTEMPTS
+
+
+def make_queue(tmp_path):
+    return LocalTaskQueue(str(tmp_path / "tasks.db"))
+
+
+def test_put_ignores_duplicate_task_ids(tmp_path):
+    q = make_queue(tmp_path)
+    assert q.put([{"task_id": "a", "cmd": "PING_SERVER", "data": {"gwid": "g"}}, {"task_id": "b", "cmd": "X"}]) == 2
+    assert q.put([{"task_id": "a", "cmd": "PING_SERVER"}]) == 0
+
+
+def test_claim_is_exclusive_and_counts_attempts(tmp_path):
+    q = make_queue(tmp_path)
+    q.put([{"task_id": "a", "cmd": "PING_SERVER", "data": {"gwid": "g"}}, {"task_id": "b", "cmd": "X"}])
+    claimed = q.claim(10)
+    assert [c["task_id"] for c in claimed] == ["a", "b"]
+    assert claimed[0]["data"] == {"gwid": "g"}
+    assert claimed[0]["attempts"] == 1
+    assert q.claim(10) == []
+    assert q.get("a")["status"] == "doing"
+
+
+def test_claim_only_given_task_ids(tmp_path):
+    q = make_queue(tmp_path)
+    q.put([{"task_id": "a", "cmd": "X"}, {"task_id": "b", "cmd": "X"}])
+    assert [c["task_id"] for c in q.claim(10, ["b"])] == ["b"]
+    assert q.get("a")["status"] == "todo"
+
+
+def test_finish_done_and_retry(tmp_path):
+    q = make_queue(tmp_path)
+    q.put([{"task_id": "a", "cmd": "X"}, {"task_id": "b", "cmd": "X"}])
+    q.claim(10)
+    q.finish([("a", True, {"ok": 1}), ("b", False, {"error": "x"})])
+    assert q.get("a")["status"] == "done"
+    assert q.get("b")["status"] == "todo"
+    assert [c["task_id"] for c in q.claim(10)] == ["b"]
+
+
+def test_failing_task_becomes_failed_after_max_attempts(tmp_path):
+    q = make_queue(tmp_path)
+    q.put([{"task_id": "a", "cmd": "X"}])
+    for _ in range(MAX_ATTEMPTS):
+        assert len(q.claim(1)) == 1
+        q.finish([("a", False, {"error": "x"})])
+    assert q.get("a")["status"] == "failed"
+    assert q.claim(1) == []
+
+
+def test_expired_claims_count_and_end_failed(tmp_path):
+    # 每次执行都让进程退出的任务：租约过期后重新领取，次数用完后不再领取
+    q = make_queue(tmp_path)
+    q.put([{"task_id": "a", "cmd": "X"}])
+    for i in range(MAX_ATTEMPTS):
+        claimed = q.claim(1, lease=0)
+        assert claimed[0]["attempts"] == i + 1
+    assert q.claim(1, lease=0) == []
+    assert q.get("a")["status"] == "failed"
+
+
+def test_flush_upserts_status_and_result_only(tmp_path, monkeypatch):
+    q = make_queue(tmp_path)
+    sent = []
+
+    async def fake_bulk_upsert(table_name, rows, on_conflict=None):
+        sent.append((table_name, on_conflict, rows))
+        return {"rows": len(rows), "written": len(rows), "failed": 0, "chunks": []}
+
+    monkeypatch.setattr(tq, "bulk_upsert", fake_bulk_upsert)
+    q.put([{"task_id": "a", "cmd": "X", "data": {"table_data": [1, 2, 3]}}], remote=True)
+    q.claim(1)
+    q.finish([("a", True, {"data": [1, 2]})])
+    assert asyncio.run(q.flush()) == 1
+    table_name, on_conflict, rows = sent[0]
+    assert (table_name, on_conflict) == ("tasks", "task_id")
+    assert rows == [{"task_id": "a", "status": "done", "result": {"data": [1, 2]}}]
+    assert q.stats()["done"]["dirty"] == 0
+    assert asyncio.run(q.flush()) == 0
+
+
+def test_local_tasks_are_not_flushed(tmp_path, monkeypatch):
+    q = make_queue(tmp_path)
+
+    async def fake_bulk_upsert(table_name, rows, on_conflict=None):
+        raise AssertionError("local tasks have no row in supabase")
+
+    monkeypatch.setattr(tq, "bulk_upsert", fake_bulk_upsert)
+    q.put([{"task_id": "a", "cmd": "X"}])
+    q.claim(1)
+    q.finish([("a", True, {"data": []})])
+    assert asyncio.run(q.flush()) == 0
+    assert q.stats()["done"]["dirty"] == 0
+
+
+def test_exhausted_task_is_flushed_as_todo(tmp_path, monkeypatch):
+    q = make_queue(tmp_path)
+    sent = []
+
+    async def fake_bulk_upsert(table_name, rows, on_conflict=None):
+        sent.extend(rows)
+        return {"rows": len(rows), "written": len(rows), "failed": 0, "chunks": []}
+
+    monkeypatch.setattr(tq, "bulk_upsert", fake_bulk_upsert)
+    q.put([{"task_id": "a", "cmd": "X"}], remote=True)
+    for _ in range(MAX_ATTEMPTS):
+        q.claim(1)
+        q.finish([("a", False, {"error": "x"})])
+    assert q.get("a")["status"] == "failed"
+    asyncio.run(q.flush())
+    assert sent == [{"task_id": "a", "status": "todo", "result": {"error": "x"}}]
+
+
+def failed_report(rows, retryable):
+    return {"rows": len(rows), "written": 0, "failed": len(rows),
+            "chunks": [{"status": "failed", "rows": len(rows), "error": "e", "retryable": retryable}]}
+
+
+def test_flush_keeps_dirty_rows_when_supabase_is_unavailable(tmp_path, monkeypatch):
+    q = make_queue(tmp_path)
+
+    async def failing_bulk_upsert(table_name, rows, on_conflict=None):
+        return failed_report(rows, True)
+
+    monkeypatch.setattr(tq, "bulk_upsert", failing_bulk_upsert)
+    q.put([{"task_id": "a", "cmd": "X"}], remote=True)
+    q.claim(1)
+    assert asyncio.run(q.flush()) == 0
+    assert q.stats()["doing"]["dirty"] == 1
+
+
+def test_rejected_rows_are_retried_one_by_one_then_dropped(tmp_path, monkeypatch):
+    q = make_queue(tmp_path)
+    calls = []
+
+    async def rejecting_bulk_upsert(table_name, rows, on_conflict=None):
+        calls.append([r["task_id"] for r in rows])
+        if any(r["task_id"] == "bad" for r in rows):
+            return failed_report(rows, False)
+        return {"rows": len(rows), "written": len(rows), "failed": 0, "chunks": []}
+
+    monkeypatch.setattr(tq, "bulk_upsert", rejecting_bulk_upsert)
+    q.put([{"task_id": "good", "cmd": "X"}, {"task_id": "bad", "cmd": "X"}], remote=True)
+    q.claim(2)
+    assert asyncio.run(q.flush()) == 1
+    assert calls[0] == ["good", "bad"]
+    assert sorted(calls[1:]) == [["bad"], ["good"]]
+    assert q.stats()["doing"]["dirty"] == 0
+    assert asyncio.run(q.flush()) == 0
+
+
+def test_old_database_is_migrated(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "tasks.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE tasks (task_id TEXT PRIMARY KEY, cmd TEXT, data TEXT, status TEXT NOT NULL DEFAULT 'todo', result TEXT, "
+                 "attempts INTEGER NOT NULL DEFAULT 0, claimed_at REAL, updated_at REAL NOT NULL, dirty INTEGER NOT NULL DEFAULT 1)")
+    conn.execute("INSERT INTO tasks (task_id, cmd, data, updated_at) VALUES ('a', 'X', '{}', 0)")
+    conn.commit()
+    conn.close()
+    q = LocalTaskQueue(path)
+    assert q.get("a")["dirty"] == 0
+    assert [c["task_id"] for c in q.claim(1)] == ["a"]
+
+
+def test_perform_tasks_records_state_locally(tmp_path, monkeypatch):
+    import app.task as task_module
+    q = make_queue(tmp_path)
+
+    async def fake_run_single_task(request):
+        if request.command == "BAD":
+            return {"error": "command not found"}
+        return {"data": request.data}
+
+    monkeypatch.setattr(task_module, "run_single_task", fake_run_single_task)
+    tasks = [{"task_id": "a", "cmd": "OK", "data": {"x": 1}}, {"task_id": "b", "cmd": "BAD", "data": {}}]
+    results = asyncio.run(task_module.perform_tasks(tasks, queue=q))
+    assert sorted((task_id, ok) for task_id, ok, _ in results) == [("a", True), ("b", False)]
+    assert q.get("a")["status"] == "done"
+    assert q.get("b")["status"] == "todo"
+    # 已经完成的任务不会重复执行
+    results = asyncio.run(task_module.perform_tasks([tasks[0]], queue=q))
+    assert results == []